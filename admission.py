@@ -0,0 +1,303 @@
+"""
+请求准入控制 - 限制同时推理的请求数，超出部分进入有界等待队列，队列满时快速拒绝
+- 优先级：interactive 请求总是先于 batch 请求获得名额，batch 请求最多占用 batch_max_share 比例的并发，
+  其余名额留给交互式请求，batch 租户压满节点时交互式请求的延迟仍有保证
+- 同一优先级内按租户（用户 / API key）加权公平排队（start-time fair queuing）：
+  每个请求的代价为 prompt token 数 + 请求的生成 token 数，租户的排队位置按 累计代价 / 权重 推进，
+  大量提交长请求的租户不会饿死其他租户
+- 截止时间：按实测的 prefill 速度（token/s）与单序列 decode 耗时（s/token）估算请求耗时
+  （prompt token 数 / prefill 速度 + max_tokens × decode 耗时），加上排队等待的估计（运行中请求的剩余耗时与
+  排在前面的请求耗时之和，按并发名额平摊）；预计无法在截止时间前完成的请求直接拒绝，排队期间到期的请求移出队列，
+  节点过载时不再接收注定超时的请求。尚无实测数据时不做预估（只在排队期间按截止时间移出）
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)  # 按优先级从高到低
+DEADLINE_HEADER = "X-Request-Timeout"  # 请求超时（秒），与请求体的 timeout 字段取较小者
+
+
+class OverloadedError(Exception):
+    """等待队列已满，请求被拒绝"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineError(OverloadedError):
+    """请求预计无法在截止时间前完成（或排队期间已到期），提前拒绝"""
+
+
+def request_deadline(timeout: Optional[float], header: Optional[str], default_timeout: float = 0.0) -> Optional[float]:
+    """
+    请求的截止时间（time.time() 时间戳），从收到请求起计算：请求体 timeout 与 X-Request-Timeout 头取较小者，
+    都未指定时使用 default_timeout（0 表示不限制）；头部不是正数时抛出 ValueError
+    """
+    timeouts = [timeout] if timeout is not None else []
+    if header:
+        try:
+            value = float(header)
+        except ValueError:
+            value = 0.0
+        if not value > 0:
+            raise ValueError(f"{DEADLINE_HEADER} 必须为正数（秒）: {header}")
+        timeouts.append(value)
+    if not timeouts and default_timeout > 0:
+        timeouts.append(default_timeout)
+    return time.time() + min(timeouts) if timeouts else None
+
+
+@dataclass(frozen=True)
+class Tenant:
+    """公平调度的单位"""
+    name: str
+    weight: float = 1.0
+    priority: str = PRIORITY_INTERACTIVE
+
+
+DEFAULT_TENANT = Tenant("anonymous")
+
+
+@dataclass(eq=False)
+class Grant:
+    """已获得的执行名额，release 时传回"""
+    tenant: Tenant
+    admitted_at: float
+    prompt_tokens: int = 0
+    estimated_seconds: float = 0.0  # 获取名额时估算的执行耗时
+
+
+class AdmissionController:
+    """
+    有界准入队列（在事件循环中使用）
+    - 同时执行的请求数不超过 max_concurrency
+    - 其余请求按优先级 + 租户公平顺序排队，每个优先级的排队数不超过 max_queue_size
+    - 队列满时抛出 OverloadedError，并根据平均服务时长估算 Retry-After
+    - 指定截止时间的请求预计无法按时完成、或排队期间到期时抛出 DeadlineError
+    """
+
+    def __init__(self, max_concurrency: int, max_queue_size: int, batch_max_share: float = 1.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.batch_max_concurrency = max(1, math.floor(max_concurrency * batch_max_share))
+        self._active = 0
+        self._active_by_priority: Dict[str, int] = {p: 0 for p in PRIORITY_CLASSES}
+        # 每个优先级一个小根堆：(完成标签, 序号, 开始标签, 租户名, 等待者, 估算耗时)
+        self._queues: Dict[str, List[tuple]] = {p: [] for p in PRIORITY_CLASSES}
+        self._queued_seconds: Dict[str, float] = {p: 0.0 for p in PRIORITY_CLASSES}  # 排队请求的估算耗时之和
+        self._grants: set = set()  # 执行中的名额
+        self._virtual_time: Dict[str, float] = {p: 0.0 for p in PRIORITY_CLASSES}
+        self._finish_tags: Dict[str, float] = {}  # 租户 -> 最后一个排队请求的完成标签
+        self._sequence = itertools.count()
+
+        self.admitted_total = 0
+        self.completed_total = 0
+        self.rejected_total = 0
+        self.avg_wait_time = 0.0  # 秒，指数移动平均
+        self.avg_service_time = 0.0  # 秒，指数移动平均
+        self.last_wait_time = 0.0
+        self.deadline_rejected_total = 0  # 预计无法按时完成而拒绝的请求数
+        self.deadline_expired_total = 0  # 排队期间到期的请求数
+        self.prefill_tokens_per_second = 0.0  # 指数移动平均，0 表示尚无实测
+        self.decode_seconds_per_token = 0.0  # 单个序列每生成一个 token 的耗时，指数移动平均
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def acquire(
+        self,
+        tenant: Tenant = DEFAULT_TENANT,
+        cost: float = 1.0,
+        bounded: bool = True,
+        deadline: Optional[float] = None,
+        prompt_tokens: int = 0,
+        max_tokens: int = 0,
+    ) -> Grant:
+        """
+        获取执行名额，cost 为请求的代价（token 数）
+        bounded=False 时排队数不计上限（调用方自身已限制并发，如离线批处理）
+        deadline 为截止时间（time.time() 时间戳），按 prompt_tokens / max_tokens 估算耗时，预计超时则抛出 DeadlineError
+        """
+        start = time.monotonic()
+        priority = tenant.priority
+        estimated = self.estimate_seconds(prompt_tokens, max_tokens)
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            expected = self.estimate_wait(priority) + estimated
+            if timeout <= 0 or expected > timeout:
+                self.deadline_rejected_total += 1
+                raise DeadlineError(
+                    f"请求无法在截止时间前完成：预计耗时 {expected:.1f}s，剩余 {max(timeout, 0.0):.1f}s",
+                    retry_after=self.estimate_retry_after(),
+                )
+        if self._can_start(priority) and not self._waiting_ahead(priority):
+            self._start(priority)
+        else:
+            queue = self._queues[priority]
+            if bounded and len(queue) >= self.max_queue_size:
+                self.rejected_total += 1
+                raise OverloadedError(
+                    f"服务繁忙：排队请求数已达上限 {self.max_queue_size}",
+                    retry_after=self.estimate_retry_after(),
+                )
+            start_tag = max(self._virtual_time[priority], self._finish_tags.get(tenant.name, 0.0))
+            finish_tag = start_tag + cost / max(tenant.weight, 1e-6)
+            self._finish_tags[tenant.name] = finish_tag
+            if len(self._finish_tags) > 4096:
+                # 标签不超过当前虚拟时间的租户不再受限，可以清理
+                floor = min(self._virtual_time.values())
+                self._finish_tags = {name: tag for name, tag in self._finish_tags.items() if tag > floor}
+            waiter = asyncio.get_running_loop().create_future()
+            entry = (finish_tag, next(self._sequence), start_tag, tenant.name, waiter, estimated)
+            heapq.heappush(queue, entry)
+            self._queued_seconds[priority] += estimated
+            try:
+                # 超时后 wait_for 取消 waiter，与请求被取消的处理相同
+                await asyncio.wait_for(waiter, timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+                if entry in queue:
+                    queue.remove(entry)
+                    heapq.heapify(queue)
+                    self._queued_seconds[priority] -= estimated
+                elif waiter.done() and not waiter.cancelled():
+                    # 名额已经转交给本请求，但请求被取消，需要归还
+                    self._release_slot(priority)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.deadline_expired_total += 1
+                    raise DeadlineError("请求在排队期间已到截止时间", retry_after=self.estimate_retry_after())
+                raise
+
+        admitted_at = time.monotonic()
+        self._record_wait(admitted_at - start)
+        grant = Grant(tenant, admitted_at, prompt_tokens, estimated)
+        self._grants.add(grant)
+        return grant
+
+    def release(self, grant: Grant, completion_tokens: int = 0, prefill_seconds: Optional[float] = None) -> None:
+        """
+        归还执行名额；completion_tokens 为单个序列生成的 token 数，prefill_seconds 为调度到首 token 的耗时，
+        两者用于更新 prefill 速度与 decode 耗时的实测值
+        """
+        service_time = time.monotonic() - grant.admitted_at
+        self.completed_total += 1
+        self.avg_service_time = service_time if self.completed_total == 1 else (
+            0.9 * self.avg_service_time + 0.1 * service_time
+        )
+        if prefill_seconds is not None and prefill_seconds > 0 and grant.prompt_tokens:
+            self.prefill_tokens_per_second = _ema(self.prefill_tokens_per_second, grant.prompt_tokens / prefill_seconds)
+        decode_seconds = service_time - (prefill_seconds or 0.0)
+        if completion_tokens > 1 and decode_seconds > 0:
+            self.decode_seconds_per_token = _ema(self.decode_seconds_per_token, decode_seconds / (completion_tokens - 1))
+        self._grants.discard(grant)
+        self._release_slot(grant.tenant.priority)
+
+    def estimate_seconds(self, prompt_tokens: int, max_tokens: int) -> float:
+        """按实测速度估算请求的执行耗时（生成满 max_tokens），尚无实测数据时返回 0"""
+        if not self.decode_seconds_per_token:
+            return 0.0
+        prefill = prompt_tokens / self.prefill_tokens_per_second if self.prefill_tokens_per_second else 0.0
+        return prefill + max_tokens * self.decode_seconds_per_token
+
+    def estimate_wait(self, priority: str = PRIORITY_INTERACTIVE) -> float:
+        """估算新请求获得名额前的等待时间：运行中请求的剩余耗时与排在前面的请求耗时之和，按并发名额平摊"""
+        if self._can_start(priority) and not self._waiting_ahead(priority):
+            return 0.0
+        now = time.monotonic()
+        remaining = sum(max(0.0, g.estimated_seconds - (now - g.admitted_at)) for g in self._grants)
+        for p in PRIORITY_CLASSES:
+            remaining += self._queued_seconds[p]
+            if p == priority:
+                break
+        return remaining / self.max_concurrency
+
+    def _can_start(self, priority: str) -> bool:
+        if self._active >= self.max_concurrency:
+            return False
+        return priority != PRIORITY_BATCH or self._active_by_priority[PRIORITY_BATCH] < self.batch_max_concurrency
+
+    def _waiting_ahead(self, priority: str) -> bool:
+        """是否有同级或更高优先级的请求在排队（新请求不插队）"""
+        for p in PRIORITY_CLASSES:
+            if self._queues[p]:
+                return True
+            if p == priority:
+                return False
+        return False
+
+    def _start(self, priority: str) -> None:
+        self._active += 1
+        self._active_by_priority[priority] += 1
+
+    def _release_slot(self, priority: str) -> None:
+        self._active -= 1
+        self._active_by_priority[priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """名额直接转交给排在最前的等待者：先高优先级，同级内完成标签最小者"""
+        for priority in PRIORITY_CLASSES:
+            queue = self._queues[priority]
+            while queue and self._can_start(priority):
+                _, _, start_tag, tenant_name, waiter, estimated = heapq.heappop(queue)
+                self._queued_seconds[priority] -= estimated
+                if waiter.done():
+                    continue
+                self._virtual_time[priority] = start_tag
+                if self._finish_tags.get(tenant_name, 0.0) <= start_tag:
+                    # 该租户没有更靠后的排队请求，清理标签
+                    self._finish_tags.pop(tenant_name, None)
+                self._start(priority)
+                waiter.set_result(None)
+            if queue:
+                # 高优先级仍有请求在等待时，不把名额让给低优先级
+                return
+
+    def _record_wait(self, wait: float) -> None:
+        self.admitted_total += 1
+        self.last_wait_time = wait
+        self.avg_wait_time = wait if self.admitted_total == 1 else (
+            0.9 * self.avg_wait_time + 0.1 * wait
+        )
+
+    def estimate_retry_after(self) -> int:
+        """估算排队请求全部开始执行所需的秒数"""
+        if self.avg_service_time <= 0:
+            return 1
+        rounds = (self.queue_depth + 1) / self.max_concurrency
+        return max(1, math.ceil(rounds * self.avg_service_time))
+
+    def stats(self) -> Dict:
+        return {
+            "active": self._active,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "max_queue_size": self.max_queue_size,
+            "by_priority": {
+                p: {"active": self._active_by_priority[p], "queue_depth": len(self._queues[p])}
+                for p in PRIORITY_CLASSES
+            },
+            "batch_max_concurrency": self.batch_max_concurrency,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "avg_wait_ms": round(self.avg_wait_time * 1000, 2),
+            "last_wait_ms": round(self.last_wait_time * 1000, 2),
+            "deadline_rejected_total": self.deadline_rejected_total,
+            "deadline_expired_total": self.deadline_expired_total,
+            "prefill_tokens_per_second": round(self.prefill_tokens_per_second, 1),
+            "decode_ms_per_token": round(self.decode_seconds_per_token * 1000, 2),
+        }
+
+
+def _ema(average: float, value: float) -> float:
+    """指数移动平均，average 为 0 时直接取 value"""
+    return value if not average else 0.9 * average + 0.1 * value
@@ -0,0 +1,1049 @@
+"""
+连续批处理推理引擎（CPU版本）
+将并发请求合并到同一个 decode batch 中，按 token 步粒度加入新序列、移除已完成序列
+"""
+import asyncio
+import inspect
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Sequence as Seq, Tuple
+
+import torch
+
+from detokenizer import IncrementalDetokenizer
+from prefix_cache import PrefixCache
+from session_cache import SessionCache
+from static_kv import StaticKVDecoder, static_cache_supported
+from sampling import (
+    SamplingParams,
+    logits_to_probs,
+    sample_from_probs,
+    sample_next_tokens,
+    verify_draft_tokens,
+)
+from stop_matcher import StopMatcher
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # 旧版本 transformers 只支持 tuple 格式的 KV 缓存
+    DynamicCache = None
+
+logger = logging.getLogger(__name__)
+
+# 每层一个 (key, value)，形状均为 [batch, heads, seq_len, head_dim]
+KVCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+@dataclass
+class RequestOutput:
+    """引擎每步推送给请求方的增量输出"""
+    request_id: str
+    text: str
+    token_ids: List[int]
+    prompt_tokens: int
+    completion_tokens: int
+    finish_reason: Optional[str] = None
+    prefill_time: Optional[float] = None  # 从被调度到产生第一个 token 的耗时（秒）
+    index: int = 0  # 候选序号（n > 1 时区分同一请求的多个候选）
+    cumulative_logprob: Optional[float] = None  # best_of > n 时用于挑选候选
+
+    @property
+    def finished(self) -> bool:
+        """该候选已结束；请求在 n 个候选都结束后结束"""
+        return self.finish_reason is not None
+
+
+class Sequence:
+    """引擎内部的一条生成序列"""
+
+    def __init__(
+        self,
+        request_id: str,
+        prompt_token_ids: List[int],
+        params: SamplingParams,
+        loop: asyncio.AbstractEventLoop,
+        index: int = 0,
+        queue: Optional[asyncio.Queue] = None,
+        session_id: Optional[str] = None,
+    ):
+        self.request_id = request_id
+        self.prompt_token_ids = list(prompt_token_ids)
+        self.params = params
+        self.index = index
+        self.session_id = session_id
+        self.output_token_ids: List[int] = []
+        self.cumulative_logprob = 0.0
+        self.text = ""
+        self.finish_reason: Optional[str] = None
+        self.arrival_time = time.time()
+        self.scheduled_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.stop_matcher = StopMatcher(params.stop) if params.stop else None
+        self.generator = None
+        if params.seed is not None:
+            # 同一请求的各候选使用不同的随机数序列
+            self.generator = torch.Generator().manual_seed(params.seed + index)
+        self.detokenizer: Optional[IncrementalDetokenizer] = None  # 首个 token 时由引擎创建
+        self._stable_text = 0  # 已确认（可安全推送）的文本长度
+        self._sent_text = 0
+        self._sent_tokens = 0
+        self._loop = loop
+        self._queue: asyncio.Queue = queue if queue is not None else asyncio.Queue()
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def needs_logprobs(self) -> bool:
+        return self.params.num_sequences > self.params.n
+
+    def fork(self, index: int) -> "Sequence":
+        """prefill 后分叉出第 index 个候选，共享同一个输出队列"""
+        child = Sequence(self.request_id, self.prompt_token_ids, self.params, self._loop, index, self._queue)
+        child.arrival_time = self.arrival_time
+        child.scheduled_time = self.scheduled_time
+        return child
+
+    def put(self, item) -> None:
+        """从引擎线程向事件循环投递输出（RequestOutput 或异常）"""
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    async def get(self):
+        item = await self._queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+
+def kv_to_tuple(past) -> KVCache:
+    """把模型返回的 KV 缓存（Cache 对象或 tuple）统一转换为 tuple 格式"""
+    if isinstance(past, tuple):
+        return past
+    if hasattr(past, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return tuple(past)
+
+
+def kv_from_tuple(past: KVCache):
+    """把 tuple 格式的 KV 缓存转换为模型可接受的格式"""
+    if DynamicCache is None:
+        return past
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past)
+    return DynamicCache(past)
+
+
+def kv_index(past: KVCache, index: torch.Tensor) -> KVCache:
+    """按 batch 维度选取行"""
+    return tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in past)
+
+
+def kv_left_pad(past: KVCache, pad: int) -> KVCache:
+    """在时间维度左侧补零，用于对齐不同长度的 batch"""
+    if pad <= 0:
+        return past
+    return tuple(
+        (torch.nn.functional.pad(k, (0, 0, pad, 0)), torch.nn.functional.pad(v, (0, 0, pad, 0)))
+        for k, v in past
+    )
+
+
+def kv_concat(caches: Seq[KVCache]) -> KVCache:
+    """沿 batch 维度拼接时间维度已对齐的多个 KV 缓存"""
+    return tuple(
+        (torch.cat([c[i][0] for c in caches]), torch.cat([c[i][1] for c in caches]))
+        for i in range(len(caches[0]))
+    )
+
+
+def kv_zeros(template: KVCache, batch_size: int, length: int) -> KVCache:
+    """构造与 template 同层数/同形状（除 batch 和时间维度外）的全零 KV"""
+    return tuple(
+        (
+            k.new_zeros((batch_size, k.shape[1], length, k.shape[3])),
+            v.new_zeros((batch_size, v.shape[1], length, v.shape[3])),
+        )
+        for k, v in template
+    )
+
+
+def kv_trim_left(past: KVCache, start: int) -> KVCache:
+    """去掉时间维度上前 start 列"""
+    if start <= 0:
+        return past
+    return tuple((k[:, :, start:], v[:, :, start:]) for k, v in past)
+
+
+def kv_select_columns(past: KVCache, row: int, columns: torch.Tensor) -> KVCache:
+    """取出第 row 行在指定时间列上的 KV（batch 维度保留为 1）"""
+    return tuple(
+        (k[row:row + 1].index_select(2, columns), v[row:row + 1].index_select(2, columns)) for k, v in past
+    )
+
+
+def kv_compact(past: KVCache, attention_mask: torch.Tensor) -> KVCache:
+    """去掉每行中被 attention mask 屏蔽的列，按有效长度重新左 padding 对齐"""
+    length = int(attention_mask.sum(-1).max())
+    rows = []
+    for i in range(attention_mask.shape[0]):
+        columns = attention_mask[i].nonzero().squeeze(-1)
+        rows.append(kv_left_pad(kv_select_columns(past, i, columns), length - len(columns)))
+    return kv_concat(rows)
+
+
+def mask_compact(attention_mask: torch.Tensor) -> torch.Tensor:
+    """与 kv_compact 对应的左 padding attention mask"""
+    valid = attention_mask.sum(-1)
+    length = int(valid.max())
+    return (torch.arange(length)[None, :] >= (length - valid)[:, None]).long()
+
+
+def positions_from_mask(attention_mask: torch.Tensor) -> torch.Tensor:
+    """左 padding 下每个位置对应的 position id"""
+    return (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+
+def length_buckets(lengths: List[int], max_padding_ratio: float) -> List[List[int]]:
+    """
+    按长度升序分组（返回各组的下标），组内左 padding 的 token 占比不超过 max_padding_ratio，
+    短 prompt 不会被同组的长 prompt 拖成长 prompt；max_padding_ratio >= 1 时不拆分
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    groups: List[List[int]] = []
+    current: List[int] = []
+    total = 0
+    for i in order:
+        padded = (len(current) + 1) * lengths[i]  # 升序加入，组内最长的就是当前序列
+        if current and padded - total - lengths[i] > max_padding_ratio * padded:
+            groups.append(current)
+            current, total = [], 0
+        current.append(i)
+        total += lengths[i]
+    if current:
+        groups.append(current)
+    return groups
+
+
+def merge_outputs(outputs: List[RequestOutput]) -> RequestOutput:
+    """把同一候选的增量输出合并为一个完整输出"""
+    last = outputs[-1]
+    return RequestOutput(
+        request_id=last.request_id,
+        text="".join(o.text for o in outputs),
+        token_ids=[t for o in outputs for t in o.token_ids],
+        prompt_tokens=last.prompt_tokens,
+        completion_tokens=last.completion_tokens,
+        finish_reason=last.finish_reason,
+        prefill_time=next((o.prefill_time for o in outputs if o.prefill_time is not None), None),
+        index=last.index,
+        cumulative_logprob=last.cumulative_logprob,
+    )
+
+
+def select_best_of(candidates: Dict[int, List[RequestOutput]], n: int) -> List[RequestOutput]:
+    """best_of 个候选中按累计 logprob 取前 n 个，候选序号按排名重新编号"""
+    merged = sorted(
+        (merge_outputs(outputs) for outputs in candidates.values()),
+        key=lambda o: o.cumulative_logprob if o.cumulative_logprob is not None else float("-inf"),
+        reverse=True,
+    )[:n]
+    for index, output in enumerate(merged):
+        output.index = index
+    return merged
+
+
+async def collect_outputs(
+    outputs: AsyncIterator[RequestOutput],
+    on_output: Optional[Callable[[RequestOutput], None]] = None,
+) -> Dict:
+    """
+    非流式：汇总 generate() 的增量输出
+    返回 {text, finish_reason, prompt_tokens, completion_tokens, choices}，
+    text / finish_reason 为第一个候选，completion_tokens 为所有候选之和
+    """
+    choices: Dict[int, Dict] = {}
+    prompt_tokens = 0
+    async for output in outputs:
+        if on_output is not None:
+            on_output(output)
+        choice = choices.setdefault(output.index, {"text": "", "finish_reason": None, "completion_tokens": 0})
+        choice["text"] += output.text
+        choice["finish_reason"] = output.finish_reason
+        choice["completion_tokens"] = output.completion_tokens
+        prompt_tokens = output.prompt_tokens
+    ordered = [choices[i] for i in sorted(choices)]
+    return {
+        "text": ordered[0]["text"],
+        "finish_reason": ordered[0]["finish_reason"],
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": sum(c["completion_tokens"] for c in ordered),
+        "choices": [{"text": c["text"], "finish_reason": c["finish_reason"]} for c in ordered],
+    }
+
+
+class ContinuousBatchingEngine:
+    """
+    连续批处理引擎
+    - 后台线程循环执行：接纳等待中的请求（批量 prefill）→ 所有运行中序列 decode 一步 → 移除已完成序列
+    - batch 内序列左 padding 对齐，attention mask / position ids 按序列各自计算
+    - 每个序列保留自己的采样参数与停止条件
+    - n / best_of > 1 的请求只 prefill 一次，KV 行复制为多个候选后一起 decode
+    - 同一步接纳的多个请求按待 prefill 的长度分组，每组一次前向，padding 占比不超过 prefill_padding_ratio；
+      引擎空闲时可等待 batch_wait_ms，让同时到达的并发请求凑成一次批量 prefill
+    - 配置草稿模型时使用投机解码：草稿模型逐个提议 k 个 token，主模型一次前向验证，
+      被拒绝位置的 KV 列由 attention mask 屏蔽，空洞累积到一定比例后统一压缩
+    - 带 session_id 的请求结束时把 prompt + 回复的 KV 存入会话缓存，同一会话的下一轮只 prefill 新增部分
+    - static_kv_cache 开启时 decode 使用按形状分桶的预分配 KV 缓冲区（见 static_kv.py），
+      compile_decode 再用 torch.compile 编译 decode 步，引擎线程启动时按分桶预热；投机解码时不生效
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_model_len: int = 4096,
+        prefix_cache: Optional[PrefixCache] = None,
+        draft_model=None,
+        num_speculative_tokens: int = 4,
+        session_cache: Optional[SessionCache] = None,
+        prefill_padding_ratio: float = 0.3,
+        batch_wait_ms: float = 0.0,
+        static_kv_cache: bool = False,
+        compile_decode: bool = False,
+        static_kv_min_len: int = 256,
+        compile_warmup_len: int = 1024,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_model_len = max_model_len
+        self.prefix_cache = prefix_cache
+        self.session_cache = session_cache
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.prefill_padding_ratio = prefill_padding_ratio
+        self.batch_wait_seconds = batch_wait_ms / 1000
+        self.static_decoder: Optional[StaticKVDecoder] = None
+        if static_kv_cache and draft_model is not None:
+            logger.warning("投机解码每步验证多个 token，不使用静态 KV 缓存")
+        elif static_kv_cache and not static_cache_supported(model):
+            logger.warning("当前 transformers 版本的 StaticCache 不支持，decode 使用动态 KV 缓存")
+        elif static_kv_cache:
+            self.static_decoder = StaticKVDecoder(
+                model,
+                max_batch_size=max_batch_size,
+                max_model_len=max_model_len,
+                min_len=static_kv_min_len,
+                compile=compile_decode,
+                warmup_len=compile_warmup_len,
+            )
+
+        self.eos_token_ids = self._collect_eos_token_ids()
+        self.pad_token_id = tokenizer.pad_token_id
+        if self.pad_token_id is None:
+            self.pad_token_id = next(iter(self.eos_token_ids), 0)
+
+        # prefill 只需要最后一个位置的 logits，避免 [B, L, V] 的巨大张量
+        forward_params = inspect.signature(model.forward).parameters
+        if "logits_to_keep" in forward_params:
+            self._prefill_kwargs = {"logits_to_keep": 1}
+        elif "num_logits_to_keep" in forward_params:
+            self._prefill_kwargs = {"num_logits_to_keep": 1}
+        else:
+            self._prefill_kwargs = {}
+
+        self._waiting: Deque[Sequence] = deque()
+        self._running: List[Sequence] = []
+        self._prefilling: List[Sequence] = []  # 本步接纳、尚未合并进 batch 的序列（prefill 失败时需通知）
+        self._aborted: set = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+        # 运行中 batch 的状态
+        self._past: Optional[KVCache] = None
+        self._draft_past: Optional[KVCache] = None  # 草稿模型的 KV，与主模型共用 attention mask
+        self._attention_mask: Optional[torch.Tensor] = None  # [B, T]
+        self._next_tokens: Optional[torch.Tensor] = None  # [B]，已采样但尚未送入模型的 token
+
+        self.total_generated_tokens = 0
+        self.total_steps = 0
+        self.cancelled_total = 0
+        self.spec_proposed_tokens = 0
+        self.spec_accepted_tokens = 0
+        self.prefill_batches = 0  # prefill 前向次数
+        self.prefill_tokens = 0  # prefill 的有效 token 数
+        self.prefill_padded_tokens = 0  # prefill 的 token 数（含 padding）
+        self.decode_seconds = 0.0  # decode 前向的累计耗时（不含采样与投机解码）
+        self.decode_steps = 0
+
+    def _collect_eos_token_ids(self) -> set:
+        eos = set()
+        for value in (
+            getattr(getattr(self.model, "generation_config", None), "eos_token_id", None),
+            self.tokenizer.eos_token_id,
+        ):
+            if value is None:
+                continue
+            eos.update(value if isinstance(value, (list, tuple)) else [value])
+        return eos
+
+    # ============================================
+    # 对外接口（在事件循环中调用）
+    # ============================================
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="batch-engine", daemon=True)
+        self._thread.start()
+        logger.info(f"连续批处理引擎已启动 (max_batch_size={self.max_batch_size})")
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.session_cache is not None:
+            self.session_cache.clear()
+
+    def add_request(
+        self,
+        prompt_token_ids: List[int],
+        params: SamplingParams,
+        request_id: Optional[str] = None,
+        session_id: Optional[str] = None,
+    ) -> Sequence:
+        if len(prompt_token_ids) == 0:
+            raise ValueError("prompt 不能为空")
+        if len(prompt_token_ids) >= self.max_model_len:
+            raise ValueError(
+                f"prompt 长度 {len(prompt_token_ids)} 超过模型最大长度 {self.max_model_len}"
+            )
+        params.validate()
+        if params.num_sequences > self.max_batch_size:
+            raise ValueError(
+                f"候选数 {params.num_sequences} 超过引擎 batch 大小 {self.max_batch_size}"
+            )
+        if session_id is not None and params.num_sequences > 1:
+            raise ValueError("session_id 不支持多个候选（n / best_of > 1）")
+        seq = Sequence(
+            request_id=request_id or uuid.uuid4().hex,
+            prompt_token_ids=prompt_token_ids,
+            params=params,
+            loop=asyncio.get_running_loop(),
+            session_id=session_id,
+        )
+        with self._lock:
+            self._waiting.append(seq)
+        self._wakeup.set()
+        return seq
+
+    async def generate(
+        self,
+        prompt_token_ids: List[int],
+        params: SamplingParams,
+        request_id: Optional[str] = None,
+        session_id: Optional[str] = None,
+    ) -> AsyncIterator[RequestOutput]:
+        """
+        提交请求并异步迭代增量输出，每个候选（按 output.index 区分）的最后一个输出带 finish_reason
+        best_of > n 时等所有候选结束后一次性返回得分最高的 n 个
+        指定 session_id 时复用该会话上一轮的 KV，结束后保存本轮的 KV
+        调用方提前退出（客户端断开、任务被取消）时自动取消生成
+        """
+        seq = self.add_request(prompt_token_ids, params, request_id, session_id)
+        remaining = params.num_sequences
+        candidates: Dict[int, List[RequestOutput]] = {}
+        try:
+            while remaining:
+                output = await seq.get()
+                if output.finished:
+                    remaining -= 1
+                if seq.needs_logprobs:
+                    candidates.setdefault(output.index, []).append(output)
+                else:
+                    yield output
+            for output in select_best_of(candidates, params.n) if candidates else []:
+                yield output
+        finally:
+            if remaining:
+                self.abort(seq.request_id)
+
+    def abort(self, request_id: str) -> None:
+        """取消请求：在下一个 decode 步之前从队列或 batch 中移除，立即释放其 batch 名额"""
+        with self._lock:
+            self._aborted.add(request_id)
+        self._wakeup.set()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            waiting = len(self._waiting)
+        stats = {
+            "running": len(self._running),
+            "waiting": waiting,
+            "max_batch_size": self.max_batch_size,
+            "total_generated_tokens": self.total_generated_tokens,
+            "total_steps": self.total_steps,
+            "cancelled_total": self.cancelled_total,
+            "prefill": {
+                "batches": self.prefill_batches,
+                "tokens": self.prefill_tokens,
+                "padding_ratio": (
+                    round(1 - self.prefill_tokens / self.prefill_padded_tokens, 4) if self.prefill_padded_tokens else 0.0
+                ),
+            },
+        }
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        if self.session_cache is not None:
+            stats["session_cache"] = self.session_cache.stats()
+        if self.decode_steps:
+            stats["decode"] = {
+                "steps": self.decode_steps,
+                "mean_step_ms": round(self.decode_seconds / self.decode_steps * 1000, 3),
+            }
+        if self.static_decoder is not None:
+            stats["static_kv"] = self.static_decoder.stats()
+        if self.draft_model is not None:
+            stats["speculative"] = {
+                "num_speculative_tokens": self.num_speculative_tokens,
+                "proposed": self.spec_proposed_tokens,
+                "accepted": self.spec_accepted_tokens,
+                "acceptance_rate": (
+                    round(self.spec_accepted_tokens / self.spec_proposed_tokens, 4)
+                    if self.spec_proposed_tokens else 0.0
+                ),
+            }
+        return stats
+
+    # ============================================
+    # 引擎线程
+    # ============================================
+
+    def _run(self) -> None:
+        with torch.inference_mode():
+            if self.static_decoder is not None and self.static_decoder.compile:
+                self._warm_up_decode()
+            while not self._stopped:
+                try:
+                    self._step()
+                except Exception as e:
+                    logger.exception("推理引擎执行失败")
+                    self._fail_running(e)
+
+    def _warm_up_decode(self) -> None:
+        """编译模式下在接纳请求前按分桶预热 decode 步，之后的请求不再触发编译"""
+        out = self.model(input_ids=torch.tensor([[self.pad_token_id]]), use_cache=True)
+        self.static_decoder.warm_up(kv_to_tuple(out.past_key_values))
+
+    def _step(self) -> None:
+        self._process_aborts()
+        new_seqs = self._take_waiting()
+        if new_seqs:
+            self._prefilling = new_seqs
+            self._prefill(new_seqs)
+            self._prefilling = []
+        if self._running:
+            self._decode()
+        elif not new_seqs:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+    def _process_aborts(self) -> None:
+        with self._lock:
+            if not self._aborted:
+                return
+            aborted, self._aborted = self._aborted, set()
+            # 尚未 prefill 的多候选请求也要为每个候选发送结束输出
+            cancelled = [
+                seq.fork(j) if j else seq
+                for seq in self._waiting if seq.request_id in aborted
+                for j in range(seq.params.num_sequences)
+            ]
+            if cancelled:
+                self._waiting = deque(seq for seq in self._waiting if seq.request_id not in aborted)
+        cancelled += [seq for seq in self._running if seq.request_id in aborted]
+        request_ids = {seq.request_id for seq in cancelled}
+        self.cancelled_total += len(request_ids)
+        for seq in cancelled:
+            seq.finish_reason = "abort"
+            self._emit(seq)
+        if cancelled:
+            logger.info(f"已取消 {len(request_ids)} 个请求")
+            self._retire()
+
+    def _take_waiting(self) -> List[Sequence]:
+        """按到达顺序接纳请求，每个请求占用 num_sequences 个 batch 名额"""
+        free = self.max_batch_size - len(self._running)
+        if self.batch_wait_seconds > 0 and not self._running:
+            self._wait_for_batch(free)
+        taken = []
+        with self._lock:
+            while self._waiting and self._waiting[0].params.num_sequences <= free:
+                free -= self._waiting[0].params.num_sequences
+                taken.append(self._waiting.popleft())
+        now = time.time()
+        # 等待期间已到截止时间的请求不再 prefill，每个候选直接以 "length"（无输出）结束
+        expired = [seq for seq in taken if seq.params.expired(now)]
+        for seq in expired:
+            for child in [seq.fork(j) if j else seq for j in range(seq.params.num_sequences)]:
+                child.finish_reason = "length"
+                self._emit(child)
+        taken = [seq for seq in taken if not seq.finished]
+        for seq in taken:
+            seq.scheduled_time = now
+        return taken
+
+    def _wait_for_batch(self, free: int) -> None:
+        """引擎空闲时，等到最早的请求到达 batch_wait_seconds 后（或名额已满）再接纳，让并发请求一起 prefill"""
+        while not self._stopped:
+            with self._lock:
+                if not self._waiting or sum(seq.params.num_sequences for seq in self._waiting) >= free:
+                    return
+                remaining = self._waiting[0].arrival_time + self.batch_wait_seconds - time.time()
+            if remaining <= 0:
+                return
+            self._wakeup.wait(remaining)
+            self._wakeup.clear()
+
+    def _prefill(self, seqs: List[Sequence]) -> None:
+        """新加入的序列按待 prefill 的后缀长度分组，每组一次批量 prefill，短的组先完成（首 token 更早）"""
+        cached = [self._match_prefix(seq) for seq in seqs]
+        lengths = [len(seq.prompt_token_ids) - length for seq, (length, _) in zip(seqs, cached)]
+        for group in length_buckets(lengths, self.prefill_padding_ratio):
+            self._prefill_group([seqs[i] for i in group], [cached[i] for i in group])
+
+    def _prefill_group(self, seqs: List[Sequence], cached: List[Tuple[int, Optional[KVCache]]]) -> None:
+        """
+        对一组新序列做一次批量 prefill，并合并到运行中的 batch
+        命中前缀缓存的序列只需 prefill 未缓存的后缀，每行布局为：
+            [padding | 缓存前缀] + [padding | 待 prefill 后缀]
+        中间的 padding 由 attention mask 屏蔽，position ids 按有效 token 计数
+        """
+        prefix_len = max(length for length, _ in cached)
+        suffixes = [seq.prompt_token_ids[length:] for seq, (length, _) in zip(seqs, cached)]
+        suffix_len = max(len(suffix) for suffix in suffixes)
+        self.prefill_batches += 1
+        self.prefill_tokens += sum(len(suffix) for suffix in suffixes)
+        self.prefill_padded_tokens += suffix_len * len(seqs)
+
+        input_ids = torch.full((len(seqs), suffix_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(seqs), prefix_len + suffix_len), dtype=torch.long)
+        for i, ((length, _), suffix) in enumerate(zip(cached, suffixes)):
+            input_ids[i, suffix_len - len(suffix):] = torch.tensor(suffix, dtype=torch.long)
+            attention_mask[i, prefix_len - length:prefix_len] = 1
+            attention_mask[i, prefix_len + suffix_len - len(suffix):] = 1
+
+        past = None
+        if prefix_len > 0:
+            template = next(kv for _, kv in cached if kv is not None)
+            past = kv_from_tuple(kv_concat([
+                kv_left_pad(kv, prefix_len - length) if kv is not None else kv_zeros(template, 1, prefix_len)
+                for length, kv in cached
+            ]))
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=positions_from_mask(attention_mask)[:, prefix_len:],
+            past_key_values=past,
+            use_cache=True,
+            **self._prefill_kwargs,
+        )
+        past = kv_to_tuple(out.past_key_values)
+        if self.prefix_cache is not None:
+            self._insert_prefixes(seqs, past, attention_mask)
+        draft_past = self._draft_prefill(seqs, attention_mask) if self.draft_model is not None else None
+
+        logits = out.logits[:, -1, :]
+        if any(seq.params.num_sequences > 1 for seq in seqs):
+            # 多候选请求：prefill 结果（KV 行、mask、logits）复制到各候选，各自采样第一个 token
+            index = torch.tensor(
+                [i for i, seq in enumerate(seqs) for _ in range(seq.params.num_sequences)], dtype=torch.long
+            )
+            seqs = [seq.fork(j) if j else seq for seq in seqs for j in range(seq.params.num_sequences)]
+            past = kv_index(past, index)
+            if draft_past is not None:
+                draft_past = kv_index(draft_past, index)
+            attention_mask = attention_mask.index_select(0, index)
+            logits = logits.index_select(0, index)
+
+        next_tokens = sample_next_tokens(logits, [s.params for s in seqs], [s.generator for s in seqs])
+        self._merge(past, draft_past, attention_mask, next_tokens, seqs)
+        self._append_tokens(seqs, next_tokens, self._token_logprobs(logits, next_tokens, seqs))
+        self._retire()
+
+    def _draft_prefill(self, seqs: List[Sequence], attention_mask: torch.Tensor) -> KVCache:
+        """草稿模型不使用前缀缓存，按与主模型相同的列布局 prefill 完整 prompt"""
+        input_ids = torch.full(attention_mask.shape, self.pad_token_id, dtype=torch.long)
+        for i, seq in enumerate(seqs):
+            input_ids[i, attention_mask[i].bool()] = torch.tensor(seq.prompt_token_ids, dtype=torch.long)
+        out = self.draft_model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=positions_from_mask(attention_mask),
+            use_cache=True,
+            **self._prefill_kwargs,
+        )
+        return kv_to_tuple(out.past_key_values)
+
+    def _match_prefix(self, seq: Sequence) -> Tuple[int, Optional[KVCache]]:
+        """优先复用会话缓存（含上一轮的回复），未命中时查前缀缓存"""
+        # 至少保留最后一个 token 做 prefill，以得到下一个 token 的 logits
+        max_length = len(seq.prompt_token_ids) - 1
+        if seq.session_id is not None and self.session_cache is not None:
+            length, kv = self.session_cache.match(seq.session_id, seq.prompt_token_ids, max_length)
+            if kv is not None:
+                return length, kv
+        if self.prefix_cache is None:
+            return 0, None
+        return self.prefix_cache.match(seq.prompt_token_ids, max_length=max_length)
+
+    def _insert_prefixes(self, seqs: List[Sequence], past: KVCache, attention_mask: torch.Tensor) -> None:
+        for i, seq in enumerate(seqs):
+            if seq.session_id is not None and self.session_cache is not None:
+                # 会话的 KV 在结束时存入会话缓存，不再占用共享的前缀缓存
+                continue
+            columns = attention_mask[i].nonzero().squeeze(-1)
+            self.prefix_cache.insert(seq.prompt_token_ids, kv_select_columns(past, i, columns))
+
+    def _store_sessions(self) -> None:
+        """正常结束的会话序列：保存 prompt + 已生成 token 的 KV（最后一个 token 尚未送入模型时不含其 KV）"""
+        for i, seq in enumerate(self._running):
+            if seq.session_id is None or seq.finish_reason not in ("stop", "length"):
+                continue
+            columns = self._attention_mask[i].nonzero().squeeze(-1)
+            token_ids = seq.prompt_token_ids + seq.output_token_ids
+            length = min(len(columns), len(token_ids))
+            self.session_cache.store(
+                seq.session_id,
+                token_ids[:length],
+                len(seq.prompt_token_ids),
+                kv_select_columns(self._past, i, columns[:length]),
+            )
+
+    def _merge(
+        self,
+        past: KVCache,
+        draft_past: Optional[KVCache],
+        attention_mask: torch.Tensor,
+        next_tokens: torch.Tensor,
+        seqs: List[Sequence],
+    ) -> None:
+        if self._past is None:
+            self._past, self._attention_mask, self._next_tokens = past, attention_mask, next_tokens
+            self._draft_past = draft_past
+            self._running = list(seqs)
+            return
+
+        old_len = self._attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        total = max(old_len, new_len)
+        self._past = kv_concat([
+            kv_left_pad(self._past, total - old_len),
+            kv_left_pad(past, total - new_len),
+        ])
+        if draft_past is not None:
+            self._draft_past = kv_concat([
+                kv_left_pad(self._draft_past, total - old_len),
+                kv_left_pad(draft_past, total - new_len),
+            ])
+        self._attention_mask = torch.cat([
+            torch.nn.functional.pad(self._attention_mask, (total - old_len, 0)),
+            torch.nn.functional.pad(attention_mask, (total - new_len, 0)),
+        ])
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens])
+        self._running.extend(seqs)
+
+    def _decode(self) -> None:
+        """所有运行中的序列前进一个 token"""
+        if self.draft_model is not None:
+            self._speculative_decode()
+            return
+        start = time.perf_counter()
+        batch_size, length = self._attention_mask.shape
+        attention_mask = torch.cat(
+            [self._attention_mask, torch.ones((batch_size, 1), dtype=torch.long)], dim=1
+        )
+        if self.static_decoder is not None and self.static_decoder.fits(batch_size, length):
+            logits, self._past = self.static_decoder.step(self._past, self._attention_mask, self._next_tokens)
+        else:
+            out = self.model(
+                input_ids=self._next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=self._attention_mask.sum(-1, keepdim=True),
+                past_key_values=kv_from_tuple(self._past),
+                use_cache=True,
+            )
+            self._past = kv_to_tuple(out.past_key_values)
+            logits = out.logits[:, -1, :]
+        self._attention_mask = attention_mask
+        self.decode_seconds += time.perf_counter() - start
+        self.decode_steps += 1
+        self._next_tokens = sample_next_tokens(
+            logits, [s.params for s in self._running], [s.generator for s in self._running]
+        )
+        self.total_steps += 1
+        self._append_tokens(
+            self._running, self._next_tokens, self._token_logprobs(logits, self._next_tokens, self._running)
+        )
+        self._retire()
+
+    def _speculative_decode(self) -> None:
+        """
+        投机解码一步：草稿模型逐个提议 k 个 token，主模型一次前向验证 k+1 个位置
+        每行接受 a 个草稿 token 并额外得到 1 个 token（拒绝位置重采样或全部接受后的下一个 token）
+        """
+        k = self.num_speculative_tokens
+        batch_size = len(self._running)
+        params = [s.params for s in self._running]
+        generators = [s.generator for s in self._running]
+        all_greedy = all(p.greedy for p in params)
+        ones = torch.ones((batch_size, 1), dtype=torch.long)
+
+        # 草稿模型多前进一步（消费第 k 个草稿 token），使其 KV 列与主模型保持一致
+        draft_past = self._draft_past
+        draft_mask = self._attention_mask
+        token = self._next_tokens
+        draft_tokens, draft_probs = [], []
+        for step in range(k + 1):
+            position_ids = draft_mask.sum(-1, keepdim=True)
+            draft_mask = torch.cat([draft_mask, ones], dim=1)
+            out = self.draft_model(
+                input_ids=token[:, None],
+                attention_mask=draft_mask,
+                position_ids=position_ids,
+                past_key_values=kv_from_tuple(draft_past),
+                use_cache=True,
+            )
+            draft_past = kv_to_tuple(out.past_key_values)
+            if step == k:
+                break
+            logits = out.logits[:, -1, :]
+            if all_greedy:
+                token = logits.argmax(dim=-1)
+            else:
+                probs = self._draft_probs(logits, params)
+                token = sample_from_probs(probs, generators)
+                draft_probs.append(probs)
+            draft_tokens.append(token)
+        draft_tokens = torch.stack(draft_tokens, dim=1)  # [B, k]
+
+        # 主模型一次验证：输入为上一步的 token + k 个草稿 token
+        input_ids = torch.cat([self._next_tokens[:, None], draft_tokens], dim=1)
+        position_ids = self._attention_mask.sum(-1, keepdim=True) + torch.arange(k + 1)[None, :]
+        attention_mask = torch.cat(
+            [self._attention_mask, torch.ones((batch_size, k + 1), dtype=torch.long)], dim=1
+        )
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=kv_from_tuple(self._past),
+            use_cache=True,
+        )
+        logits = out.logits
+        if all_greedy:
+            target = logits.argmax(dim=-1)  # [B, k+1]
+            num_accepted = (target[:, :k] == draft_tokens).long().cumprod(dim=-1).sum(dim=-1)
+            next_tokens = target.gather(1, num_accepted[:, None]).squeeze(1)
+        else:
+            target_probs = torch.stack([logits_to_probs(logits[:, j], params) for j in range(k + 1)], dim=1)
+            num_accepted, next_tokens = verify_draft_tokens(
+                target_probs, torch.stack(draft_probs, dim=1), draft_tokens, generators
+            )
+
+        # 每行只保留上一步 token 与被接受的草稿 token 对应的列，其余列屏蔽
+        keep = torch.arange(k + 1)[None, :] <= num_accepted[:, None]
+        self._past = kv_to_tuple(out.past_key_values)
+        self._draft_past = draft_past
+        self._attention_mask = torch.cat([self._attention_mask, keep.long()], dim=1)
+        self._next_tokens = next_tokens
+        self.total_steps += 1
+        self.spec_proposed_tokens += k * batch_size
+        self.spec_accepted_tokens += int(num_accepted.sum())
+
+        # 第 j 列 logits 预测的 token：被接受的草稿 token，或拒绝位置 / 末尾的新 token
+        chosen = torch.cat([draft_tokens, next_tokens[:, None]], dim=1)
+        chosen.scatter_(1, num_accepted[:, None], next_tokens[:, None])
+        logprobs = None
+        if any(seq.needs_logprobs for seq in self._running):
+            logprobs = torch.log_softmax(logits.float(), dim=-1).gather(2, chosen[:, :, None]).squeeze(-1)
+
+        for i, seq in enumerate(self._running):
+            accepted = int(num_accepted[i])
+            for j, token in enumerate(chosen[i, :accepted + 1].tolist()):
+                if seq.finished:
+                    break
+                self._append_token(seq, token, float(logprobs[i, j]) if logprobs is not None else None)
+            self._emit(seq)
+        self._compact_if_needed()
+        self._retire()
+
+    def _draft_probs(self, logits: torch.Tensor, params: List[SamplingParams]) -> torch.Tensor:
+        """草稿模型的采样分布，对齐到主模型词表大小（两者 embedding 大小可能不同）"""
+        vocab_size = self.model.config.vocab_size
+        probs = logits_to_probs(logits[:, :vocab_size], params)
+        if probs.shape[1] < vocab_size:
+            probs = torch.nn.functional.pad(probs, (0, vocab_size - probs.shape[1]))
+        return probs
+
+    def _compact_if_needed(self) -> None:
+        """被拒绝位置留下的空洞列超过阈值时，重新左对齐 KV，避免缓存无效增长"""
+        total = self._attention_mask.shape[1]
+        wasted = total - int(self._attention_mask.sum(-1).max())
+        if wasted < max(8 * (self.num_speculative_tokens + 1), total // 4):
+            return
+        self._past = kv_compact(self._past, self._attention_mask)
+        self._draft_past = kv_compact(self._draft_past, self._attention_mask)
+        self._attention_mask = mask_compact(self._attention_mask)
+
+    def _retire(self) -> None:
+        """移除已完成的序列，并裁掉所有行都是 padding 的前导列"""
+        keep = [i for i, seq in enumerate(self._running) if not seq.finished]
+        if len(keep) == len(self._running):
+            return
+        if self.session_cache is not None:
+            self._store_sessions()
+        if not keep:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long)
+        self._past = kv_index(self._past, index)
+        if self._draft_past is not None:
+            self._draft_past = kv_index(self._draft_past, index)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._running = [self._running[i] for i in keep]
+
+        first_valid = int(self._attention_mask.any(dim=0).nonzero()[0])
+        if first_valid > 0:
+            self._past = kv_trim_left(self._past, first_valid)
+            if self._draft_past is not None:
+                self._draft_past = kv_trim_left(self._draft_past, first_valid)
+            self._attention_mask = self._attention_mask[:, first_valid:]
+
+    def _reset_batch(self) -> None:
+        self._running = []
+        self._past = None
+        if self.static_decoder is not None:
+            self.static_decoder.reset()
+        self._draft_past = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _fail_running(self, error: Exception) -> None:
+        """batch 中的序列与本步已接纳、尚未合并进 batch 的序列都以错误结束（同一请求的候选共享输出队列）"""
+        for seq in self._running + self._prefilling:
+            if seq.finish_reason == "error":
+                continue
+            seq.finish_reason = "error"
+            seq.put(error)
+        self._prefilling = []
+        self._reset_batch()
+
+    # ============================================
+    # 输出处理
+    # ============================================
+
+    def _token_logprobs(
+        self, logits: torch.Tensor, tokens: torch.Tensor, seqs: List[Sequence]
+    ) -> Optional[List[float]]:
+        """只有 best_of > n 的请求需要累计 logprob，其余情况跳过 log_softmax"""
+        if not any(seq.needs_logprobs for seq in seqs):
+            return None
+        return torch.log_softmax(logits.float(), dim=-1).gather(1, tokens[:, None]).squeeze(-1).tolist()
+
+    def _append_tokens(
+        self, seqs: List[Sequence], tokens: torch.Tensor, logprobs: Optional[List[float]] = None
+    ) -> None:
+        for i, (seq, token) in enumerate(zip(seqs, tokens.tolist())):
+            if seq.finished:
+                continue
+            self._append_token(seq, token, logprobs[i] if logprobs is not None else None)
+            self._emit(seq)
+
+    def _append_token(self, seq: Sequence, token: int, logprob: Optional[float] = None) -> None:
+        if seq.first_token_time is None:
+            seq.first_token_time = time.time()
+        seq.output_token_ids.append(token)
+        if logprob is not None:
+            seq.cumulative_logprob += logprob
+        self.total_generated_tokens += 1
+        self._update_text(seq, token)
+
+    def _update_text(self, seq: Sequence, token: int) -> None:
+        if seq.detokenizer is None:
+            seq.detokenizer = IncrementalDetokenizer(self.tokenizer)
+        if token in self.eos_token_ids:
+            self._finish_text(seq, "stop")
+            return
+
+        # 增量解码只返回新确认的字符，末尾不完整的多字节字符留到后续 token 补全
+        delta = seq.detokenizer.step([token])
+        text = seq.text + delta
+        stable = len(text)
+        if seq.stop_matcher is not None:
+            # 只喂入新确认的字符，停止词跨 token 也能在补全的那一步立即命中
+            start = seq.stop_matcher.feed(delta)
+            if start >= 0:
+                seq.text = text[:start]
+                seq.finish_reason = "stop"
+                return
+            # 末尾可能是停止词开头的部分暂缓推送
+            stable -= seq.stop_matcher.pending
+        seq.text = text
+        seq._stable_text = max(stable, seq._sent_text)
+
+        total_len = len(seq.prompt_token_ids) + len(seq.output_token_ids)
+        if (
+            len(seq.output_token_ids) >= seq.params.max_tokens
+            or total_len >= self.max_model_len
+            or seq.params.expired(time.time())
+        ):
+            self._finish_text(seq, "length")
+
+    def _finish_text(self, seq: Sequence, finish_reason: str) -> None:
+        """结束时补上增量解码暂缓的尾部文本；尾部同样经过停止词匹配，命中时在停止词处截断"""
+        tail = seq.detokenizer.flush()
+        if tail and seq.stop_matcher is not None:
+            start = seq.stop_matcher.feed(tail)
+            if start >= 0:
+                seq.text = (seq.text + tail)[:start]
+                seq.finish_reason = "stop"
+                return
+        seq.text += tail
+        seq.finish_reason = finish_reason
+
+    def _emit(self, seq: Sequence) -> None:
+        end = len(seq.text) if seq.finished else seq._stable_text
+        delta = seq.text[seq._sent_text:end]
+        new_tokens = seq.output_token_ids[seq._sent_tokens:]
+        if not delta and not new_tokens and not seq.finished:
+            return
+        seq._sent_text = max(end, seq._sent_text)
+        seq._sent_tokens = len(seq.output_token_ids)
+        seq.put(RequestOutput(
+            request_id=seq.request_id,
+            text=delta,
+            token_ids=new_tokens,
+            prompt_tokens=len(seq.prompt_token_ids),
+            completion_tokens=len(seq.output_token_ids),
+            finish_reason=seq.finish_reason,
+            prefill_time=(
+                seq.first_token_time - seq.scheduled_time
+                if seq.first_token_time is not None and seq.scheduled_time is not None
+                else None
+            ),
+            index=seq.index,
+            cumulative_logprob=seq.cumulative_logprob if seq.needs_logprobs else None,
+        ))
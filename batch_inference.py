@@ -0,0 +1,521 @@
+"""
+离线批处理推理 - OpenAI 兼容的 /v1/batches 任务与命令行工具，适合评测集、数据标注等大批量 JSONL 负载
+- 输入每行一个请求: {"custom_id": "...", "method": "POST", "url": "/v1/chat/completions", "body": {聊天请求}}
+  命令行模式下也可以直接是聊天请求体（custom_id 缺省为行号）
+- 分块读入后按 prompt 长度排序，长度相近的请求成组提交，同一组在引擎中一起 prefill，减少左填充浪费
+- 每完成一个请求立即追加写入结果文件并 flush；重新运行时跳过结果文件中已有的 custom_id，可断点续跑
+
+用法:
+    python batch_inference.py requests.jsonl results.jsonl --max-concurrency 16
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import config
+from batch_engine import RequestOutput, collect_outputs
+from sampling import SamplingParams
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+# 终态的任务不再运行
+FINAL_STATUSES = ("completed", "failed", "cancelled", "expired")
+
+# body -> (prompt_token_ids, 采样参数, 模型名)，请求不合法时抛出 ValueError
+PrepareFn = Callable[[Dict], Tuple[List[int], SamplingParams, str]]
+# (生成结果, 模型名) -> 响应体
+ResponseFn = Callable[[Dict, str], Dict]
+# (prompt_token_ids, 采样参数, 模型名) -> 引擎输出流
+GenerateFn = Callable[[List[int], SamplingParams, str], AsyncIterator[RequestOutput]]
+
+
+def read_done_ids(path: str) -> Set[str]:
+    """结果文件中已完成（含失败）的 custom_id，用于断点续跑"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["custom_id"])
+            except (ValueError, KeyError):
+                # 上次中断时可能写了半行
+                continue
+    return done
+
+
+def count_requests(path: str) -> int:
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def read_chunks(path: str, chunk_size: int, skip: Set[str]) -> Iterator[List[Tuple[str, Dict]]]:
+    """按块读取 (custom_id, 请求行)，跳过已完成的请求"""
+    chunk = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = {"_invalid": f"第 {line_no} 行不是合法的 JSON"}
+            custom_id = str(item.get("custom_id") or f"line-{line_no}")
+            if custom_id in skip:
+                continue
+            chunk.append((custom_id, item))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def prepare_chunk(
+    chunk: List[Tuple[str, Dict]], prepare: PrepareFn,
+) -> Tuple[List[Tuple[str, List[int], SamplingParams, str]], List[Tuple[str, str, str]]]:
+    """
+    把一块请求转换为 (custom_id, prompt_token_ids, 采样参数, 模型名)，以及不合法请求的 (custom_id, 错误码, 错误信息)
+    含聊天模板与分词（可能首次加载分词器），在线程池中调用
+    """
+    prepared = []
+    errors = []
+    for custom_id, item in chunk:
+        if "_invalid" in item:
+            errors.append((custom_id, "invalid_json", item["_invalid"]))
+            continue
+        url = item.get("url", BATCH_ENDPOINTS[0])
+        if url not in BATCH_ENDPOINTS:
+            errors.append((custom_id, "invalid_url", f"不支持的接口: {url}"))
+            continue
+        try:
+            prompt_token_ids, params, model_name = prepare(item.get("body", item))
+        except ValueError as e:
+            errors.append((custom_id, "invalid_request", str(e)))
+            continue
+        prepared.append((custom_id, prompt_token_ids, params, model_name))
+    return prepared, errors
+
+
+def output_line(custom_id: str, body: Optional[Dict] = None, error: Optional[Dict] = None) -> str:
+    """OpenAI 批处理结果格式的一行"""
+    record = {
+        "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+        "custom_id": custom_id,
+        "response": None,
+        "error": error,
+    }
+    if body is not None:
+        record["response"] = {
+            "status_code": 200,
+            "request_id": uuid.uuid4().hex,
+            "body": body,
+        }
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+async def run_batch(
+    input_path: str,
+    output_path: str,
+    error_path: str,
+    generate: GenerateFn,
+    prepare: PrepareFn,
+    build_response: ResponseFn,
+    max_concurrency: int,
+    chunk_size: int = 1024,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    cancel_event: Optional[asyncio.Event] = None,
+) -> Dict[str, int]:
+    """
+    执行批处理，结果与错误分别追加到 output_path / error_path
+    返回 {"total", "completed", "failed"}（包含之前运行已完成的部分）
+    """
+    # 读文件、分词都在线程池中执行，不阻塞事件循环（服务中与在线请求共用同一个事件循环）
+    loop = asyncio.get_running_loop()
+    done_ids = await loop.run_in_executor(None, read_done_ids, output_path)
+    failed_ids = await loop.run_in_executor(None, read_done_ids, error_path)
+    counts = {
+        "total": await loop.run_in_executor(None, count_requests, input_path),
+        "completed": len(done_ids),
+        "failed": len(failed_ids - done_ids),
+    }
+    if done_ids or failed_ids:
+        logger.info(f"断点续跑: 跳过已完成 {counts['completed']} 条、已失败 {counts['failed']} 条")
+    # 同一组至少这么多请求一起提交，让引擎在同一步 prefill
+    group_size = max(1, max_concurrency // 2)
+    in_flight: Set[asyncio.Task] = set()
+
+    with open(output_path, "a", encoding="utf-8") as out, open(error_path, "a", encoding="utf-8") as err:
+        def write(f, line: str, key: str) -> None:
+            f.write(line)
+            f.flush()
+            counts[key] += 1
+            if on_progress is not None:
+                on_progress(counts["completed"], counts["failed"])
+
+        def write_error(custom_id: str, code: str, message: str) -> None:
+            write(err, output_line(custom_id, error={"code": code, "message": message}), "failed")
+
+        async def process(custom_id: str, prompt_token_ids: List[int], params: SamplingParams, model_name: str):
+            try:
+                result = await collect_outputs(generate(prompt_token_ids, params, model_name))
+            except asyncio.CancelledError:
+                raise
+            except ValueError as e:
+                write_error(custom_id, "invalid_request", str(e))
+            except Exception as e:
+                logger.error(f"批处理请求 {custom_id} 失败: {str(e)}")
+                write_error(custom_id, "internal_error", str(e))
+            else:
+                write(out, output_line(custom_id, body=build_response(result, model_name)), "completed")
+
+        try:
+            chunks = read_chunks(input_path, chunk_size, done_ids | failed_ids)
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                prepared, errors = await loop.run_in_executor(None, prepare_chunk, chunk, prepare)
+                for custom_id, code, message in errors:
+                    write_error(custom_id, code, message)
+
+                # 长的先跑：长请求耗时长，先提交可缩短尾部；相邻请求长度相近，填充少
+                prepared.sort(key=lambda p: len(p[1]), reverse=True)
+                pos = 0
+                while pos < len(prepared):
+                    if cancel_event is not None and cancel_event.is_set():
+                        return counts
+                    want = min(group_size, len(prepared) - pos)
+                    while max_concurrency - len(in_flight) < want:
+                        if await _wait_any(in_flight, cancel_event):
+                            return counts
+                        in_flight = {task for task in in_flight if not task.done()}
+                    # 空出的名额全部一次性填满，同一事件循环轮次提交的请求会被引擎合并 prefill
+                    free = max_concurrency - len(in_flight)
+                    for custom_id, prompt_token_ids, params, model_name in prepared[pos:pos + free]:
+                        in_flight.add(asyncio.create_task(process(custom_id, prompt_token_ids, params, model_name)))
+                    pos += free
+
+                    if cancel_event is not None and cancel_event.is_set():
+                        return counts
+
+            while in_flight:
+                if await _wait_any(in_flight, cancel_event):
+                    return counts
+                in_flight = {task for task in in_flight if not task.done()}
+            return counts
+        finally:
+            # 取消或异常退出时中止未完成的请求（引擎侧随之释放 KV 缓存）
+            for task in in_flight:
+                task.cancel()
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+async def _wait_any(tasks: Set[asyncio.Task], cancel_event: Optional[asyncio.Event]) -> bool:
+    """等待任一请求完成或任务被取消，返回是否已取消"""
+    if cancel_event is None:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        return False
+    waiter = asyncio.create_task(cancel_event.wait())
+    await asyncio.wait(tasks | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+    waiter.cancel()
+    return cancel_event.is_set()
+
+
+class BatchManager:
+    """
+    /v1/files 与 /v1/batches 的存储和调度
+    - 文件与任务元数据以 JSON 存在 data_dir 下，服务重启后未完成的任务从断点继续
+    - 任务逐个执行，每个任务内部按 max_concurrency 并发提交给引擎
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        generate: GenerateFn,
+        prepare: PrepareFn,
+        build_response: ResponseFn,
+        max_concurrency: int,
+        chunk_size: int = 1024,
+    ):
+        self.files_dir = os.path.join(data_dir, "files")
+        self.batches_dir = os.path.join(data_dir, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+        self.generate = generate
+        self.prepare = prepare
+        self.build_response = build_response
+        self.max_concurrency = max_concurrency
+        self.chunk_size = chunk_size
+
+        self._pending: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_events: Dict[str, asyncio.Event] = {}
+
+    # ---------- 文件 ----------
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{file_id}.jsonl")
+
+    def _file_meta_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{file_id}.json")
+
+    def create_file(self, source: BinaryIO, filename: str, purpose: str) -> Dict:
+        """保存上传的文件（分块复制，不整体读入内存）；文件可能很大，服务中在线程池中调用"""
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        with open(self.file_path(file_id), "wb") as f:
+            shutil.copyfileobj(source, f)
+        return self._save_file_meta(file_id, filename, purpose)
+
+    def _save_file_meta(self, file_id: str, filename: str, purpose: str) -> Dict:
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self.file_path(file_id)) if os.path.exists(self.file_path(file_id)) else 0,
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        _write_json(self._file_meta_path(file_id), meta)
+        return meta
+
+    def get_file(self, file_id: str) -> Optional[Dict]:
+        meta = _read_json(self._file_meta_path(file_id))
+        if meta is not None:
+            meta["bytes"] = os.path.getsize(self.file_path(file_id))
+        return meta
+
+    # ---------- 任务 ----------
+
+    def _batch_path(self, batch_id: str) -> str:
+        return os.path.join(self.batches_dir, f"{batch_id}.json")
+
+    def get_batch(self, batch_id: str) -> Optional[Dict]:
+        return _read_json(self._batch_path(batch_id))
+
+    def list_batches(self, limit: Optional[int] = 20) -> List[Dict]:
+        batches = [
+            _read_json(os.path.join(self.batches_dir, name))
+            for name in os.listdir(self.batches_dir) if name.endswith(".json")
+        ]
+        batches = [b for b in batches if b is not None]
+        batches.sort(key=lambda b: b["created_at"], reverse=True)
+        return batches[:limit]
+
+    async def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[Dict]) -> Dict:
+        """校验输入文件后创建任务并排队，输入不合法时抛出 ValueError"""
+        if endpoint not in BATCH_ENDPOINTS:
+            raise ValueError(f"不支持的接口: {endpoint}，可选: {', '.join(BATCH_ENDPOINTS)}")
+        if self.get_file(input_file_id) is None:
+            raise ValueError(f"输入文件不存在: {input_file_id}")
+
+        # 输入文件可能有几十万行，在线程池中计数
+        total = await asyncio.get_running_loop().run_in_executor(None, count_requests, self.file_path(input_file_id))
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        output_file_id = f"file-{uuid.uuid4().hex[:24]}"
+        error_file_id = f"file-{uuid.uuid4().hex[:24]}"
+        for file_id, suffix in ((output_file_id, "output"), (error_file_id, "errors")):
+            open(self.file_path(file_id), "w").close()
+            self._save_file_meta(file_id, f"{batch_id}_{suffix}.jsonl", "batch_output")
+
+        now = int(time.time())
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": output_file_id,
+            "error_file_id": error_file_id,
+            "created_at": now,
+            "in_progress_at": None,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        _write_json(self._batch_path(batch_id), batch)
+        self._pending.put_nowait(batch_id)
+        return batch
+
+    def cancel_batch(self, batch_id: str) -> Optional[Dict]:
+        batch = self.get_batch(batch_id)
+        if batch is None or batch["status"] in FINAL_STATUSES or batch["status"] == "cancelling":
+            return batch
+        batch.update(status="cancelling", cancelling_at=int(time.time()))
+        _write_json(self._batch_path(batch_id), batch)
+        self._cancel_events.setdefault(batch_id, asyncio.Event()).set()
+        return batch
+
+    # ---------- 调度 ----------
+
+    def start(self) -> None:
+        """需在事件循环内调用；未完成的任务按创建顺序重新排队"""
+        self._pending = asyncio.Queue()
+        for batch in sorted(self.list_batches(limit=None), key=lambda b: b["created_at"]):
+            if batch["status"] in ("validating", "in_progress", "cancelling"):
+                logger.info(f"恢复批处理任务 {batch['id']}（{batch['status']}）")
+                if batch["status"] == "cancelling":
+                    self._cancel_events.setdefault(batch["id"], asyncio.Event()).set()
+                self._pending.put_nowait(batch["id"])
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            batch_id = await self._pending.get()
+            try:
+                await self._run_batch(batch_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"批处理任务 {batch_id} 失败: {str(e)}")
+                try:
+                    self._update(batch_id, status="failed", failed_at=int(time.time()),
+                                 errors={"object": "list", "data": [{"code": "internal_error", "message": str(e)}]})
+                except Exception as update_error:
+                    # 任务文件丢失或损坏：记录后继续处理后面的任务，不让调度循环退出
+                    logger.error(f"批处理任务 {batch_id} 状态更新失败: {str(update_error)}")
+
+    async def _run_batch(self, batch_id: str) -> None:
+        batch = self.get_batch(batch_id)
+        cancel_event = self._cancel_events.setdefault(batch_id, asyncio.Event())
+        if batch["status"] != "cancelling":
+            batch = self._update(batch_id, status="in_progress", in_progress_at=batch["in_progress_at"] or int(time.time()))
+        logger.info(f"开始批处理任务 {batch_id}，共 {batch['request_counts']['total']} 条请求")
+
+        last_saved = [time.time()]
+
+        def on_progress(completed: int, failed: int) -> None:
+            # 进度每秒最多落盘一次
+            if time.time() - last_saved[0] >= 1.0:
+                last_saved[0] = time.time()
+                self._update(batch_id, request_counts=dict(batch["request_counts"], completed=completed, failed=failed))
+
+        counts = await run_batch(
+            input_path=self.file_path(batch["input_file_id"]),
+            output_path=self.file_path(batch["output_file_id"]),
+            error_path=self.file_path(batch["error_file_id"]),
+            generate=self.generate,
+            prepare=self.prepare,
+            build_response=self.build_response,
+            max_concurrency=self.max_concurrency,
+            chunk_size=self.chunk_size,
+            on_progress=on_progress,
+            cancel_event=cancel_event,
+        )
+        now = int(time.time())
+        if cancel_event.is_set():
+            self._update(batch_id, status="cancelled", cancelled_at=now, request_counts=counts)
+            logger.info(f"批处理任务 {batch_id} 已取消")
+        else:
+            self._update(batch_id, status="completed", finalizing_at=now, completed_at=now, request_counts=counts)
+            logger.info(f"批处理任务 {batch_id} 完成: 成功 {counts['completed']}，失败 {counts['failed']}")
+        for file_id in (batch["output_file_id"], batch["error_file_id"]):
+            meta = self.get_file(file_id)
+            self._save_file_meta(file_id, meta["filename"], meta["purpose"])
+        self._cancel_events.pop(batch_id, None)
+
+    def _update(self, batch_id: str, **fields) -> Dict:
+        batch = self.get_batch(batch_id)
+        # 取消请求可能在运行过程中到达，不要覆盖
+        if batch["status"] == "cancelling" and fields.get("status") == "in_progress":
+            fields.pop("status")
+        batch.update(fields)
+        _write_json(self._batch_path(batch_id), batch)
+        return batch
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_json(path: str, data: Dict) -> None:
+    # 先写临时文件再替换，中途崩溃不会留下半个文件
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批处理推理（JSONL）")
+    parser.add_argument("input", help="输入 JSONL，每行一个聊天请求或 OpenAI 批处理请求行")
+    parser.add_argument("output", help="结果 JSONL（追加写入，重新运行时跳过已完成的请求）")
+    parser.add_argument("--errors", default="", help="失败请求 JSONL，默认为 <output>.errors.jsonl")
+    parser.add_argument(
+        "--max-concurrency", type=int, default=config.BATCH_CONFIG["max_concurrency"],
+        help="同时提交给引擎的请求数，0 表示等于引擎 batch 大小",
+    )
+    parser.add_argument("--chunk-size", type=int, default=config.BATCH_CONFIG["chunk_size"], help="每次读入并排序的请求数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # 延迟导入：复用服务的请求模型与 chat 模板，但不启动服务
+    import llm_service_cpu
+    import model_loader
+    from fake_engine import FakeEngine
+
+    async def run() -> Dict[str, int]:
+        if config.CPU_ENGINE_BACKEND == "fake":
+            engine = FakeEngine(**config.CPU_ENGINE_CONFIG, **config.FAKE_ENGINE_CONFIG)
+        else:
+            model = model_loader.load_model()
+            engine = model_loader.build_engine(
+                model, model_loader.load_tokenizer(), model_loader.load_draft_model()
+            )
+        engine.start()
+        start = time.perf_counter()
+
+        def on_progress(completed: int, failed: int) -> None:
+            if (completed + failed) % 100 == 0:
+                logger.info(f"进度: 成功 {completed}，失败 {failed}，耗时 {time.perf_counter() - start:.1f}s")
+
+        try:
+            return await run_batch(
+                input_path=args.input,
+                output_path=args.output,
+                error_path=args.errors or f"{args.output}.errors.jsonl",
+                generate=lambda prompt_token_ids, params, model_name: engine.generate(prompt_token_ids, params),
+                prepare=functools.partial(llm_service_cpu.prepare_batch_request, engine.tokenizer),
+                build_response=llm_service_cpu.chat_completion_response,
+                max_concurrency=args.max_concurrency or config.CPU_ENGINE_CONFIG["max_batch_size"],
+                chunk_size=args.chunk_size,
+                on_progress=on_progress,
+            )
+        finally:
+            engine.stop()
+
+    start = time.perf_counter()
+    counts = asyncio.run(run())
+    logger.info(
+        f"完成: 共 {counts['total']} 条，成功 {counts['completed']}，失败 {counts['failed']}，"
+        f"耗时 {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+"""
+压测工具 - 回放请求 trace 或生成合成负载，统计吞吐、首 token 延迟（TTFT）、token 间隔（ITL）与端到端延迟分位数
+
+trace 为 JSONL，每行一个 /v1/chat/completions 请求体，可带 "timestamp" 字段（相对开始的秒数，配合 --replay-timestamps）:
+    {"messages": [{"role": "user", "content": "..."}], "max_tokens": 128, "timestamp": 0.5}
+
+用法:
+    python benchmark.py --trace trace.jsonl --concurrency 16 --rate 4
+    python benchmark.py --num-requests 200 --prompt-len 512 --output-len 128 --concurrency 32
+
+不加载权重、只压测服务层自身开销（排队、调度、SSE、JSON）:
+    CPU_ENGINE_BACKEND=fake python llm_service_cpu.py
+    python benchmark.py --num-requests 1000 --concurrency 64
+
+单独测量 SSE 编码层的单核吞吐（进程内，不需要启动服务）:
+    python benchmark.py --sse-bench --output-len 256 --sse-coalesce-bytes 64
+
+对比 CPU 引擎动态 KV / 静态 KV / 静态 KV + 编译 decode 的逐 token 延迟（进程内加载 MODEL_PATH 的模型）:
+    python benchmark.py --decode-bench --concurrency 4 --prompt-len 512 --output-len 128
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+
+SYNTHETIC_WORDS = [
+    "model", "inference", "latency", "token", "batch", "cache", "server", "request", "stream", "queue",
+    "人工智能", "推理", "服务", "延迟", "吞吐", "缓存", "请求", "模型", "数据", "优化",
+]
+
+
+@dataclass
+class RequestResult:
+    ok: bool = False
+    status: int = 0
+    error: str = ""
+    ttft: Optional[float] = None
+    e2e: float = 0.0
+    itls: List[float] = field(default_factory=list)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    chunks: int = 0
+    bytes_received: int = 0
+
+
+def load_trace(path: str, limit: int = 0) -> List[Dict]:
+    payloads = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                payloads.append(json.loads(line))
+            if limit and len(payloads) >= limit:
+                break
+    return payloads
+
+
+def sample_length(rng: random.Random, mean: int, sigma: float) -> int:
+    """按对数正态分布采样长度（sigma=0 时固定为 mean），更接近真实负载的长尾"""
+    if sigma <= 0:
+        return mean
+    return max(1, int(rng.lognormvariate(0, sigma) * mean / math.exp(sigma ** 2 / 2)))
+
+
+def synthetic_trace(num_requests: int, prompt_len: int, output_len: int, sigma: float, seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(num_requests):
+        words = [rng.choice(SYNTHETIC_WORDS) for _ in range(sample_length(rng, prompt_len, sigma))]
+        payloads.append({
+            "messages": [{"role": "user", "content": " ".join(words)}],
+            "max_tokens": sample_length(rng, output_len, sigma),
+            "temperature": 0.7,
+        })
+    return payloads
+
+
+async def send_request(client: httpx.AsyncClient, url: str, payload: Dict, stream: bool) -> RequestResult:
+    result = RequestResult()
+    payload = {key: value for key, value in payload.items() if key != "timestamp"}
+    payload["stream"] = stream
+    start = time.perf_counter()
+    last_token_time = None
+    try:
+        if not stream:
+            response = await client.post(url, json=payload)
+            result.status = response.status_code
+            result.bytes_received = len(response.content)
+            if response.status_code == 200:
+                usage = response.json().get("usage", {})
+                result.prompt_tokens = usage.get("prompt_tokens", 0)
+                result.completion_tokens = usage.get("completion_tokens", 0)
+                result.ttft = time.perf_counter() - start
+                result.ok = True
+            else:
+                result.error = response.text[:200]
+            return result
+
+        async with client.stream("POST", url, json=payload) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                result.error = (await response.aread()).decode("utf-8", errors="replace")[:200]
+                return result
+            async for line in response.aiter_lines():
+                result.bytes_received += len(line) + 1
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    result.ok = True
+                    break
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    result.error = f"stream_error: {chunk['error']}"
+                    break
+                result.chunks += 1
+                if chunk.get("usage"):
+                    result.prompt_tokens = chunk["usage"].get("prompt_tokens", 0)
+                    result.completion_tokens = chunk["usage"].get("completion_tokens", 0)
+                choices = chunk.get("choices") or [{}]
+                if choices[0].get("delta", {}).get("content"):
+                    now = time.perf_counter()
+                    if result.ttft is None:
+                        result.ttft = now - start
+                    else:
+                        result.itls.append(now - last_token_time)
+                    last_token_time = now
+    except httpx.HTTPError as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.e2e = time.perf_counter() - start
+    return result
+
+
+def percentile(values: List[float], p: float) -> float:
+    """线性插值的分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def latency_summary(values: List[float]) -> Dict:
+    """秒 -> 毫秒的均值与分位数"""
+    if not values:
+        return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+    return {
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+    }
+
+
+async def run_benchmark(
+    url: str,
+    payloads: List[Dict],
+    concurrency: int,
+    rate: float,
+    stream: bool,
+    replay_timestamps: bool,
+    timeout: float,
+    seed: int,
+) -> Dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    rng = random.Random(seed)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        async def limited(payload: Dict) -> RequestResult:
+            async with semaphore:
+                return await send_request(client, url, payload, stream)
+
+        tasks = []
+        start = time.perf_counter()
+        next_arrival = 0.0
+        for payload in payloads:
+            # 到达时间：按 trace 时间戳回放，或按给定速率的泊松过程，或全部立即发出（只受并发限制）
+            if replay_timestamps and "timestamp" in payload:
+                next_arrival = float(payload["timestamp"])
+            elif rate > 0:
+                next_arrival += rng.expovariate(rate)
+            delay = next_arrival - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(limited(payload)))
+        results = await asyncio.gather(*tasks)
+        duration = time.perf_counter() - start
+
+    succeeded = [r for r in results if r.ok]
+    failures: Dict[str, int] = {}
+    for r in results:
+        if not r.ok:
+            key = str(r.status) if r.status and r.status != 200 else (r.error.split(":")[0] or "unknown")
+            failures[key] = failures.get(key, 0) + 1
+    prompt_tokens = sum(r.prompt_tokens for r in succeeded)
+    completion_tokens = sum(r.completion_tokens for r in succeeded)
+    chunks = sum(r.chunks for r in succeeded)
+    return {
+        "requests": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "failures": failures,
+        "duration_s": round(duration, 2),
+        "request_throughput": round(len(succeeded) / duration, 2),
+        "output_token_throughput": round(completion_tokens / duration, 2),
+        "total_token_throughput": round((prompt_tokens + completion_tokens) / duration, 2),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "stream_chunks": chunks,
+        "tokens_per_chunk": round(completion_tokens / chunks, 2) if chunks else 0.0,
+        "received_mb": round(sum(r.bytes_received for r in results) / 1024 / 1024, 2),
+        "ttft_ms": latency_summary([r.ttft for r in succeeded if r.ttft is not None]),
+        "itl_ms": latency_summary([itl for r in succeeded for itl in r.itls]),
+        "e2e_ms": latency_summary([r.e2e for r in succeeded]),
+    }
+
+
+def print_report(summary: Dict) -> None:
+    print("=" * 60)
+    print(f"请求数: {summary['requests']}  成功: {summary['succeeded']}  失败: {summary['failed']} {summary['failures'] or ''}")
+    print(f"总耗时: {summary['duration_s']} s")
+    print(f"吞吐: {summary['request_throughput']} req/s, "
+          f"{summary['output_token_throughput']} 生成 tokens/s, {summary['total_token_throughput']} 总 tokens/s")
+    if summary["stream_chunks"]:
+        print(f"SSE: {summary['stream_chunks']} chunks, {summary['tokens_per_chunk']} tokens/chunk, "
+              f"接收 {summary['received_mb']} MB")
+    print("-" * 60)
+    print(f"{'(ms)':<8}{'mean':>12}{'p50':>12}{'p95':>12}{'p99':>12}")
+    for name, key in (("TTFT", "ttft_ms"), ("ITL", "itl_ms"), ("E2E", "e2e_ms")):
+        s = summary[key]
+        print(f"{name:<8}{s['mean']:>12}{s['p50']:>12}{s['p95']:>12}{s['p99']:>12}")
+    print("=" * 60)
+
+
+def sse_benchmark(num_tokens: int, streams: int, coalesce_bytes: int, seed: int) -> Dict:
+    """
+    SSE 编码层的单核吞吐：用 process_time 计时，只统计编码本身的 CPU 时间
+    对比逐 token 构造完整 chunk 的 sse.chat_chunk、预编码外层字段的 ChatStreamEncoder，以及按字节窗口合并后的结果
+    """
+    import sse
+
+    rng = random.Random(seed)
+    deltas = [rng.choice(SYNTHETIC_WORDS) + " " for _ in range(num_tokens)]
+    usage = sse.usage_dict(16, num_tokens)
+
+    def legacy() -> int:
+        written = 0
+        for _ in range(streams):
+            for delta in deltas:
+                written += len(sse.chat_chunk("chatcmpl-bench", 0, "bench", content=delta).encode("utf-8"))
+            written += len(sse.chat_chunk("chatcmpl-bench", 0, "bench", finish_reason="stop", usage=usage).encode("utf-8"))
+            written += len(sse.DONE_EVENT.encode("utf-8"))
+        return written
+
+    def encoder(window: int):
+        def run() -> int:
+            written = 0
+            for _ in range(streams):
+                enc = sse.ChatStreamEncoder("chatcmpl-bench", 0, "bench", coalesce_bytes=window)
+                for delta in deltas:
+                    enc.add_content(delta)
+                    written += len(enc.poll())
+                enc.add_finish("stop", usage)
+                written += len(enc.finish_stream())
+            return written
+        return run
+
+    cases = [("chat_chunk", legacy), ("encoder", encoder(0))]
+    if coalesce_bytes > 0:
+        cases.append((f"encoder+coalesce({coalesce_bytes}B)", encoder(coalesce_bytes)))
+    results = {}
+    for name, fn in cases:
+        start = time.process_time()
+        written = fn()
+        elapsed = max(time.process_time() - start, 1e-9)
+        results[name] = {
+            "tokens_per_core_s": round(streams * num_tokens / elapsed, 1),
+            "mb_per_core_s": round(written / elapsed / 1024 / 1024, 2),
+            "bytes_per_token": round(written / (streams * num_tokens), 1),
+        }
+    return results
+
+
+DECODE_MODES = {
+    "dynamic": {},
+    "static": {"static_kv_cache": True},
+    "static+compile": {"static_kv_cache": True, "compile_decode": True},
+}
+
+
+def decode_benchmark(model, tokenizer, batch_size: int, prompt_len: int, output_len: int, modes: List[str], seed: int) -> Dict:
+    """
+    CPU 引擎的逐 token decode 延迟：同一模型依次按各模式构建引擎，batch_size 个请求一起 prefill 后一起 decode
+    output_len 步（greedy，遇到 EOS 提前结束）；prompt 长度在 prompt_len / 2 到 prompt_len 个 token 之间均匀分布，
+    与真实 batch 一样带左 padding
+    - step_ms：引擎统计的 decode 前向耗时 / 步
+    - itl_ms：每个序列相邻两次输出的间隔（含采样、增量解码等引擎开销）
+    - 引擎启动时的预热（编译）不计入，单独记为 warmup_s
+    """
+    import config
+    from batch_engine import ContinuousBatchingEngine
+    from sampling import SamplingParams
+
+    rng = random.Random(seed)
+    text = " ".join(rng.choice(SYNTHETIC_WORDS) for _ in range(prompt_len * 2))
+    prompts = [
+        tokenizer(f"{i} {text}")["input_ids"][:prompt_len - i * prompt_len // (2 * batch_size)]
+        for i in range(batch_size)
+    ]
+    params = SamplingParams(max_tokens=output_len, temperature=0.0)
+    engine_config = config.CPU_ENGINE_CONFIG
+
+    async def run(engine) -> Dict:
+        async def one(prompt_token_ids: List[int]) -> List[float]:
+            times = []
+            async for output in engine.generate(prompt_token_ids, params):
+                times.append(time.perf_counter())
+            return [b - a for a, b in zip(times, times[1:])]
+
+        # 预热请求等引擎线程完成编译预热后才返回
+        start = time.perf_counter()
+        async for _ in engine.generate(prompts[0][:8], SamplingParams(max_tokens=2, temperature=0.0)):
+            pass
+        warmup = time.perf_counter() - start
+        steps_before, seconds_before = engine.decode_steps, engine.decode_seconds
+        start = time.perf_counter()
+        itls = [itl for seq_itls in await asyncio.gather(*(one(p) for p in prompts)) for itl in seq_itls]
+        duration = time.perf_counter() - start
+        steps = engine.decode_steps - steps_before
+        return {
+            "step_ms": round((engine.decode_seconds - seconds_before) / max(steps, 1) * 1000, 3),
+            "itl_ms": latency_summary(itls),
+            "decode_steps": steps,
+            "output_tokens_per_s": round((len(itls) + len(prompts)) / duration, 2),
+            "warmup_s": round(warmup, 2),
+        }
+
+    results = {}
+    for mode in modes:
+        engine = ContinuousBatchingEngine(
+            model,
+            tokenizer,
+            max_batch_size=batch_size,
+            max_model_len=engine_config["max_model_len"],
+            batch_wait_ms=100,  # 让同时提交的请求一起 prefill
+            static_kv_min_len=engine_config["static_kv_min_len"],
+            compile_warmup_len=max(engine_config["compile_warmup_len"], prompt_len + output_len),
+            **DECODE_MODES[mode],
+        )
+        engine.start()
+        try:
+            results[mode] = asyncio.run(run(engine))
+        finally:
+            engine.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM 服务压测")
+    parser.add_argument("--url", default="http://localhost:8000/v1/chat/completions", help="聊天接口地址")
+    parser.add_argument("--trace", default="", help="JSONL 请求 trace，不指定时生成合成负载")
+    parser.add_argument("--num-requests", type=int, default=100, help="请求数（trace 模式下为上限，0 表示全部）")
+    parser.add_argument("--prompt-len", type=int, default=256, help="合成负载的平均 prompt 词数")
+    parser.add_argument("--output-len", type=int, default=128, help="合成负载的平均 max_tokens")
+    parser.add_argument("--length-sigma", type=float, default=0.5, help="长度对数正态分布的 sigma，0 表示固定长度")
+    parser.add_argument("--concurrency", type=int, default=16, help="最大并发请求数")
+    parser.add_argument("--rate", type=float, default=0, help="平均到达速率（req/s，泊松过程），0 表示不限")
+    parser.add_argument("--replay-timestamps", action="store_true", help="按 trace 中的 timestamp 回放")
+    parser.add_argument("--no-stream", action="store_true", help="使用非流式接口")
+    parser.add_argument("--timeout", type=float, default=600, help="单请求超时（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="合成负载与到达间隔的随机种子")
+    parser.add_argument("--output", default="", help="结果另存为 JSON 文件")
+    parser.add_argument("--sse-bench", action="store_true", help="只在进程内测量 SSE 编码层的单核吞吐（--num-requests 个流，每个 --output-len 个 token）")
+    parser.add_argument("--sse-coalesce-bytes", type=int, default=64, help="--sse-bench 中合并窗口的字节数，0 表示不测合并")
+    parser.add_argument("--decode-bench", action="store_true", help="只在进程内测量 CPU 引擎的逐 token decode 延迟（batch 为 --concurrency，长度为 --prompt-len / --output-len 个 token）")
+    parser.add_argument("--decode-modes", default=",".join(DECODE_MODES), help=f"--decode-bench 对比的模式，逗号分隔，可选 {'/'.join(DECODE_MODES)}")
+    args = parser.parse_args()
+
+    if args.decode_bench:
+        import model_loader
+
+        modes = [mode.strip() for mode in args.decode_modes.split(",") if mode.strip()]
+        unknown = [mode for mode in modes if mode not in DECODE_MODES]
+        if unknown:
+            parser.error(f"未知的 decode 模式: {unknown}")
+        summary = decode_benchmark(
+            model_loader.load_model(), model_loader.load_tokenizer(),
+            args.concurrency, args.prompt_len, args.output_len, modes, args.seed,
+        )
+        print(f"{'decode 模式':<20}{'step ms':>10}{'ITL mean':>10}{'ITL p50':>10}{'ITL p99':>10}{'tokens/s':>10}{'warmup s':>10}")
+        for name, row in summary.items():
+            itl = row["itl_ms"]
+            print(f"{name:<20}{row['step_ms']:>10}{itl['mean']:>10}{itl['p50']:>10}{itl['p99']:>10}"
+                  f"{row['output_tokens_per_s']:>10}{row['warmup_s']:>10}")
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump({"decode": summary, "config": vars(args)}, f, ensure_ascii=False, indent=2)
+        return
+
+    if args.sse_bench:
+        summary = sse_benchmark(args.output_len, args.num_requests, args.sse_coalesce_bytes, args.seed)
+        print(f"{'SSE 编码':<32}{'tokens/s/core':>16}{'MB/s/core':>12}{'bytes/token':>14}")
+        for name, row in summary.items():
+            print(f"{name:<32}{row['tokens_per_core_s']:>16}{row['mb_per_core_s']:>12}{row['bytes_per_token']:>14}")
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump({"sse": summary, "config": vars(args)}, f, ensure_ascii=False, indent=2)
+        return
+
+    if args.trace:
+        payloads = load_trace(args.trace, args.num_requests)
+    else:
+        payloads = synthetic_trace(args.num_requests, args.prompt_len, args.output_len, args.length_sigma, args.seed)
+
+    summary = asyncio.run(run_benchmark(
+        url=args.url,
+        payloads=payloads,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        stream=not args.no_stream,
+        replay_timestamps=args.replay_timestamps,
+        timeout=args.timeout,
+        seed=args.seed,
+    ))
+    print_report(summary)
+
+    if args.output:
+        summary["config"] = vars(args)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,13 @@ MODEL_PATH = os.getenv(
 )
 MODEL_NAME = os.getenv("MODEL_NAME", "Qwen3-4B")
 
+# 多模型（CPU 服务）：按请求的 model 字段路由，MODEL_NAME / MODEL_PATH 为默认模型
+MODEL_REGISTRY_CONFIG = {
+    "models": os.getenv("MODELS", ""),  # 其他模型，格式 "名称=路径;名称=路径"
+    "memory_budget_mb": int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0")),  # 已加载模型的权重内存上限，0 表示不限制，超出时按 LRU 卸载空闲模型
+    "preload_default": os.getenv("MODEL_PRELOAD_DEFAULT", "true").lower() == "true",  # 启动时加载默认模型，否则首次请求时加载
+}
+
 # ============================================
 # 服务配置
 # ============================================
@@ -30,7 +37,97 @@ VLLM_CONFIG = {
     "tensor_parallel_size": int(os.getenv("TENSOR_PARALLEL_SIZE", "1")),  # GPU数量
     "gpu_memory_utilization": float(os.getenv("GPU_MEMORY_UTILIZATION", "0.9")),
     "max_model_len": int(os.getenv("MAX_MODEL_LEN", "4096")),
+    "max_num_seqs": int(os.getenv("MAX_NUM_SEQS", "256")),  # 引擎同时批处理的最大序列数
     "trust_remote_code": True,
+    "load_format": os.getenv("VLLM_LOAD_FORMAT", "auto"),  # 权重格式，预先转换为 sharded_state 等格式可加快冷启动
+}
+
+# CPU 推理配置 (用于无GPU环境，连续批处理引擎)
+CPU_ENGINE_CONFIG = {
+    "max_batch_size": int(os.getenv("CPU_MAX_BATCH_SIZE", "8")),  # 同时decode的最大序列数
+    "max_model_len": int(os.getenv("CPU_MAX_MODEL_LEN", os.getenv("MAX_MODEL_LEN", "4096"))),
+    "prefill_padding_ratio": float(os.getenv("CPU_PREFILL_PADDING_RATIO", "0.3")),  # 一次 prefill 中 padding token 的占比上限，超出时按长度分组分别前向；1 表示不分组
+    "batch_wait_ms": float(os.getenv("CPU_BATCH_WAIT_MS", "0")),  # 引擎空闲时收到请求后最多等待的时长，让同时到达的短请求一起 prefill；0 表示不等待
+    "static_kv_cache": os.getenv("CPU_STATIC_KV_CACHE", "false").lower() == "true",  # decode 使用按 batch / 长度分桶预分配的 KV 缓冲区，新 token 原地写入
+    "compile_decode": os.getenv("CPU_COMPILE_DECODE", "false").lower() == "true",  # 用 torch.compile 编译 decode 步（需开启静态 KV 缓存），引擎启动时按分桶预热
+    "static_kv_min_len": int(os.getenv("CPU_STATIC_KV_MIN_LEN", "256")),  # 最小的长度分桶，之后按 2 倍增长到 max_model_len
+    "compile_warmup_len": int(os.getenv("CPU_COMPILE_WARMUP_LEN", "1024")),  # 启动时预编译的最大长度分桶，更长的分桶首次用到时编译
+}
+
+# 投机解码配置 (CPU，小草稿模型一次提议多个 token，主模型一次前向验证)
+# 草稿模型需与主模型使用同一分词器，如主模型 Qwen2.5-14B-Instruct 搭配 Qwen2.5-0.5B-Instruct
+SPECULATIVE_CONFIG = {
+    "draft_model_path": os.getenv("DRAFT_MODEL_PATH", ""),  # 为空则不启用
+    "num_speculative_tokens": int(os.getenv("NUM_SPECULATIVE_TOKENS", "4")),  # 每步提议的 token 数
+}
+
+# CPU 推理后端: transformers（真实模型）/ fake（无权重的确定性假引擎，用于压测服务层开销）
+CPU_ENGINE_BACKEND = os.getenv("CPU_ENGINE_BACKEND", "transformers")
+
+# 假引擎的耗时模型
+FAKE_ENGINE_CONFIG = {
+    "prefill_ms_per_token": float(os.getenv("FAKE_PREFILL_MS_PER_TOKEN", "0.05")),
+    "decode_ms_per_step": float(os.getenv("FAKE_DECODE_MS_PER_STEP", "10")),  # 每个 decode 步的固定耗时
+    "decode_ms_per_seq": float(os.getenv("FAKE_DECODE_MS_PER_SEQ", "0.5")),  # batch 中每多一条序列增加的耗时
+}
+
+# CPU 推理精度配置 (fp32 / fp16 / bf16 / int8 动态量化 / int4 仅权重量化)
+CPU_PRECISION_CONFIG = {
+    "mode": os.getenv("CPU_PRECISION", "bf16"),
+    "int4_group_size": int(os.getenv("CPU_INT4_GROUP_SIZE", "128")),  # int4 每组共享 scale 的权重数
+}
+
+# CPU 多进程 worker 池配置 (每个 worker 绑定一组核 / 一个 NUMA 节点，运行独立的批处理引擎)
+WORKER_POOL_CONFIG = {
+    "num_workers": int(os.getenv("CPU_NUM_WORKERS", "1")),  # 1 表示不启用，单进程内运行引擎
+    "cpu_sets": os.getenv("CPU_WORKER_CPU_SETS", ""),  # 显式绑核，如 "0-15;16-31"，分号分隔各 worker
+    "numa": os.getenv("CPU_WORKER_NUMA", "false").lower() == "true",  # 按 NUMA 节点绑核
+    "threads_per_worker": int(os.getenv("CPU_THREADS_PER_WORKER", "0")),  # 0 表示等于绑定的核数
+    "weight_sharing": os.getenv("CPU_WEIGHT_SHARING", "fork"),  # fork: 加载后 fork 共享内存页; mmap: 各 worker mmap 加载
+}
+
+# 冷启动配置 (权重缓存仅用于 CPU，预热两个服务共用)
+STARTUP_CONFIG = {
+    "weight_cache_dir": os.getenv("WEIGHT_CACHE_DIR", ""),  # 按目标精度转换后的权重缓存目录，为空则不启用；命中时以 mmap 零拷贝加载
+    "warmup": os.getenv("WARMUP_ENABLED", "true").lower() == "true",  # 加载后先跑预热请求，完成后 /health/ready 才返回 200
+    "warmup_tokens": int(os.getenv("WARMUP_TOKENS", "4")),  # 每个预热请求生成的 token 数
+}
+
+# 前缀 KV 缓存配置 (CPU，复用相同系统提示词等公共前缀的 prefill 结果)
+PREFIX_CACHE_CONFIG = {
+    "enabled": os.getenv("PREFIX_CACHE_ENABLED", "true").lower() == "true",
+    "max_memory_mb": int(os.getenv("PREFIX_CACHE_MAX_MB", "1024")),  # 缓存占用内存上限
+    "min_match_tokens": int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "16")),  # 命中长度低于此值不复用
+}
+
+# 会话 KV 缓存配置 (CPU，带 session_id 的多轮对话保留上一轮的 KV，下一轮只 prefill 新增的消息)
+SESSION_CACHE_CONFIG = {
+    "enabled": os.getenv("SESSION_CACHE_ENABLED", "true").lower() == "true",
+    "max_memory_mb": int(os.getenv("SESSION_CACHE_MAX_MB", "1024")),  # 每个引擎内存中会话 KV 的总上限，超出时按 LRU 转存到磁盘
+    "spill_dir": os.getenv("SESSION_CACHE_SPILL_DIR", ""),  # 转存目录（读回时 mmap），为空则超限的会话直接丢弃
+    "max_disk_mb": int(os.getenv("SESSION_CACHE_MAX_DISK_MB", "8192")),  # 每个引擎转存文件的总上限，0 表示不限制
+    "idle_seconds": int(os.getenv("SESSION_CACHE_IDLE_SECONDS", "60")),  # 空闲超过该时长的会话转存到磁盘
+    "ttl_seconds": int(os.getenv("SESSION_CACHE_TTL", "3600")),  # 超过该时长未访问的会话删除
+}
+
+# 流式输出配置 (两个服务共用)：合并窗口内的多个 token 合并为一个 SSE chunk，减少序列化与写入次数
+SSE_CONFIG = {
+    "coalesce_ms": int(os.getenv("SSE_COALESCE_MS", "0")),  # 时间窗口（毫秒），0 表示不按时间合并
+    "coalesce_bytes": int(os.getenv("SSE_COALESCE_BYTES", "0")),  # 字节窗口，0 表示不按字节合并；两者都为 0 时每个增量单独发送
+    "disconnect_check_ms": int(os.getenv("SSE_DISCONNECT_CHECK_MS", "200")),  # 检查客户端是否断开的间隔（毫秒），不在每个 token 上检查
+}
+
+# Prompt 构建配置 (按特殊 token 分段缓存 token id，重复的系统提示词 / 历史消息不重复分词)
+PROMPT_CACHE_CONFIG = {
+    "max_cached_chars": int(os.getenv("PROMPT_CACHE_MAX_CHARS", str(4 * 1024 * 1024))),  # 缓存的段文本总字符数上限，0 表示不缓存
+}
+
+# 确定性响应缓存配置 (temperature=0 或指定 seed 的请求)
+RESPONSE_CACHE_CONFIG = {
+    "enabled": os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true",
+    "max_memory_mb": int(os.getenv("RESPONSE_CACHE_MAX_MB", "256")),  # 内存层上限
+    "ttl_seconds": int(os.getenv("RESPONSE_CACHE_TTL", "3600")),  # 缓存有效期
+    "disk_path": os.getenv("RESPONSE_CACHE_DISK_PATH", ""),  # SQLite 文件路径，为空则不启用磁盘层
 }
 
 # 生成参数默认值
@@ -40,3 +137,52 @@ VLLM_CONFIG = {
 #     "top_p": 0.9,
 #     "top_k": 50,
 # }
+
+# ============================================
+# 请求排队配置
+# ============================================
+# 超出并发上限的请求在有界队列中等待，队列满时立即返回 503 + Retry-After
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "32"))
+# /generate 与 /v1/completions 单个请求最多包含的 prompt 数（每个 prompt 作为独立的引擎请求排队）
+MAX_PROMPTS_PER_REQUEST = int(os.getenv("MAX_PROMPTS_PER_REQUEST", "256"))
+
+# 请求截止时间（请求体 timeout 或 X-Request-Timeout 头，单位秒）：按实测吞吐预计无法按时完成的请求直接返回 503，
+# 生成中到期的请求返回已生成的部分（finish_reason 为 length）
+DEADLINE_CONFIG = {
+    "default_timeout": float(os.getenv("REQUEST_DEFAULT_TIMEOUT", "0")),  # 未指定截止时间的请求的默认超时（秒），0 表示不限制
+}
+
+# 多租户公平调度与限流（租户为请求的 user 字段，未提供时为 API key）
+TENANT_CONFIG = {
+    # 单独配置的租户，格式 "名称=key:sk-xxx,weight:4,priority:interactive,rpm:60,tpm:100000;名称=priority:batch"（配置 key 时只按 API key 识别）
+    "tenants": os.getenv("TENANTS", ""),
+    "default_weight": float(os.getenv("TENANT_DEFAULT_WEIGHT", "1")),  # 公平排队的权重，越大分到的份额越多
+    "default_priority": os.getenv("TENANT_DEFAULT_PRIORITY", "interactive"),  # interactive / batch
+    "requests_per_minute": int(os.getenv("TENANT_RPM", "0")),  # 每个租户每分钟的请求数，0 表示不限制
+    "tokens_per_minute": int(os.getenv("TENANT_TPM", "0")),  # 每个租户每分钟的 prompt + 生成 token 数，0 表示不限制
+    "batch_max_share": float(os.getenv("BATCH_PRIORITY_MAX_SHARE", "0.75")),  # batch 优先级最多占用的并发比例，其余留给交互式请求
+}
+
+# ============================================
+# 离线批处理配置（/v1/batches 与 batch_inference.py）
+# ============================================
+BATCH_CONFIG = {
+    "data_dir": os.getenv("BATCH_DATA_DIR", "./batch_data"),  # 上传文件、任务状态与结果文件的存放目录
+    "max_concurrency": int(os.getenv("BATCH_MAX_CONCURRENCY", "0")),  # 同时提交给引擎的请求数，0 表示等于引擎 batch 大小
+    "chunk_size": int(os.getenv("BATCH_CHUNK_SIZE", "1024")),  # 每次读入并按长度排序的请求数
+}
+
+# ============================================
+# 请求路由配置（router.py，部署在多个服务副本前）
+# ============================================
+ROUTER_CONFIG = {
+    "backends": [url.strip() for url in os.getenv("ROUTER_BACKENDS", "").split(",") if url.strip()],  # 副本地址，逗号分隔，如 "http://10.0.0.1:8000,http://10.0.0.2:8000"
+    "port": int(os.getenv("ROUTER_PORT", "9000")),
+    "health_interval": float(os.getenv("ROUTER_HEALTH_INTERVAL", "5")),  # 健康检查间隔（秒），同时刷新各副本上报的负载
+    "load_factor": float(os.getenv("ROUTER_LOAD_FACTOR", "1.25")),  # 亲和副本的负载超过平均负载的该倍数时溢出到下一个副本
+    "load_slack": int(os.getenv("ROUTER_LOAD_SLACK", "4")),  # 在上述上限之外，亲和副本还可多承担的请求数（副本能并行 batch，少量超出不值得放弃缓存）
+    "prefix_chars": int(os.getenv("ROUTER_PREFIX_CHARS", "512")),  # 参与前缀哈希的 prompt 字符数
+    "max_attempts": int(os.getenv("ROUTER_MAX_ATTEMPTS", "3")),  # 单个请求最多尝试的副本数
+    "max_connections": int(os.getenv("ROUTER_MAX_CONNECTIONS", "512")),  # 与副本之间的长连接池大小
+    "timeout": float(os.getenv("ROUTER_TIMEOUT", "600")),  # 转发请求的超时（秒）
+}
@@ -0,0 +1,44 @@
+"""
+增量解码（detokenize）- 流式输出时每步只解码新 token 附近的一小段，而不是每步重新解码全部输出（O(n²)）
+- 维护两个偏移：prefix_offset 之前的 token 已输出且不再参与解码；[prefix_offset, read_offset) 作为上下文
+  与新 token 一起解码，保证 SentencePiece 的前导空格、多 token 拼成的字符与完整解码一致
+- 新增文本以 U+FFFD 结尾时说明多字节 UTF-8 字符（如中文的 byte-fallback token）尚不完整，
+  先不输出，等后续 token 补全后整字输出，流式 chunk 中不会出现半个汉字
+- CPU 引擎与 vLLM 服务的流式输出共用
+"""
+from typing import List, Sequence
+
+
+class IncrementalDetokenizer:
+    """单个生成序列的增量解码器（每个序列 / 候选一个实例）"""
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+        self._prefix_text = ""  # [prefix_offset, read_offset) 的解码结果
+
+    def _decode(self, start: int, end: int) -> str:
+        return self.tokenizer.decode(self.token_ids[start:end], skip_special_tokens=self.skip_special_tokens)
+
+    def step(self, token_ids: Sequence[int]) -> str:
+        """加入新生成的 token，返回新确认的文本（可能为空）"""
+        self.token_ids.extend(token_ids)
+        new_text = self._decode(self._prefix_offset, len(self.token_ids))
+        if len(new_text) <= len(self._prefix_text) or new_text.endswith("\ufffd"):
+            # 没有新文本（如被跳过的特殊 token），或末尾的多字节字符还不完整
+            return ""
+        delta = new_text[len(self._prefix_text):]
+        self._prefix_offset, self._read_offset = self._read_offset, len(self.token_ids)
+        self._prefix_text = self._decode(self._prefix_offset, self._read_offset)
+        return delta
+
+    def flush(self) -> str:
+        """序列结束时返回尚未确认的剩余文本（不完整的字符解码为 U+FFFD）"""
+        new_text = self._decode(self._prefix_offset, len(self.token_ids))
+        delta = new_text[len(self._prefix_text):]
+        self._prefix_offset = self._read_offset = len(self.token_ids)
+        self._prefix_text = ""
+        return delta
@@ -0,0 +1,266 @@
+"""
+无权重的确定性假引擎（CPU 服务），用于离线压测服务层自身的开销（排队、调度、SSE、JSON）
+- 对外接口与 ContinuousBatchingEngine 一致（start / stop / generate / abort / stats）
+- 按 token 步模拟连续批处理：每步所有运行中的序列各前进一个 token，步耗时随 batch 大小线性增长
+- 输出只由 prompt 与 seed 决定，同一请求每次结果相同；总是生成到 max_tokens（不处理 EOS 和停止词）
+- n / best_of > 1 的请求只计一次 prefill 耗时，各候选的假 logprob 同样是确定性的
+- prefill 耗时按与真实引擎相同的长度分组计入 padding
+"""
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+import zlib
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+from batch_engine import RequestOutput, length_buckets, select_best_of
+from sampling import SamplingParams
+
+logger = logging.getLogger(__name__)
+
+# 假词表：token id -> 文本片段
+FAKE_WORDS = [
+    "的", "是", "在", "模型", "推理", "服务", "数据", "可以", "我们", "一个",
+    " the", " model", " token", " batch", " cache", " latency", " and", " of", "，", "。",
+]
+
+
+class FakeTokenizer:
+    """
+    假分词器：prompt 每 4 个字符记为一个 token（接近真实分词器的压缩比）
+    生成侧的 token id 从 vocab_offset 开始，映射到假词表
+    """
+
+    eos_token_id = 0
+    pad_token_id = 0
+    chars_per_token = 4
+    vocab_offset = 32000
+
+    def __call__(self, text: str) -> Dict[str, List[int]]:
+        step = self.chars_per_token
+        return {
+            "input_ids": [
+                1 + zlib.crc32(text[i:i + step].encode("utf-8")) % (self.vocab_offset - 1)
+                for i in range(0, len(text), step)
+            ]
+        }
+
+    def encode(self, text: str) -> List[int]:
+        return self(text)["input_ids"]
+
+    def decode(self, token_ids: List[int], skip_special_tokens: bool = True) -> str:
+        """只还原生成侧的 token，prompt 侧 token 无法还原"""
+        return "".join(
+            FAKE_WORDS[(t - self.vocab_offset) % len(FAKE_WORDS)] for t in token_ids if t >= self.vocab_offset
+        )
+
+
+class _FakeSequence:
+    def __init__(
+        self,
+        request_id: str,
+        prompt_token_ids: List[int],
+        params: SamplingParams,
+        index: int,
+        queue: asyncio.Queue,
+    ):
+        self.request_id = request_id
+        self.prompt_token_ids = prompt_token_ids
+        self.params = params
+        self.index = index
+        self.completion_tokens = 0
+        self.cumulative_logprob = 0.0
+        self.finish_reason: Optional[str] = None
+        self.scheduled_time: Optional[float] = None
+        self.queue = queue
+        self.prefill_time: Optional[float] = None
+        digest = hashlib.sha256(f"{params.seed}:{index}:{prompt_token_ids}".encode("utf-8")).digest()
+        self.state = int.from_bytes(digest[:8], "little")
+
+    def next_token(self) -> int:
+        # 线性同余序列，保证确定性
+        self.state = (self.state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+        self.cumulative_logprob -= (self.state >> 40) % 1000 / 250
+        return FakeTokenizer.vocab_offset + (self.state >> 33) % len(FAKE_WORDS)
+
+
+class FakeEngine:
+    """按固定耗时模型模拟 prefill / decode 的连续批处理引擎"""
+
+    def __init__(
+        self,
+        max_batch_size: int = 8,
+        max_model_len: int = 4096,
+        prefill_ms_per_token: float = 0.05,
+        decode_ms_per_step: float = 10.0,
+        decode_ms_per_seq: float = 0.5,
+        prefill_padding_ratio: float = 0.3,
+        batch_wait_ms: float = 0.0,
+        static_kv_cache: bool = False,
+        compile_decode: bool = False,
+        static_kv_min_len: int = 256,
+        compile_warmup_len: int = 1024,
+    ):
+        # static_kv_cache / compile_decode 等只与真实模型的 KV 缓存有关，假引擎接受后忽略（与 CPU_ENGINE_CONFIG 保持同一组参数）
+        self.max_batch_size = max_batch_size
+        self.max_model_len = max_model_len
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.decode_ms_per_step = decode_ms_per_step
+        self.decode_ms_per_seq = decode_ms_per_seq
+        self.prefill_padding_ratio = prefill_padding_ratio
+        self.batch_wait_ms = batch_wait_ms
+        self.tokenizer = FakeTokenizer()
+
+        self._waiting: Deque[List[_FakeSequence]] = deque()  # 每项为同一请求的所有候选
+        self._running: List[_FakeSequence] = []
+        self._aborted: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.total_generated_tokens = 0
+        self.total_steps = 0
+        self.cancelled_total = 0
+
+    def start(self) -> None:
+        """需在事件循环内调用（服务 lifespan 中）"""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"假引擎已启动 (max_batch_size={self.max_batch_size}, decode={self.decode_ms_per_step}ms/步)")
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def generate(
+        self,
+        prompt_token_ids: List[int],
+        params: SamplingParams,
+        request_id: Optional[str] = None,
+        session_id: Optional[str] = None,  # 假引擎没有 KV，忽略
+    ) -> AsyncIterator[RequestOutput]:
+        if len(prompt_token_ids) == 0:
+            raise ValueError("prompt 不能为空")
+        if len(prompt_token_ids) >= self.max_model_len:
+            raise ValueError(
+                f"prompt 长度 {len(prompt_token_ids)} 超过模型最大长度 {self.max_model_len}"
+            )
+        params.validate()
+        if params.num_sequences > self.max_batch_size:
+            raise ValueError(f"候选数 {params.num_sequences} 超过引擎 batch 大小 {self.max_batch_size}")
+        request_id = request_id or uuid.uuid4().hex
+        queue: asyncio.Queue = asyncio.Queue()
+        self._waiting.append([
+            _FakeSequence(request_id, list(prompt_token_ids), params, index, queue)
+            for index in range(params.num_sequences)
+        ])
+        self._wakeup.set()
+        remaining = params.num_sequences
+        candidates: Dict[int, List[RequestOutput]] = {}
+        try:
+            while remaining:
+                output = await queue.get()
+                if output.finished:
+                    remaining -= 1
+                if params.num_sequences > params.n:
+                    candidates.setdefault(output.index, []).append(output)
+                else:
+                    yield output
+            for output in select_best_of(candidates, params.n) if candidates else []:
+                yield output
+        finally:
+            if remaining:
+                self.abort(request_id)
+
+    def abort(self, request_id: str) -> None:
+        self._aborted.add(request_id)
+
+    def stats(self) -> Dict:
+        return {
+            "running": len(self._running),
+            "waiting": len(self._waiting),
+            "max_batch_size": self.max_batch_size,
+            "total_generated_tokens": self.total_generated_tokens,
+            "total_steps": self.total_steps,
+            "cancelled_total": self.cancelled_total,
+            "backend": "fake",
+        }
+
+    async def _run(self) -> None:
+        while True:
+            self._process_aborts()
+            new_seqs = []
+            while self._waiting and len(self._running) + len(new_seqs) + len(self._waiting[0]) <= self.max_batch_size:
+                new_seqs.extend(self._waiting.popleft())
+            if new_seqs:
+                now = time.time()
+                for seq in new_seqs:
+                    seq.scheduled_time = now
+                    if seq.params.expired(now):
+                        seq.finish_reason = "length"
+                        self._emit(seq, [])
+                # 等待期间已到截止时间的请求不再 prefill
+                new_seqs = [seq for seq in new_seqs if seq.finish_reason is None]
+                prompt_lengths = [len(seq.prompt_token_ids) for seq in new_seqs if seq.index == 0]
+                padded_tokens = sum(
+                    len(bucket) * max(prompt_lengths[i] for i in bucket)
+                    for bucket in length_buckets(prompt_lengths, self.prefill_padding_ratio)
+                )
+                await asyncio.sleep(padded_tokens * self.prefill_ms_per_token / 1000)
+                self._running.extend(new_seqs)
+                self._advance(new_seqs)
+            elif self._running:
+                await asyncio.sleep((self.decode_ms_per_step + self.decode_ms_per_seq * len(self._running)) / 1000)
+                self.total_steps += 1
+                self._advance(self._running)
+            else:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                if self.batch_wait_ms > 0:
+                    # 空闲后的第一个请求：等待并发请求一起 prefill
+                    await asyncio.sleep(self.batch_wait_ms / 1000)
+
+    def _process_aborts(self) -> None:
+        if not self._aborted:
+            return
+        aborted, self._aborted = self._aborted, set()
+        cancelled = set()
+        for seq in [seq for group in self._waiting for seq in group] + self._running:
+            if seq.request_id in aborted:
+                seq.finish_reason = "abort"
+                cancelled.add(seq.request_id)
+                self._emit(seq, [])
+        self.cancelled_total += len(cancelled)
+        self._waiting = deque(group for group in self._waiting if group[0].finish_reason is None)
+        self._running = [seq for seq in self._running if seq.finish_reason is None]
+
+    def _advance(self, seqs: List[_FakeSequence]) -> None:
+        for seq in seqs:
+            token = seq.next_token()
+            if seq.prefill_time is None:
+                seq.prefill_time = time.time() - seq.scheduled_time
+            seq.completion_tokens += 1
+            self.total_generated_tokens += 1
+            total_len = len(seq.prompt_token_ids) + seq.completion_tokens
+            if (
+                seq.completion_tokens >= seq.params.max_tokens
+                or total_len >= self.max_model_len
+                or seq.params.expired(time.time())
+            ):
+                seq.finish_reason = "length"
+            self._emit(seq, [token])
+        self._running = [seq for seq in self._running if seq.finish_reason is None]
+
+    def _emit(self, seq: _FakeSequence, token_ids: List[int]) -> None:
+        seq.queue.put_nowait(RequestOutput(
+            request_id=seq.request_id,
+            text=self.tokenizer.decode(token_ids),
+            token_ids=token_ids,
+            prompt_tokens=len(seq.prompt_token_ids),
+            completion_tokens=seq.completion_tokens,
+            finish_reason=seq.finish_reason,
+            prefill_time=seq.prefill_time,
+            index=seq.index,
+            cumulative_logprob=seq.cumulative_logprob if seq.params.num_sequences > seq.params.n else None,
+        ))
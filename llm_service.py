@@ -2,15 +2,27 @@
 vLLM FastAPI Service for Qwen-32B
 用于GPU环境的生产部署
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 import asyncio
-from vllm import LLM, SamplingParams
+import time
+from contextlib import asynccontextmanager
+from vllm import SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
+from vllm.engine.async_llm_engine import AsyncLLMEngine
+from vllm.inputs import TokensPrompt
 from vllm.utils import random_uuid
 import config
 import logging
+import metrics
+import sse
+from admission import DEADLINE_HEADER, AdmissionController, Grant, OverloadedError, Tenant, request_deadline
+from detokenizer import IncrementalDetokenizer
+from prompt_builder import PromptBuilder, for_tokenizer
+from rate_limit import RateLimitError, build_rate_limiter
+from response_cache import ResponseCache, is_cacheable, make_key
 
 # 日志配置
 logging.basicConfig(
@@ -19,26 +31,72 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# FastAPI应用
-app = FastAPI(
-    title="Qwen LLM Service (vLLM)",
-    description="基于vLLM的Qwen大模型推理服务",
-    version="1.0.0"
+# 全局异步引擎实例：并发请求由 vLLM 自身做连续批处理
+llm_engine: Optional[AsyncLLMEngine] = None
+loaded_at = 0  # 模型加载完成的时间戳（/v1/models 的 created）
+# 启动各阶段耗时（秒），预热完成后 /health/ready 才返回 200
+startup_timings: Dict[str, float] = {}
+startup_phase = "loading"  # loading / ready / failed
+startup_error: Optional[str] = None
+WARMUP_PROMPT = "Hello! 请简单介绍一下你自己。"
+# 对话 / 文本 -> token id（按模型的 chat template 渲染，分段缓存），token id 直接提交给 vLLM，不再重复分词
+prompt_cache: Optional[PromptBuilder] = None
+
+# 准入队列：并发数与 vLLM 的 max_num_seqs 一致，其余请求排队，队列满时快速拒绝
+admission = AdmissionController(
+    max_concurrency=config.VLLM_CONFIG["max_num_seqs"],
+    max_queue_size=config.MAX_QUEUE_SIZE,
+    batch_max_share=config.TENANT_CONFIG["batch_max_share"],
 )
 
-# 全局模型实例
-llm_engine: Optional[LLM] = None
+# 多租户：按租户（user 字段 / API key）的令牌桶限流，准入队列按租户加权公平排队
+rate_limiter = build_rate_limiter(config.TENANT_CONFIG)
+
+# 因客户端断开而取消的请求数
+cancelled_requests = 0
+
+# 确定性响应缓存（可选）：temperature=0 或指定 seed 的相同请求直接返回缓存结果
+response_cache: Optional[ResponseCache] = None
+if config.RESPONSE_CACHE_CONFIG["enabled"]:
+    response_cache = ResponseCache(
+        max_bytes=config.RESPONSE_CACHE_CONFIG["max_memory_mb"] * 1024 * 1024,
+        ttl_seconds=config.RESPONSE_CACHE_CONFIG["ttl_seconds"],
+        disk_path=config.RESPONSE_CACHE_CONFIG["disk_path"] or None,
+    )
+
+
+def metrics_stats() -> dict:
+    """供 /metrics 抓取的服务状态（vLLM 内部的调度队列不可见，运行数取已准入的请求数）"""
+    stats = {
+        "running": admission.stats()["active"],
+        "queue_depth": admission.queue_depth,
+        "cache": {},
+        "startup": startup_timings,
+    }
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        stats["cache"]["response"] = {
+            "hits": cache_stats["memory_hits"] + cache_stats["disk_hits"],
+            "misses": cache_stats["misses"],
+        }
+    return stats
+
+
+metrics.register_stats(config.MODEL_NAME, metrics_stats)
 
 
 # 请求模型
 class GenerationRequest(BaseModel):
-    prompt: str = Field(..., description="输入文本提示")
+    prompt: Union[str, List[str]] = Field(..., description="输入文本提示（可为列表，一次提交多个 prompt）")
     max_tokens: int = Field(512, ge=1, le=4096, description="生成的最大token数")
     temperature: float = Field(0.7, ge=0.0, le=2.0, description="采样温度")
     top_p: float = Field(0.9, ge=0.0, le=1.0, description="nucleus采样参数")
     top_k: int = Field(50, ge=-1, description="top-k采样参数")
     stop: Optional[List[str]] = Field(None, description="停止词列表")
     stream: bool = Field(False, description="是否流式输出")
+    seed: Optional[int] = Field(None, description="随机种子（指定后结果可复现并可缓存）")
+    user: Optional[str] = Field(None, description="用户标识（没有 API key 时按用户公平调度与限流；带 key 的请求按 key 区分租户）")
+    timeout: Optional[float] = Field(None, gt=0, description="超时（秒，从收到请求起计算，也可用 X-Request-Timeout 头）：预计无法按时完成时直接返回 503，生成中到期时返回已生成的部分（finish_reason 为 length）")
 
 
 class ChatMessage(BaseModel):
@@ -52,122 +110,739 @@ class ChatRequest(BaseModel):
     temperature: float = Field(0.7, ge=0.0, le=2.0)
     top_p: float = Field(0.9, ge=0.0, le=1.0)
     stream: bool = Field(False, description="是否流式输出")
+    seed: Optional[int] = Field(None, description="随机种子（指定后结果可复现并可缓存）")
+    n: int = Field(1, ge=1, description="返回的候选数（vLLM 对同一 prompt 只 prefill 一次）")
+    best_of: Optional[int] = Field(None, ge=1, description="生成的候选数，按累计 logprob 返回最好的 n 个（不支持流式）")
+    user: Optional[str] = Field(None, description="用户标识（没有 API key 时按用户公平调度与限流；带 key 的请求按 key 区分租户）")
+    timeout: Optional[float] = Field(None, gt=0, description="超时（秒，从收到请求起计算，也可用 X-Request-Timeout 头）：预计无法按时完成时直接返回 503，生成中到期时返回已生成的部分（finish_reason 为 length）")
+
+
+class CompletionRequest(BaseModel):
+    """OpenAI 兼容的文本补全请求（legacy completions，prompt 不套用 chat template）"""
+    prompt: Union[str, List[str]] = Field(..., description="输入文本提示（可为列表）")
+    max_tokens: int = Field(512, ge=1, le=4096)
+    temperature: float = Field(0.7, ge=0.0, le=2.0)
+    top_p: float = Field(0.9, ge=0.0, le=1.0)
+    stop: Optional[Union[str, List[str]]] = Field(None, description="停止词")
+    stream: bool = Field(False, description="是否流式输出（暂不支持）")
+    seed: Optional[int] = Field(None, description="随机种子（指定后结果可复现并可缓存）")
+    n: int = Field(1, ge=1, description="每个 prompt 返回的候选数")
+    best_of: Optional[int] = Field(None, ge=1, description="每个 prompt 生成的候选数，按累计 logprob 返回最好的 n 个")
+    user: Optional[str] = Field(None, description="用户标识（没有 API key 时按用户公平调度与限流；带 key 的请求按 key 区分租户）")
+    timeout: Optional[float] = Field(None, gt=0, description="超时（秒，从收到请求起计算，也可用 X-Request-Timeout 头）：预计无法按时完成时直接返回 503，生成中到期时返回已生成的部分（finish_reason 为 length）")
+
+
+class TokenizeRequest(BaseModel):
+    """分词请求（prompt 与 messages 二选一，只计算 token，不生成）"""
+    prompt: Optional[str] = Field(None, description="文本")
+    messages: Optional[List[ChatMessage]] = Field(None, description="对话消息（按模型的 chat template 渲染）")
+    add_generation_prompt: bool = Field(True, description="messages 末尾是否加入助手回复的起始标记")
+    return_token_ids: bool = Field(False, description="是否返回 token id 列表")
 
 
 # 响应模型
 class GenerationResponse(BaseModel):
     id: str
-    text: str
-    prompt: str
-    finish_reason: str
+    text: Union[str, List[str]]  # prompt 为列表时按顺序对应
+    prompt: Union[str, List[str]]
+    finish_reason: Union[str, List[str]]
+    usage: Optional[Union[Dict, List[Dict]]] = None  # prompt 为列表时为每个 prompt 各自的用量
 
 
-@app.on_event("startup")
-async def startup_event():
-    """启动时加载模型"""
-    global llm_engine
+async def load_engine() -> None:
+    """后台初始化 vLLM 引擎并预热，完成后 /health/ready 返回 200"""
+    global llm_engine, loaded_at, startup_phase, startup_error, prompt_cache
     try:
+        start = time.perf_counter()
         logger.info(f"正在加载模型: {config.MODEL_PATH}")
-        llm_engine = LLM(
+        engine_args = AsyncEngineArgs(
             model=config.MODEL_PATH,
             tensor_parallel_size=config.VLLM_CONFIG["tensor_parallel_size"],
             gpu_memory_utilization=config.VLLM_CONFIG["gpu_memory_utilization"],
             max_model_len=config.VLLM_CONFIG["max_model_len"],
+            max_num_seqs=config.VLLM_CONFIG["max_num_seqs"],
             trust_remote_code=config.VLLM_CONFIG["trust_remote_code"],
+            load_format=config.VLLM_CONFIG["load_format"],
         )
+        # 引擎构造会同步加载权重、分配 KV 缓存，放到线程池中执行，加载期间 /health/live 仍可响应
+        engine = await asyncio.get_running_loop().run_in_executor(None, AsyncLLMEngine.from_engine_args, engine_args)
+        prompt_cache = for_tokenizer(await engine.get_tokenizer(), config.PROMPT_CACHE_CONFIG["max_cached_chars"])
+        llm_engine = engine
+        loaded_at = int(time.time())
+        startup_timings["engine_init"] = time.perf_counter() - start
         logger.info("模型加载成功！")
+
+        if config.STARTUP_CONFIG["warmup"]:
+            phase_start = time.perf_counter()
+            warmup_params = SamplingParams(max_tokens=config.STARTUP_CONFIG["warmup_tokens"], temperature=0.0)
+            async for _ in llm_engine.generate(WARMUP_PROMPT, warmup_params, random_uuid()):
+                pass
+            startup_timings["warmup"] = time.perf_counter() - phase_start
+        startup_timings["total"] = time.perf_counter() - start
+        startup_phase = "ready"
+        logger.info(
+            f"✅ 服务就绪，启动耗时 {startup_timings['total']:.1f}s"
+            f"（{', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in startup_timings.items() if phase != 'total')}）"
+        )
     except Exception as e:
+        startup_phase, startup_error = "failed", str(e)
         logger.error(f"模型加载失败: {str(e)}")
-        raise
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    启动后立即开放端口（/health/live 可用），vLLM 引擎在后台初始化与预热，
+    完成后 /health/ready 才返回 200，负载均衡据此决定何时导入流量
+    """
+    load_task = asyncio.create_task(load_engine())
+    yield
+    if not load_task.done():
+        load_task.cancel()
+    if response_cache is not None:
+        response_cache.close()
+
+
+# FastAPI应用
+app = FastAPI(
+    title="Qwen LLM Service (vLLM)",
+    description="基于vLLM的Qwen大模型推理服务",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+
+
+@app.get("/health/live")
+async def liveness():
+    """存活检查：进程在运行即返回 200，模型加载失败时返回 503（应重启实例）"""
+    if startup_phase == "failed":
+        raise HTTPException(status_code=503, detail=f"模型加载失败: {startup_error}")
+    return {"status": "alive", "phase": startup_phase}
+
+
+@app.get("/health/ready")
+async def readiness():
+    """就绪检查：模型加载并预热完成后返回 200，附带当前负载（供 router.py 按负载选择副本）"""
+    if startup_phase != "ready":
+        raise HTTPException(status_code=503, detail=f"服务未就绪: {startup_phase}")
+    return {
+        "status": "ready",
+        "load": {"active": admission.stats()["active"], "queue_depth": admission.queue_depth},
+    }
 
 
 @app.get("/health")
 async def health_check():
-    """健康检查"""
+    """健康检查（就绪后返回 200）"""
+    if llm_engine is None or startup_phase != "ready":
+        raise HTTPException(status_code=503, detail="模型未加载")
+    return {
+        "status": "healthy",
+        "model": config.MODEL_PATH,
+        "queue": admission.stats(),
+        "cancelled_requests": cancelled_requests,
+        "rate_limit": rate_limiter.stats(),
+        "startup_seconds": {phase: round(seconds, 3) for phase, seconds in startup_timings.items()},
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "prompt_cache": prompt_cache.stats() if prompt_cache is not None else None,
+    }
+
+
+@app.get("/v1/models")
+async def list_models():
+    """OpenAI 兼容的模型列表（GPU 服务只加载一个模型，vLLM 预分配显存，不做按需加载 / 卸载）"""
     if llm_engine is None:
         raise HTTPException(status_code=503, detail="模型未加载")
-    return {"status": "healthy", "model": config.MODEL_PATH}
+    return {
+        "object": "list",
+        "data": [{
+            "id": config.MODEL_NAME,
+            "object": "model",
+            "created": loaded_at,
+            "owned_by": "local",
+            "loaded": True,
+            "default": True,
+        }],
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 监控指标（与 CPU 服务指标名一致）"""
+    return metrics.metrics_response()
+
+
+def overloaded_exception(e: OverloadedError) -> HTTPException:
+    """排队已满时返回 503，并通过 Retry-After 告知客户端重试时间"""
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def rate_limited_exception(e: RateLimitError) -> HTTPException:
+    """租户超出限流额度时返回 429，附带 Retry-After 与 x-ratelimit-* 响应头"""
+    return HTTPException(status_code=429, detail=str(e), headers=e.headers)
+
+
+def reserved_tokens(sampling_params: SamplingParams) -> int:
+    """所有候选的生成 token 上限（限流时预扣，结束后退还未用完的部分）"""
+    return sampling_params.max_tokens * max(sampling_params.best_of or sampling_params.n, sampling_params.n)
+
+
+def request_cost(prompt_token_ids: List[int], sampling_params: SamplingParams) -> int:
+    """请求的 token 代价（限流预扣与公平排队）：prompt token 数 + 所有候选的生成上限"""
+    return len(prompt_token_ids) + reserved_tokens(sampling_params)
+
+
+def response_cache_key(prompt_token_ids: List[int], sampling_params: SamplingParams) -> Optional[str]:
+    """可缓存的请求返回缓存键（基于 prompt token ids），否则返回 None（多候选请求不缓存）"""
+    if (
+        response_cache is None
+        or sampling_params.n > 1
+        or not is_cacheable(sampling_params.temperature, sampling_params.seed)
+    ):
+        return None
+    # 按 vLLM SamplingParams 的全部字段生成键（与 CPU 服务的 asdict(params) 一致），避免漏掉 best_of 等字段；
+    # 新版为 msgspec.Struct（字段在 __struct_fields__ 中），旧版为普通对象
+    names = getattr(type(sampling_params), "__struct_fields__", None) or vars(sampling_params).keys()
+    params = {name: getattr(sampling_params, name) for name in names}
+    return make_key(config.MODEL_NAME, prompt_token_ids, params)
+
+
+def prefill_time(output) -> Optional[float]:
+    """从 vLLM 的请求指标中取 prefill 耗时（引擎未提供时返回 None）"""
+    request_metrics = getattr(output, "metrics", None)
+    first_token_time = getattr(request_metrics, "first_token_time", None)
+    first_scheduled_time = getattr(request_metrics, "first_scheduled_time", None)
+    if first_token_time is None or first_scheduled_time is None:
+        return None
+    return first_token_time - first_scheduled_time
+
+
+def cache_result(cache_key: Optional[str], result: dict) -> None:
+    """只缓存正常结束的结果"""
+    if cache_key is not None and result["finish_reason"] in ("stop", "length"):
+        response_cache.put(cache_key, result)
+
+
+def deadline_for(request: Union[GenerationRequest, ChatRequest, CompletionRequest], raw_request: Request) -> Optional[float]:
+    """请求的截止时间：请求体 timeout 与 X-Request-Timeout 头取较小者，都未指定时使用默认超时"""
+    try:
+        return request_deadline(
+            request.timeout, raw_request.headers.get(DEADLINE_HEADER), config.DEADLINE_CONFIG["default_timeout"]
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def generate_until(
+    prompt_token_ids: List[int], sampling_params: SamplingParams, request_id: str, deadline: Optional[float]
+):
+    """
+    提交给 vLLM 并迭代输出；到截止时间时在引擎中取消请求并结束迭代，
+    调用方按最后一次输出返回已生成的部分（未结束的候选 finish_reason 为 length）
+    """
+    outputs = llm_engine.generate(TokensPrompt(prompt_token_ids=prompt_token_ids), sampling_params, request_id)
+    try:
+        while True:
+            timeout = None if deadline is None else deadline - time.time()
+            try:
+                output = await asyncio.wait_for(outputs.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                await llm_engine.abort(request_id)
+                return
+            yield output
+    finally:
+        await outputs.aclose()
+
+
+async def run_generate(
+    prompt_token_ids: List[int],
+    sampling_params: SamplingParams,
+    tenant: Tenant,
+    cost: int,
+    req_metrics: metrics.RequestMetrics,
+    cache_key: Optional[str] = None,
+    bounded: bool = True,
+    deadline: Optional[float] = None,
+) -> dict:
+    """
+    命中响应缓存直接返回；否则按租户公平排队获取名额后提交给异步引擎
+    结束后退还预扣但未生成的 token 额度；bounded=False 时排队不计上限（见 run_generates）
+    指定截止时间时预计无法按时完成则抛出 DeadlineError，生成中到期则返回已生成的部分
+    返回 {text, finish_reason, prompt_tokens, completion_tokens, choices}
+    """
+    reserved = reserved_tokens(sampling_params)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            req_metrics.finished(cached["finish_reason"], cached["prompt_tokens"], cached["completion_tokens"])
+            rate_limiter.refund(tenant.name, reserved - cached["completion_tokens"])
+            return cached
+
+    req_metrics.queue_started()
+    try:
+        grant = await admission.acquire(
+            tenant, cost, bounded=bounded, deadline=deadline,
+            prompt_tokens=len(prompt_token_ids), max_tokens=sampling_params.max_tokens,
+        )
+    except BaseException:
+        rate_limiter.refund(tenant.name, reserved)
+        raise
+    req_metrics.admitted()
+    final_output = None
+    num_tokens = 0
+    try:
+        async for output in generate_until(prompt_token_ids, sampling_params, random_uuid(), deadline):
+            token_ids = output.outputs[0].token_ids
+            req_metrics.tokens(len(token_ids) - num_tokens, prefill_time(output))
+            num_tokens = len(token_ids)
+            final_output = output
+    finally:
+        admission.release(grant, num_tokens, prefill_time(final_output) if final_output is not None else None)
+        generated = sum(len(c.token_ids) for c in final_output.outputs) if final_output is not None else 0
+        rate_limiter.refund(tenant.name, reserved - generated)
+
+    completions = sorted(final_output.outputs, key=lambda c: c.index)[:sampling_params.n] if final_output else []
+    # 到截止时间时未结束（或尚未输出）的候选以 "length" 结束
+    truncated = not completions or any(c.finish_reason is None for c in completions)
+    choices = [{"text": c.text, "finish_reason": c.finish_reason or "length"} for c in completions] or [
+        {"text": "", "finish_reason": "length"} for _ in range(sampling_params.n)
+    ]
+    result = {
+        "text": choices[0]["text"],
+        "finish_reason": choices[0]["finish_reason"],
+        "prompt_tokens": len(prompt_token_ids),
+        "completion_tokens": sum(len(c.token_ids) for c in completions),
+        "choices": choices,
+    }
+    req_metrics.finished(result["finish_reason"], result["prompt_tokens"], result["completion_tokens"])
+    if not truncated:
+        cache_result(cache_key, result)
+    return result
+
+
+def prompt_list(prompt: Union[str, List[str]]) -> List[str]:
+    """请求中的 prompt（字符串或列表）-> 列表，数量不合法时返回 400"""
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    if not prompts:
+        raise HTTPException(status_code=400, detail="prompt 列表不能为空")
+    if len(prompts) > config.MAX_PROMPTS_PER_REQUEST:
+        raise HTTPException(
+            status_code=400, detail=f"prompt 数 {len(prompts)} 超过单个请求的上限 {config.MAX_PROMPTS_PER_REQUEST}"
+        )
+    return prompts
+
+
+async def run_generates(
+    prompts_token_ids: List[List[int]],
+    sampling_params: SamplingParams,
+    tenant: Tenant,
+    costs: List[int],
+    endpoint: str,
+    deadline: Optional[float] = None,
+) -> List[dict]:
+    """
+    多个 prompt：每个 prompt 作为独立的请求并发提交给 vLLM（各自排队、记录指标、查询响应缓存），由 vLLM 合并批处理
+    整个列表按一个请求计入排队上限（只有第一个 prompt 受限）；任一 prompt 失败时取消其余 prompt
+    """
+    cache_keys = [response_cache_key(prompt_token_ids, sampling_params) for prompt_token_ids in prompts_token_ids]
+    tasks = [
+        asyncio.ensure_future(run_generate(
+            prompt_token_ids, sampling_params, tenant, cost,
+            metrics.RequestMetrics(config.MODEL_NAME, endpoint), cache_key, bounded=i == 0, deadline=deadline,
+        ))
+        for i, (prompt_token_ids, cost, cache_key) in enumerate(zip(prompts_token_ids, costs, cache_keys))
+    ]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
 
 @app.post("/generate", response_model=GenerationResponse)
-async def generate(request: GenerationRequest):
-    """文本生成接口（非流式）"""
+async def generate(request: GenerationRequest, raw_request: Request, response: Response):
+    """文本生成接口（非流式；prompt 为列表时批量生成，按顺序返回各 prompt 的结果与用量）"""
     if llm_engine is None:
         raise HTTPException(status_code=503, detail="模型未加载")
+    tenant = rate_limiter.resolve(request.user, raw_request.headers.get("authorization"))
     
+    req_metrics = metrics.RequestMetrics(config.MODEL_NAME, "/generate")
     try:
+        deadline = deadline_for(request, raw_request)
+        prompts = prompt_list(request.prompt)
         sampling_params = SamplingParams(
             max_tokens=request.max_tokens,
             temperature=request.temperature,
             top_p=request.top_p,
             top_k=request.top_k,
             stop=request.stop,
+            seed=request.seed,
         )
+        prompts_token_ids = [prompt_cache.token_ids(prompt) for prompt in prompts]
+        costs = [request_cost(prompt_token_ids, sampling_params) for prompt_token_ids in prompts_token_ids]
+        req_metrics.tokenized()
+        response.headers.update(rate_limiter.check(tenant.name, sum(costs)))
         
-        outputs = llm_engine.generate([request.prompt], sampling_params)
-        output = outputs[0]
-        
+        if isinstance(request.prompt, str):
+            cache_key = response_cache_key(prompts_token_ids[0], sampling_params)
+            result = await run_generate(
+                prompts_token_ids[0], sampling_params, tenant, costs[0], req_metrics, cache_key, deadline=deadline
+            )
+            return GenerationResponse(
+                id=random_uuid(),
+                text=result["text"],
+                prompt=request.prompt,
+                finish_reason=result["finish_reason"],
+                usage=sse.usage_dict(result["prompt_tokens"], result["completion_tokens"]),
+            )
+        results = await run_generates(prompts_token_ids, sampling_params, tenant, costs, "/generate", deadline)
         return GenerationResponse(
             id=random_uuid(),
-            text=output.outputs[0].text,
+            text=[result["text"] for result in results],
             prompt=request.prompt,
-            finish_reason=output.outputs[0].finish_reason
+            finish_reason=[result["finish_reason"] for result in results],
+            usage=[sse.usage_dict(result["prompt_tokens"], result["completion_tokens"]) for result in results],
         )
+    except HTTPException:
+        raise
+    except RateLimitError as e:
+        req_metrics.error(metrics.ERROR_RATE_LIMITED)
+        raise rate_limited_exception(e)
+    except OverloadedError as e:
+        req_metrics.error(metrics.ERROR_OVERLOADED)
+        raise overloaded_exception(e)
     except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
         logger.error(f"生成失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/v1/tokenize")
+async def tokenize(request: TokenizeRequest):
+    """计算 prompt / 对话的 token 数（不经过引擎），供客户端在发送前检查长度与预估费用"""
+    if prompt_cache is None:
+        raise HTTPException(status_code=503, detail="模型未加载")
+    if (request.prompt is None) == (request.messages is None):
+        raise HTTPException(status_code=400, detail="prompt 与 messages 需且只能提供一个")
+    if request.messages is not None:
+        token_ids = prompt_cache.chat_token_ids(
+            [{"role": msg.role, "content": msg.content} for msg in request.messages], request.add_generation_prompt
+        )
+    else:
+        token_ids = prompt_cache.token_ids(request.prompt)
+    result = {
+        "model": config.MODEL_NAME,
+        "count": len(token_ids),
+        "max_model_len": config.VLLM_CONFIG["max_model_len"],
+    }
+    if request.return_token_ids:
+        result["tokens"] = token_ids
+    return result
+
+
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatRequest):
+async def chat_completions(request: ChatRequest, raw_request: Request, response: Response):
     """OpenAI兼容的聊天接口"""
     if llm_engine is None:
         raise HTTPException(status_code=503, detail="模型未加载")
+    tenant = rate_limiter.resolve(request.user, raw_request.headers.get("authorization"))
     
+    req_metrics = metrics.RequestMetrics(config.MODEL_NAME, "/v1/chat/completions")
     try:
-        # 将messages转换为prompt（简化版，实际需要按模型格式）
-        prompt = ""
-        for msg in request.messages:
-            if msg.role == "system":
-                prompt += f"<|im_start|>system\n{msg.content}<|im_end|>\n"
-            elif msg.role == "user":
-                prompt += f"<|im_start|>user\n{msg.content}<|im_end|>\n"
-            elif msg.role == "assistant":
-                prompt += f"<|im_start|>assistant\n{msg.content}<|im_end|>\n"
-        prompt += "<|im_start|>assistant\n"
+        deadline = deadline_for(request, raw_request)
+        # 按模型的 chat template 把对话直接转换为 token id（重复的系统提示词 / 历史消息命中分段缓存）
+        prompt_token_ids = prompt_cache.chat_token_ids(
+            [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        )
         
+        if request.best_of is not None and request.best_of < request.n:
+            raise HTTPException(status_code=400, detail=f"best_of ({request.best_of}) 不能小于 n ({request.n})")
+        if request.stream and (request.best_of or request.n) > request.n:
+            raise HTTPException(status_code=400, detail="流式输出不支持 best_of > n")
+        # n / best_of 交给 vLLM：同一 prompt 的多个候选共享 prefill 的 KV 块
+        extra_params = {"best_of": request.best_of} if request.best_of is not None else {}
         sampling_params = SamplingParams(
             max_tokens=request.max_tokens,
             temperature=request.temperature,
             top_p=request.top_p,
+            seed=request.seed,
+            n=request.n,
+            # 流式输出由服务端按新 token 增量解码，引擎只返回 token id
+            detokenize=not request.stream,
+            **extra_params,
         )
+        cache_key = response_cache_key(prompt_token_ids, sampling_params)
+        cost = request_cost(prompt_token_ids, sampling_params)
+        req_metrics.tokenized()
+        # 按 prompt + 生成上限预扣租户的 token 额度，结束后退还未用完的部分
+        rate_headers = rate_limiter.check(tenant.name, cost)
         
+        # 流式输出：命中缓存直接回放；否则先排队获取名额，名额在流结束时归还
         if request.stream:
-            # 流式输出暂不实现，返回提示
-            raise HTTPException(status_code=501, detail="流式输出暂未实现")
+            cached = await response_cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                req_metrics.finished(cached["finish_reason"], cached["prompt_tokens"], cached["completion_tokens"])
+                rate_limiter.refund(tenant.name, reserved_tokens(sampling_params) - cached["completion_tokens"])
+                return StreamingResponse(
+                    replay_cached_stream(cached),
+                    media_type="text/event-stream",
+                    headers=rate_headers,
+                )
+            req_metrics.queue_started()
+            try:
+                grant = await admission.acquire(
+                    tenant, cost, deadline=deadline,
+                    prompt_tokens=len(prompt_token_ids), max_tokens=sampling_params.max_tokens,
+                )
+            except BaseException:
+                rate_limiter.refund(tenant.name, reserved_tokens(sampling_params))
+                raise
+            req_metrics.admitted()
+            return StreamingResponse(
+                stream_chat_completions(
+                    prompt_token_ids, sampling_params, grant, raw_request, req_metrics, cache_key, deadline
+                ),
+                media_type="text/event-stream",
+                headers=rate_headers,
+            )
         
-        outputs = llm_engine.generate([prompt], sampling_params)
-        output = outputs[0]
+        result = await run_generate(prompt_token_ids, sampling_params, tenant, cost, req_metrics, cache_key, deadline=deadline)
+        response.headers.update(rate_headers)
         
         return {
-            "id": random_uuid(),
+            "id": f"chatcmpl-{random_uuid()}",
             "object": "chat.completion",
-            "created": 0,
+            "created": int(time.time()),
             "model": config.MODEL_NAME,
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": output.outputs[0].text
-                },
-                "finish_reason": output.outputs[0].finish_reason
-            }]
+            "choices": [
+                {
+                    "index": index,
+                    "message": {
+                        "role": "assistant",
+                        "content": choice["text"]
+                    },
+                    "finish_reason": choice["finish_reason"]
+                }
+                # 缓存中的结果只有单个候选
+                for index, choice in enumerate(result.get("choices") or [result])
+            ],
+            "usage": sse.usage_dict(result["prompt_tokens"], result["completion_tokens"]),
         }
+    except HTTPException:
+        raise
+    except RateLimitError as e:
+        req_metrics.error(metrics.ERROR_RATE_LIMITED)
+        raise rate_limited_exception(e)
+    except OverloadedError as e:
+        req_metrics.error(metrics.ERROR_OVERLOADED)
+        raise overloaded_exception(e)
     except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
         logger.error(f"聊天生成失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def stream_chat_completions(
+    prompt_token_ids: List[int],
+    sampling_params: SamplingParams,
+    grant: Grant,
+    raw_request: Request,
+    req_metrics: metrics.RequestMetrics,
+    cache_key: Optional[str] = None,
+    deadline: Optional[float] = None,
+):
+    """
+    流式生成聊天响应（OpenAI 兼容，与 CPU 服务的 SSE 格式一致），结束时归还名额并退还未用完的 token 额度
+    到截止时间时未结束的候选以 "length" 结束
+    """
+    global cancelled_requests
+    num_tokens: Dict[int, int] = {}
+    first_output = None
+    outputs = None
+    try:
+        request_id = random_uuid()
+        encoder = sse.ChatStreamEncoder(
+            f"chatcmpl-{request_id}", int(time.time()), config.MODEL_NAME,
+            coalesce_seconds=config.SSE_CONFIG["coalesce_ms"] / 1000,
+            coalesce_bytes=config.SSE_CONFIG["coalesce_bytes"],
+        )
+        tokenizer = await llm_engine.get_tokenizer()
+        # 按候选 index 记录增量解码器与已输出的文本，以及已结束的候选
+        detokenizers: Dict[int, IncrementalDetokenizer] = {}
+        texts: Dict[int, str] = {}
+        finished: Dict[int, Any] = {}
+        disconnected = sse.DisconnectCheck(raw_request, config.SSE_CONFIG["disconnect_check_ms"] / 1000)
+        
+        # vLLM 每次返回各候选的累计 token id（流式请求不在引擎中解码），只增量解码新增的 token
+        outputs = generate_until(prompt_token_ids, sampling_params, request_id, deadline)
+        async for output in outputs:
+            # 客户端断开后在引擎中取消该请求，释放其 batch 名额（按间隔检查，不在每个 token 上轮询连接）
+            if await disconnected():
+                logger.info(f"客户端已断开，取消生成: {request_id}")
+                await llm_engine.abort(request_id)
+                cancelled_requests += 1
+                req_metrics.error(metrics.ERROR_CANCELLED)
+                return
+            if first_output is None:
+                first_output = output
+            for completion in output.outputs:
+                index = completion.index
+                if index in finished:
+                    continue
+                if index == 0:
+                    req_metrics.tokens(len(completion.token_ids) - num_tokens.get(0, 0), prefill_time(output))
+                new_token_ids = completion.token_ids[num_tokens.get(index, 0):]
+                num_tokens[index] = len(completion.token_ids)
+                if index not in detokenizers:
+                    detokenizers[index] = IncrementalDetokenizer(tokenizer)
+                delta = detokenizers[index].step(new_token_ids)
+                if completion.finish_reason is not None:
+                    delta += detokenizers[index].flush()
+                texts[index] = texts.get(index, "") + delta
+                encoder.add_content(delta, index)
+                if completion.finish_reason is None:
+                    continue
+                finished[index] = completion
+                usage = None
+                if len(finished) == sampling_params.n:
+                    # 最后一个候选结束：汇总所有候选的 usage
+                    result = {
+                        "text": texts[0],
+                        "finish_reason": finished[0].finish_reason,
+                        "prompt_tokens": len(output.prompt_token_ids),
+                        "completion_tokens": sum(len(c.token_ids) for c in finished.values()),
+                    }
+                    req_metrics.finished(result["finish_reason"], result["prompt_tokens"], result["completion_tokens"])
+                    cache_result(cache_key, result)
+                    usage = sse.usage_dict(result["prompt_tokens"], result["completion_tokens"])
+                # 发送结束标记
+                encoder.add_finish(completion.finish_reason, usage, index)
+            data = encoder.poll()
+            if data:
+                yield data
+        # 到截止时间：未结束的候选写出剩余内容后以 "length" 结束，usage 在最后一个候选上
+        unfinished = [index for index in range(sampling_params.n) if index not in finished]
+        for index in unfinished:
+            if index in detokenizers:
+                encoder.add_content(detokenizers[index].flush(), index)
+            usage = None
+            if index == unfinished[-1]:
+                finish_reason = finished[0].finish_reason if 0 in finished else "length"
+                completion_tokens = sum(num_tokens.values())
+                req_metrics.finished(finish_reason, len(prompt_token_ids), completion_tokens)
+                usage = sse.usage_dict(len(prompt_token_ids), completion_tokens)
+            encoder.add_finish("length", usage, index)
+        yield encoder.finish_stream()
+        
+    except asyncio.CancelledError:
+        # 客户端断开时服务器可能直接取消该生成器，vLLM 会随之中止请求
+        cancelled_requests += 1
+        req_metrics.error(metrics.ERROR_CANCELLED)
+        raise
+    except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
+        logger.error(f"流式生成失败: {str(e)}")
+        yield sse.error_event(str(e))
+    finally:
+        # 关闭引擎输出的生成器：提前返回、异常或被取消时 vLLM 随之中止该请求
+        if outputs is not None:
+            await outputs.aclose()
+        admission.release(grant, num_tokens.get(0, 0), prefill_time(first_output) if first_output is not None else None)
+        rate_limiter.refund(grant.tenant.name, reserved_tokens(sampling_params) - sum(num_tokens.values()))
+
+
+@app.post("/v1/completions")
+async def completions(request: CompletionRequest, raw_request: Request, response: Response):
+    """OpenAI 兼容的文本补全接口（非流式，prompt 可为列表）"""
+    if llm_engine is None:
+        raise HTTPException(status_code=503, detail="模型未加载")
+    tenant = rate_limiter.resolve(request.user, raw_request.headers.get("authorization"))
+
+    req_metrics = metrics.RequestMetrics(config.MODEL_NAME, "/v1/completions")
+    try:
+        deadline = deadline_for(request, raw_request)
+        if request.stream:
+            raise HTTPException(status_code=400, detail="/v1/completions 暂不支持流式输出，流式请使用 /v1/chat/completions")
+        if request.best_of is not None and request.best_of < request.n:
+            raise HTTPException(status_code=400, detail=f"best_of ({request.best_of}) 不能小于 n ({request.n})")
+        prompts = prompt_list(request.prompt)
+        extra_params = {"best_of": request.best_of} if request.best_of is not None else {}
+        sampling_params = SamplingParams(
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            stop=[request.stop] if isinstance(request.stop, str) else request.stop,
+            seed=request.seed,
+            n=request.n,
+            **extra_params,
+        )
+        prompts_token_ids = [prompt_cache.token_ids(prompt) for prompt in prompts]
+        costs = [request_cost(prompt_token_ids, sampling_params) for prompt_token_ids in prompts_token_ids]
+        req_metrics.tokenized()
+        response.headers.update(rate_limiter.check(tenant.name, sum(costs)))
+
+        results = await run_generates(prompts_token_ids, sampling_params, tenant, costs, "/v1/completions", deadline)
+        # 第 i 个 prompt 的第 j 个候选 index 为 i * n + j；usage_per_prompt 为每个 prompt 各自的用量
+        return {
+            "id": f"cmpl-{random_uuid()}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": config.MODEL_NAME,
+            "choices": [
+                {
+                    "text": choice["text"],
+                    "index": i * request.n + j,
+                    "logprobs": None,
+                    "finish_reason": choice["finish_reason"],
+                }
+                # 缓存中的结果只有单个候选
+                for i, result in enumerate(results)
+                for j, choice in enumerate(result.get("choices") or [result])
+            ],
+            "usage": sse.usage_dict(
+                sum(result["prompt_tokens"] for result in results),
+                sum(result["completion_tokens"] for result in results),
+            ),
+            "usage_per_prompt": [
+                sse.usage_dict(result["prompt_tokens"], result["completion_tokens"]) for result in results
+            ],
+        }
+    except HTTPException:
+        raise
+    except RateLimitError as e:
+        req_metrics.error(metrics.ERROR_RATE_LIMITED)
+        raise rate_limited_exception(e)
+    except OverloadedError as e:
+        req_metrics.error(metrics.ERROR_OVERLOADED)
+        raise overloaded_exception(e)
+    except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
+        logger.error(f"文本补全失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def replay_cached_stream(cached: dict):
+    """以 SSE 流的形式回放缓存的结果"""
+    chunk_id = f"chatcmpl-{random_uuid()}"
+    created_time = int(time.time())
+    if cached["text"]:
+        yield sse.chat_chunk(chunk_id, created_time, config.MODEL_NAME, content=cached["text"])
+    yield sse.chat_chunk(
+        chunk_id, created_time, config.MODEL_NAME,
+        finish_reason=cached["finish_reason"],
+        usage=sse.usage_dict(cached["prompt_tokens"], cached["completion_tokens"]),
+    )
+    yield sse.DONE_EVENT
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
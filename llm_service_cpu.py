@@ -2,19 +2,31 @@
 CPU版本的LLM Service - 用于本地无GPU环境测试
 基于transformers库，完全兼容 OpenAI API
 """
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, File, Form, HTTPException, Request, Response, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List, Union
+from typing import Dict, Optional, List, Union
 from contextlib import asynccontextmanager
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
-from threading import Thread
+from dataclasses import asdict
+import asyncio
 import time
-import json
 import uuid
 import config
+import sse
 import logging
+import metrics
+from admission import DEADLINE_HEADER, PRIORITY_BATCH, AdmissionController, Grant, OverloadedError, Tenant, request_deadline
+from batch_engine import collect_outputs
+from batch_inference import BatchManager
+from fake_engine import FakeEngine, FakeTokenizer
+import model_loader
+import prompt_builder
+from model_registry import LoadedModel, ModelNotFoundError, ModelRegistry, estimate_weight_bytes, parse_model_specs
+import quantization
+from rate_limit import RateLimitError, build_rate_limiter
+from response_cache import ResponseCache, is_cacheable, make_key
+from sampling import SamplingParams
+from worker_pool import WorkerPool
 
 # 日志配置
 logging.basicConfig(
@@ -23,18 +35,73 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 全局模型和tokenizer
-model = None
-tokenizer = None
+# 模型注册表：按请求的 model 字段路由到不同模型，首次请求时加载，超出内存预算时按 LRU 卸载空闲模型
+registry: Optional[ModelRegistry] = None
+batch_manager: Optional[BatchManager] = None
+
+# 启动阶段：loading（端口已开放，默认模型在后台加载与预热）-> ready / failed
+startup_phase = "loading"
+startup_error: Optional[str] = None
+WARMUP_PROMPT = "Hello! 请简单介绍一下你自己。"
+
+# 多租户：按租户（user 字段 / API key）的令牌桶限流，准入队列按租户加权公平排队
+rate_limiter = build_rate_limiter(config.TENANT_CONFIG)
+# 离线批处理任务以 batch 优先级排队，不挤占交互式请求的名额
+BATCH_JOB_TENANT = Tenant("offline-batch", priority=PRIORITY_BATCH)
+
+# 确定性响应缓存（可选）：temperature=0 或指定 seed 的相同请求直接返回缓存结果
+response_cache: Optional[ResponseCache] = None
+if config.RESPONSE_CACHE_CONFIG["enabled"]:
+    response_cache = ResponseCache(
+        max_bytes=config.RESPONSE_CACHE_CONFIG["max_memory_mb"] * 1024 * 1024,
+        ttl_seconds=config.RESPONSE_CACHE_CONFIG["ttl_seconds"],
+        disk_path=config.RESPONSE_CACHE_CONFIG["disk_path"] or None,
+    )
+
+
+def metrics_stats() -> dict:
+    """供 /metrics 抓取的各模型状态（只包含已加载的模型）"""
+    all_stats = {}
+    for served in registry.loaded() if registry is not None else []:
+        engine_stats = served.engine.stats()
+        stats = {
+            "running": engine_stats["running"],
+            "waiting": engine_stats["waiting"],
+            "queue_depth": served.admission.queue_depth,
+            "cache": {},
+        }
+        if "prefix_cache" in engine_stats:
+            stats["cache"]["prefix"] = engine_stats["prefix_cache"]
+        if "session_cache" in engine_stats:
+            stats["cache"]["session"] = engine_stats["session_cache"]
+        if "speculative" in engine_stats:
+            stats["speculative"] = engine_stats["speculative"]
+        stats["startup"] = served.startup
+        all_stats[served.name] = stats
+    if response_cache is not None:
+        # 响应缓存各模型共用，记在默认模型名下
+        cache_stats = response_cache.stats()
+        all_stats.setdefault(config.MODEL_NAME, {}).setdefault("cache", {})["response"] = {
+            "hits": cache_stats["memory_hits"] + cache_stats["disk_hits"],
+            "misses": cache_stats["misses"],
+        }
+    return all_stats
+
+
+metrics.register_model_stats(metrics_stats)
 
 
 # 请求模型
 class GenerationRequest(BaseModel):
-    prompt: str = Field(..., description="输入文本提示")
+    model: Optional[str] = Field(None, description="模型名称（可选，默认使用默认模型）")
+    user: Optional[str] = Field(None, description="用户标识（没有 API key 时按用户公平调度与限流；带 key 的请求按 key 区分租户）")
+    prompt: Union[str, List[str]] = Field(..., description="输入文本提示（可为列表，一次提交多个 prompt，引擎按长度分组批量 prefill）")
     max_tokens: int = Field(512, ge=1, le=2048, description="生成的最大token数")
     temperature: float = Field(0.7, ge=0.0, le=2.0, description="采样温度")
     top_p: float = Field(0.9, ge=0.0, le=1.0, description="nucleus采样参数")
     top_k: int = Field(50, ge=1, description="top-k采样参数")
+    seed: Optional[int] = Field(None, description="随机种子（指定后结果可复现并可缓存）")
+    timeout: Optional[float] = Field(None, gt=0, description="超时（秒，从收到请求起计算，也可用 X-Request-Timeout 头）：预计无法按时完成时直接返回 503，生成中到期时返回已生成的部分（finish_reason 为 length）")
 
 
 class ChatMessage(BaseModel):
@@ -44,53 +111,241 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     """OpenAI 兼容的聊天请求"""
-    model: Optional[str] = Field(None, description="模型名称（可选，服务端只有一个模型）")
+    model: Optional[str] = Field(None, description="模型名称（可选，默认使用默认模型，可用模型见 /v1/models）")
     messages: List[ChatMessage] = Field(..., description="对话历史")
-    max_tokens: Optional[int] = Field(512, ge=1, le=4096, description="生成的最大token数")
-    temperature: Optional[float] = Field(0.7, ge=0.0, le=2.0, description="采样温度")
-    top_p: Optional[float] = Field(0.9, ge=0.0, le=1.0, description="nucleus采样参数")
-    stream: Optional[bool] = Field(False, description="是否流式输出")
+    max_tokens: int = Field(512, ge=1, le=4096, description="生成的最大token数")
+    temperature: float = Field(0.7, ge=0.0, le=2.0, description="采样温度")
+    top_p: float = Field(0.9, ge=0.0, le=1.0, description="nucleus采样参数")
+    stream: bool = Field(False, description="是否流式输出")
     stop: Optional[Union[str, List[str]]] = Field(None, description="停止词")
-    presence_penalty: Optional[float] = Field(0.0, ge=-2.0, le=2.0, description="存在惩罚（暂不支持）")
-    frequency_penalty: Optional[float] = Field(0.0, ge=-2.0, le=2.0, description="频率惩罚（暂不支持）")
-    n: Optional[int] = Field(1, ge=1, le=1, description="生成数量（仅支持1）")
-    user: Optional[str] = Field(None, description="用户标识")
+    presence_penalty: float = Field(0.0, ge=-2.0, le=2.0, description="存在惩罚（暂不支持）")
+    frequency_penalty: float = Field(0.0, ge=-2.0, le=2.0, description="频率惩罚（暂不支持）")
+    n: int = Field(1, ge=1, description="返回的候选数（prompt 只 prefill 一次，KV 缓存在候选间共享）")
+    best_of: Optional[int] = Field(None, ge=1, description="生成的候选数，按累计 logprob 返回最好的 n 个（不支持流式）")
+    seed: Optional[int] = Field(None, description="随机种子（指定后结果可复现并可缓存）")
+    user: Optional[str] = Field(None, description="用户标识（没有 API key 时按用户公平调度与限流；带 key 的请求按 key 区分租户）")
+    session_id: Optional[str] = Field(None, description="会话标识（可选，同一会话的下一轮复用已缓存的历史 KV，只 prefill 新增的消息）")
+    timeout: Optional[float] = Field(None, gt=0, description="超时（秒，从收到请求起计算，也可用 X-Request-Timeout 头）：预计无法按时完成时直接返回 503，生成中到期时返回已生成的部分（finish_reason 为 length）")
+
+
+class CompletionRequest(BaseModel):
+    """OpenAI 兼容的文本补全请求（legacy completions，prompt 不套用 chat template）"""
+    model: Optional[str] = Field(None, description="模型名称（可选，默认使用默认模型，可用模型见 /v1/models）")
+    prompt: Union[str, List[str]] = Field(..., description="输入文本提示（可为列表，引擎按长度分组批量 prefill）")
+    max_tokens: int = Field(512, ge=1, le=4096, description="生成的最大token数")
+    temperature: float = Field(0.7, ge=0.0, le=2.0, description="采样温度")
+    top_p: float = Field(0.9, ge=0.0, le=1.0, description="nucleus采样参数")
+    stream: bool = Field(False, description="是否流式输出（暂不支持）")
+    stop: Optional[Union[str, List[str]]] = Field(None, description="停止词")
+    n: int = Field(1, ge=1, description="每个 prompt 返回的候选数")
+    best_of: Optional[int] = Field(None, ge=1, description="每个 prompt 生成的候选数，按累计 logprob 返回最好的 n 个")
+    seed: Optional[int] = Field(None, description="随机种子（指定后结果可复现并可缓存）")
+    user: Optional[str] = Field(None, description="用户标识（没有 API key 时按用户公平调度与限流；带 key 的请求按 key 区分租户）")
+    timeout: Optional[float] = Field(None, gt=0, description="超时（秒，从收到请求起计算，也可用 X-Request-Timeout 头）：预计无法按时完成时直接返回 503，生成中到期时返回已生成的部分（finish_reason 为 length）")
+
+
+class BatchRequest(BaseModel):
+    """OpenAI 兼容的批处理任务创建请求"""
+    input_file_id: str = Field(..., description="通过 /v1/files 上传的输入文件 ID")
+    endpoint: str = Field("/v1/chat/completions", description="批处理请求调用的接口")
+    completion_window: str = Field("24h", description="完成时限（仅记录，不强制）")
+    metadata: Optional[dict] = Field(None, description="自定义元数据")
+
+
+class TokenizeRequest(BaseModel):
+    """分词请求（prompt 与 messages 二选一，只计算 token，不生成）"""
+    model: Optional[str] = Field(None, description="模型名称（默认模型）")
+    prompt: Optional[str] = Field(None, description="文本")
+    messages: Optional[List[ChatMessage]] = Field(None, description="对话消息（按模型的 chat template 渲染）")
+    add_generation_prompt: bool = Field(True, description="messages 末尾是否加入助手回复的起始标记")
+    return_token_ids: bool = Field(False, description="是否返回 token id 列表")
 
 
 # 响应模型
 class GenerationResponse(BaseModel):
-    text: str
-    prompt: str
+    text: Union[str, List[str]]  # prompt 为列表时按顺序对应
+    prompt: Union[str, List[str]]
+    usage: Optional[Union[Dict, List[Dict]]] = None  # prompt 为列表时为每个 prompt 各自的用量
+
+
+def load_tokenizer(name: str, path: str):
+    if config.CPU_ENGINE_BACKEND == "fake":
+        return FakeTokenizer()
+    return model_loader.load_tokenizer(path)
+
+
+def load_engine(name: str, path: str, tokenizer) -> tuple:
+    """加载模型并构建引擎（在线程池中执行），返回 (未启动的引擎, 权重内存字节数, 附加信息)"""
+    timings = {}
+    if config.CPU_ENGINE_BACKEND == "fake":
+        # 无权重假引擎：只用于压测服务层开销
+        return FakeEngine(**config.CPU_ENGINE_CONFIG, **config.FAKE_ENGINE_CONFIG), 0, {"precision": {"mode": "fake"}}
+
+    # 草稿模型需与主模型共用分词器，只配给默认模型
+    use_draft = name == config.MODEL_NAME
+    model = None
+    pool_config = config.WORKER_POOL_CONFIG
+    if pool_config["num_workers"] > 1:
+        # fork 模式在前端进程加载一次权重后 fork；mmap 模式由各 worker 自行加载
+        draft_model = None
+        if pool_config["weight_sharing"] == "fork":
+            model = model_loader.load_model(path, timings=timings)
+            draft_model = model_loader.load_draft_model(timings) if use_draft else None
+            logger.info(f"✅ 模型 {name} 加载成功（CPU模式），即将 fork worker 进程")
+        engine = WorkerPool(
+            num_workers=pool_config["num_workers"],
+            cpu_sets=pool_config["cpu_sets"],
+            numa=pool_config["numa"],
+            threads_per_worker=pool_config["threads_per_worker"],
+            model=model,
+            tokenizer=tokenizer,
+            draft_model=draft_model,
+            model_path=path,
+            use_draft=use_draft,
+        )
+    else:
+        model = model_loader.load_model(path, timings=timings)
+        logger.info(f"✅ 模型 {name} 加载成功（CPU模式）")
+        draft_model = model_loader.load_draft_model(timings) if use_draft else None
+        engine = model_loader.build_engine(model, tokenizer, draft_model)
+
+    mode = config.CPU_PRECISION_CONFIG["mode"]
+    if model is None:
+        # 权重在 worker 进程中（各自加载的耗时计入引擎启动），按权重文件大小估算
+        return engine, estimate_weight_bytes(path), {"precision": {"mode": mode}, "startup": timings}
+    info = {"precision": quantization.precision_info(model, mode), "startup": timings}
+    return engine, quantization.model_memory_bytes(model), info
+
+
+def make_admission() -> AdmissionController:
+    """
+    每个模型一个准入队列：并发数与该模型所有引擎的 batch 总大小一致，其余请求按优先级和租户公平排队，
+    队列满时快速拒绝
+    """
+    return AdmissionController(
+        max_concurrency=config.CPU_ENGINE_CONFIG["max_batch_size"] * config.WORKER_POOL_CONFIG["num_workers"],
+        max_queue_size=config.MAX_QUEUE_SIZE,
+        batch_max_share=config.TENANT_CONFIG["batch_max_share"],
+    )
+
+
+async def warm_up(served: LoadedModel) -> None:
+    """
+    预热：每个 worker 跑一个短请求，初始化算子并把 mmap 的权重页读入内存，
+    预热完成前模型不对外可用，之后的首 token 延迟才稳定
+    """
+    if not config.STARTUP_CONFIG["warmup"]:
+        return
+    prompt_token_ids = served.tokenizer(WARMUP_PROMPT)["input_ids"]
+    params = SamplingParams(max_tokens=config.STARTUP_CONFIG["warmup_tokens"], temperature=0.0)
+    await asyncio.gather(*(
+        collect_outputs(served.engine.generate(prompt_token_ids, params))
+        for _ in range(config.WORKER_POOL_CONFIG["num_workers"])
+    ))
+
+
+async def preload_default_model() -> None:
+    """后台加载并预热默认模型，完成后 /health/ready 返回 200"""
+    global startup_phase, startup_error
+    try:
+        registry.release(await registry.acquire(config.MODEL_NAME))
+        startup_phase = "ready"
+    except Exception as e:
+        startup_phase, startup_error = "failed", str(e)
+        logger.error(f"❌ 模型加载失败: {str(e)}")
+        logger.info("提示: 如果内存不足，请尝试使用更小的模型（如Qwen2.5-7B），或设置 MODEL_MEMORY_BUDGET_MB")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """启动时加载模型"""
-    global model, tokenizer
+    """
+    启动时创建模型注册表后立即开放端口（/health/live 可用），默认模型在后台加载与预热，
+    完成后 /health/ready 才返回 200，负载均衡据此决定何时导入流量
+    """
+    global registry, startup_phase
     try:
-        logger.info(f"正在加载模型: {config.MODEL_PATH}")
-        logger.warning("⚠️  CPU模式运行，速度较慢，仅用于测试！")
-
-        tokenizer = AutoTokenizer.from_pretrained(
-            config.MODEL_PATH,
-            trust_remote_code=True
-        )
+        if config.CPU_ENGINE_BACKEND == "fake":
+            logger.warning("⚠️  使用假引擎运行，输出为确定性的假文本！")
+        else:
+            logger.warning("⚠️  CPU模式运行，速度较慢，仅用于测试！")
+            quantization.validate_precision(
+                config.CPU_PRECISION_CONFIG["mode"], config.CPU_PRECISION_CONFIG["int4_group_size"]
+            )
 
-        # CPU模式，使用较低精度以节省内存
-        model = AutoModelForCausalLM.from_pretrained(
-            config.MODEL_PATH,
-            torch_dtype=torch.float16,  # 使用fp16节省内存
-            device_map="cpu",
-            trust_remote_code=True,
-            low_cpu_mem_usage=True,  # 低内存模式
+        registry_config = config.MODEL_REGISTRY_CONFIG
+        registry = ModelRegistry(
+            models=parse_model_specs(registry_config["models"], config.MODEL_NAME, config.MODEL_PATH),
+            default_model=config.MODEL_NAME,
+            load_tokenizer=load_tokenizer,
+            load_engine=load_engine,
+            make_admission=make_admission,
+            memory_budget_bytes=registry_config["memory_budget_mb"] * 1024 * 1024,
+            warm_up=warm_up,
         )
-
-        logger.info("✅ 模型加载成功（CPU模式）")
-        yield
+        logger.info(f"已注册模型: {', '.join(registry.models)}")
     except Exception as e:
         logger.error(f"❌ 模型加载失败: {str(e)}")
-        logger.info("提示: 如果内存不足，请尝试使用更小的模型（如Qwen2.5-7B）")
         raise
+    preload_task = None
+    if registry_config["preload_default"]:
+        preload_task = asyncio.create_task(preload_default_model())
+    else:
+        startup_phase = "ready"
+    start_batch_manager()
+    yield
+    if preload_task is not None and not preload_task.done():
+        preload_task.cancel()
+    batch_manager.stop()
+    registry.stop()
+    if response_cache is not None:
+        response_cache.close()
+
+
+async def batch_generate(prompt_token_ids: List[int], params: SamplingParams, model_name: str):
+    """
+    批处理请求以 batch 优先级排队（批处理自身限制了并发，排队不计上限），
+    最多占用 batch_max_share 比例的名额；生成期间持有模型引用
+    """
+    served = await registry.acquire(model_name)
+    try:
+        grant = await served.admission.acquire(
+            BATCH_JOB_TENANT, request_cost(prompt_token_ids, params), bounded=False,
+            prompt_tokens=len(prompt_token_ids), max_tokens=params.max_tokens,
+        )
+        completion_tokens = 0
+        prefill_seconds = None
+        try:
+            async for output in served.engine.generate(prompt_token_ids, params):
+                if output.index == 0:
+                    completion_tokens = output.completion_tokens
+                    prefill_seconds = output.prefill_time
+                yield output
+        finally:
+            served.admission.release(grant, completion_tokens, prefill_seconds)
+    finally:
+        registry.release(served)
+
+
+def prepare_routed_batch_request(body: dict) -> tuple:
+    """按 model 字段选择分词器（只加载分词器，不加载权重）；由批处理在线程池中调用"""
+    try:
+        model_name = registry.resolve(body.get("model"))
+    except ModelNotFoundError:
+        raise ValueError(f"模型不存在: {body.get('model')}")
+    return prepare_batch_request(registry.tokenizer(model_name), dict(body, model=model_name))
+
+
+def start_batch_manager() -> None:
+    global batch_manager
+    batch_manager = BatchManager(
+        data_dir=config.BATCH_CONFIG["data_dir"],
+        generate=batch_generate,
+        prepare=prepare_routed_batch_request,
+        build_response=chat_completion_response,
+        max_concurrency=config.BATCH_CONFIG["max_concurrency"] or config.CPU_ENGINE_CONFIG["max_batch_size"],
+        chunk_size=config.BATCH_CONFIG["chunk_size"],
+    )
+    batch_manager.start()
 
 
 # FastAPI应用
@@ -102,252 +357,687 @@ app = FastAPI(
 )
 
 
+@app.get("/health/live")
+async def liveness():
+    """存活检查：进程在运行即返回 200，默认模型加载失败时返回 503（应重启实例）"""
+    if startup_phase == "failed":
+        raise HTTPException(status_code=503, detail=f"模型加载失败: {startup_error}")
+    return {"status": "alive", "phase": startup_phase}
+
+
+@app.get("/health/ready")
+async def readiness():
+    """就绪检查：默认模型加载并预热完成后返回 200，附带当前负载（供 router.py 按负载选择副本）"""
+    if registry is None or startup_phase != "ready":
+        raise HTTPException(status_code=503, detail=f"服务未就绪: {startup_phase}")
+    loaded = registry.loaded()
+    return {
+        "status": "ready",
+        "load": {
+            "active": sum(served.admission.stats()["active"] for served in loaded),
+            "queue_depth": sum(served.admission.queue_depth for served in loaded),
+        },
+    }
+
+
 @app.get("/health")
 async def health_check():
-    """健康检查"""
-    if model is None or tokenizer is None:
+    """健康检查（就绪后返回 200）"""
+    if registry is None or startup_phase != "ready":
         raise HTTPException(status_code=503, detail="模型未加载")
     return {
         "status": "healthy",
         "model": config.MODEL_PATH,
         "device": "cpu",
+        "models": registry.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "prompt_cache": {served.name: get_prompt_builder(served.tokenizer).stats() for served in registry.loaded()},
         "warning": "CPU模式运行，速度较慢"
     }
 
 
-@app.post("/generate", response_model=GenerationResponse)
-async def generate(request: GenerationRequest):
-    """文本生成接口"""
-    if model is None or tokenizer is None:
+@app.get("/v1/models")
+async def list_models():
+    """已注册的模型及其加载状态（OpenAI 兼容）"""
+    if registry is None:
+        raise HTTPException(status_code=503, detail="模型未加载")
+    return {"object": "list", "data": registry.list_models()}
+
+
+@app.get("/v1/models/{model_id}")
+async def get_model(model_id: str):
+    if registry is None:
+        raise HTTPException(status_code=503, detail="模型未加载")
+    for entry in registry.list_models():
+        if entry["id"] == model_id:
+            return entry
+    raise HTTPException(status_code=404, detail=f"模型不存在: {model_id}")
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 监控指标"""
+    return metrics.metrics_response()
+
+
+def overloaded_exception(e: OverloadedError) -> HTTPException:
+    """排队已满时返回 503，并通过 Retry-After 告知客户端重试时间"""
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def rate_limited_exception(e: RateLimitError) -> HTTPException:
+    """租户超出限流额度时返回 429，附带 Retry-After 与 x-ratelimit-* 响应头"""
+    return HTTPException(status_code=429, detail=str(e), headers=e.headers)
+
+
+def request_cost(prompt_token_ids: List[int], params: SamplingParams) -> int:
+    """请求的 token 代价（限流预扣与公平排队）：prompt token 数 + 所有候选的生成上限"""
+    return len(prompt_token_ids) + params.max_tokens * params.num_sequences
+
+
+def resolve_model(name: Optional[str]) -> str:
+    """请求的模型名 -> 注册名，未注册时返回 404"""
+    if registry is None:
         raise HTTPException(status_code=503, detail="模型未加载")
-    
     try:
+        return registry.resolve(name)
+    except ModelNotFoundError:
+        raise HTTPException(
+            status_code=404, detail=f"模型不存在: {name}，可用模型: {', '.join(registry.models)}"
+        )
+
+
+def response_cache_key(model_name: str, prompt_token_ids: List[int], params: SamplingParams) -> Optional[str]:
+    """可缓存的请求返回缓存键，否则返回 None（多候选请求不缓存）"""
+    if response_cache is None or params.n > 1 or not is_cacheable(params.temperature, params.seed):
+        return None
+    # 截止时间不影响生成结果，不计入缓存键
+    return make_key(model_name, prompt_token_ids, dict(asdict(params), deadline=None))
+
+
+def cache_result(cache_key: Optional[str], result: dict, params: SamplingParams) -> None:
+    """只缓存正常结束的结果（到截止时间提前结束的部分输出不缓存）"""
+    if cache_key is None or result["finish_reason"] not in ("stop", "length"):
+        return
+    if params.deadline is not None and result["finish_reason"] == "length" and result["completion_tokens"] < params.max_tokens:
+        return
+    response_cache.put(cache_key, result)
+
+
+async def collect_generation(
+    served: LoadedModel,
+    tenant: Tenant,
+    prompt_token_ids: List[int],
+    params: SamplingParams,
+    req_metrics: metrics.RequestMetrics,
+    cache_key: Optional[str] = None,
+    session_id: Optional[str] = None,
+    bounded: bool = True,
+) -> dict:
+    """
+    非流式：命中响应缓存直接返回；否则按租户公平排队获取名额后等待引擎生成完毕
+    结束后退还预扣但未生成的 token 额度；bounded=False 时排队不计上限（见 collect_generations）
+    返回 {text, finish_reason, prompt_tokens, completion_tokens, choices}
+    """
+    reserved_tokens = params.max_tokens * params.num_sequences
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            req_metrics.finished(cached["finish_reason"], cached["prompt_tokens"], cached["completion_tokens"])
+            rate_limiter.refund(tenant.name, reserved_tokens - cached["completion_tokens"])
+            return cached
+
+    req_metrics.queue_started()
+    try:
+        grant = await served.admission.acquire(
+            tenant, request_cost(prompt_token_ids, params), bounded=bounded, deadline=params.deadline,
+            prompt_tokens=len(prompt_token_ids), max_tokens=params.max_tokens,
+        )
+    except BaseException:
+        rate_limiter.refund(tenant.name, reserved_tokens)
+        raise
+    req_metrics.admitted()
+    prefill_seconds = None
+
+    def on_output(output) -> None:
+        nonlocal prefill_seconds
+        # 多候选时首 token / token 间隔只按第一个候选统计
+        if output.index == 0:
+            req_metrics.tokens(len(output.token_ids), output.prefill_time)
+            prefill_seconds = output.prefill_time
+
+    generated_tokens = 0
+    try:
+        result = await collect_outputs(
+            served.engine.generate(prompt_token_ids, params, session_id=session_id), on_output
+        )
+        generated_tokens = result["completion_tokens"]
+    finally:
+        served.admission.release(grant, generated_tokens // params.num_sequences, prefill_seconds)
+        rate_limiter.refund(tenant.name, reserved_tokens - generated_tokens)
+    req_metrics.finished(result["finish_reason"], result["prompt_tokens"], result["completion_tokens"])
+    cache_result(cache_key, result, params)
+    return result
+
+
+def prompt_list(prompt: Union[str, List[str]]) -> List[str]:
+    """请求中的 prompt（字符串或列表）-> 列表，数量不合法时抛出 ValueError"""
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    if not prompts:
+        raise ValueError("prompt 列表不能为空")
+    if len(prompts) > config.MAX_PROMPTS_PER_REQUEST:
+        raise ValueError(f"prompt 数 {len(prompts)} 超过单个请求的上限 {config.MAX_PROMPTS_PER_REQUEST}")
+    return prompts
+
+
+def deadline_for(request: Union[GenerationRequest, ChatRequest, CompletionRequest], raw_request: Request) -> Optional[float]:
+    """请求的截止时间：请求体 timeout 与 X-Request-Timeout 头取较小者，都未指定时使用默认超时"""
+    return request_deadline(
+        request.timeout, raw_request.headers.get(DEADLINE_HEADER), config.DEADLINE_CONFIG["default_timeout"]
+    )
+
+
+async def collect_generations(
+    served: LoadedModel,
+    tenant: Tenant,
+    prompts_token_ids: List[List[int]],
+    params: SamplingParams,
+    model_name: str,
+    endpoint: str,
+) -> List[dict]:
+    """
+    多个 prompt：每个 prompt 作为独立的引擎请求并发提交（各自按租户公平排队、记录指标、查询响应缓存），
+    引擎把同一步接纳的请求按长度分组批量 prefill
+    整个列表按一个请求计入排队上限（只有第一个 prompt 受限）；任一 prompt 失败时取消其余 prompt
+    """
+    tasks = [
+        asyncio.ensure_future(collect_generation(
+            served, tenant, prompt_token_ids, params,
+            metrics.RequestMetrics(model_name, endpoint),
+            response_cache_key(model_name, prompt_token_ids, params),
+            bounded=i == 0,
+        ))
+        for i, prompt_token_ids in enumerate(prompts_token_ids)
+    ]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+@app.post("/generate", response_model=GenerationResponse)
+async def generate(request: GenerationRequest, raw_request: Request, response: Response):
+    """文本生成接口（prompt 为列表时批量生成，按顺序返回各 prompt 的结果与用量）"""
+    model_name = resolve_model(request.model)
+    tenant = rate_limiter.resolve(request.user, raw_request.headers.get("authorization"))
+    req_metrics = metrics.RequestMetrics(model_name, "/generate")
+    served = None
+    try:
+        deadline = deadline_for(request, raw_request)
+        prompts = prompt_list(request.prompt)
+        served = await registry.acquire(model_name)
         # Tokenize输入
-        inputs = tokenizer(request.prompt, return_tensors="pt")
-        
-        # 生成
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=request.max_tokens,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                top_k=request.top_k,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-            )
-        
-        # 解码输出
-        generated_text = tokenizer.decode(
-            outputs[0][inputs['input_ids'].shape[1]:],
-            skip_special_tokens=True
+        prompts_token_ids = [get_prompt_builder(served.tokenizer).token_ids(prompt) for prompt in prompts]
+        req_metrics.tokenized()
+        params = SamplingParams(
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            top_k=request.top_k,
+            seed=request.seed,
+            deadline=deadline,
         )
-        
+        cost = sum(request_cost(prompt_token_ids, params) for prompt_token_ids in prompts_token_ids)
+        response.headers.update(rate_limiter.check(tenant.name, cost))
+
+        # 提交给连续批处理引擎生成
+        if isinstance(request.prompt, str):
+            result = await collect_generation(
+                served, tenant, prompts_token_ids[0], params, req_metrics,
+                response_cache_key(model_name, prompts_token_ids[0], params),
+            )
+            return GenerationResponse(
+                text=result["text"],
+                prompt=request.prompt,
+                usage=sse.usage_dict(result["prompt_tokens"], result["completion_tokens"]),
+            )
+        results = await collect_generations(served, tenant, prompts_token_ids, params, model_name, "/generate")
         return GenerationResponse(
-            text=generated_text,
-            prompt=request.prompt
+            text=[result["text"] for result in results],
+            prompt=request.prompt,
+            usage=[sse.usage_dict(result["prompt_tokens"], result["completion_tokens"]) for result in results],
         )
+    except RateLimitError as e:
+        req_metrics.error(metrics.ERROR_RATE_LIMITED)
+        raise rate_limited_exception(e)
+    except OverloadedError as e:
+        req_metrics.error(metrics.ERROR_OVERLOADED)
+        raise overloaded_exception(e)
+    except ValueError as e:
+        req_metrics.error(metrics.ERROR_INVALID_REQUEST)
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
         logger.error(f"生成失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if served is not None:
+            registry.release(served)
+
+
+def get_prompt_builder(tokenizer) -> prompt_builder.PromptBuilder:
+    return prompt_builder.for_tokenizer(tokenizer, config.PROMPT_CACHE_CONFIG["max_cached_chars"])
+
+
+def chat_token_ids(tokenizer, messages: List[ChatMessage], add_generation_prompt: bool = True) -> List[int]:
+    """按模型的 chat template 把对话历史直接转换为 prompt token id（分段缓存，不重复分词）"""
+    return get_prompt_builder(tokenizer).chat_token_ids(
+        [{"role": msg.role, "content": msg.content} for msg in messages], add_generation_prompt
+    )
+
+
+def chat_sampling_params(request: Union[ChatRequest, CompletionRequest], deadline: Optional[float] = None) -> SamplingParams:
+    """聊天与文本补全请求的采样参数"""
+    # 处理停止词
+    stop_sequences = []
+    if request.stop:
+        if isinstance(request.stop, str):
+            stop_sequences = [request.stop]
+        else:
+            stop_sequences = request.stop
+    return SamplingParams(
+        max_tokens=request.max_tokens,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        stop=stop_sequences,
+        seed=request.seed,
+        n=request.n,
+        best_of=request.best_of,
+        deadline=deadline,
+    )
+
+
+def chat_completion_response(result: dict, model_name: str) -> dict:
+    """非流式聊天结果的 OpenAI 兼容响应体"""
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": [
+            {
+                "index": index,
+                "message": {
+                    "role": "assistant",
+                    "content": choice["text"]
+                },
+                "finish_reason": choice["finish_reason"]
+            }
+            # 缓存中的结果只有单个候选
+            for index, choice in enumerate(result.get("choices") or [result])
+        ],
+        "usage": sse.usage_dict(result["prompt_tokens"], result["completion_tokens"])
+    }
+
+
+def completion_response(results: List[dict], model_name: str, n: int) -> dict:
+    """
+    非流式文本补全结果的 OpenAI 兼容响应体：第 i 个 prompt 的第 j 个候选 index 为 i * n + j，
+    usage 为全部 prompt 之和，usage_per_prompt 按顺序给出每个 prompt 各自的用量
+    """
+    choices = [
+        {
+            "text": choice["text"],
+            "index": i * n + j,
+            "logprobs": None,
+            "finish_reason": choice["finish_reason"],
+        }
+        for i, result in enumerate(results)
+        # 缓存中的结果只有单个候选
+        for j, choice in enumerate(result.get("choices") or [result])
+    ]
+    return {
+        "id": f"cmpl-{uuid.uuid4().hex[:8]}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": choices,
+        "usage": sse.usage_dict(
+            sum(result["prompt_tokens"] for result in results),
+            sum(result["completion_tokens"] for result in results),
+        ),
+        "usage_per_prompt": [sse.usage_dict(result["prompt_tokens"], result["completion_tokens"]) for result in results],
+    }
+
+
+def prepare_batch_request(tokenizer, body: dict) -> tuple:
+    """批处理中的一条聊天请求 -> (prompt_token_ids, 采样参数, 模型名)，不合法时抛出 ValueError"""
+    request = ChatRequest(**body)
+    if request.stream:
+        raise ValueError("批处理不支持流式输出")
+    params = chat_sampling_params(request)
+    params.validate()
+    prompt_token_ids = chat_token_ids(tokenizer, request.messages)
+    return prompt_token_ids, params, request.model or config.MODEL_NAME
+
+
+@app.post("/v1/tokenize")
+async def tokenize(request: TokenizeRequest):
+    """计算 prompt / 对话的 token 数（只加载分词器，不占用引擎），供客户端在发送前检查长度与预估费用"""
+    if (request.prompt is None) == (request.messages is None):
+        raise HTTPException(status_code=400, detail="prompt 与 messages 需且只能提供一个")
+    model_name = resolve_model(request.model)
+    # 未加载的模型首次使用时从磁盘加载分词器，放到线程池中执行
+    tokenizer = await asyncio.get_running_loop().run_in_executor(None, registry.tokenizer, model_name)
+    if request.messages is not None:
+        token_ids = chat_token_ids(tokenizer, request.messages, request.add_generation_prompt)
+    else:
+        token_ids = get_prompt_builder(tokenizer).token_ids(request.prompt)
+    result = {
+        "model": model_name,
+        "count": len(token_ids),
+        "max_model_len": config.CPU_ENGINE_CONFIG["max_model_len"],
+    }
+    if request.return_token_ids:
+        result["tokens"] = token_ids
+    return result
 
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatRequest):
+async def chat_completions(request: ChatRequest, raw_request: Request, response: Response):
     """OpenAI 完全兼容的聊天接口"""
-    if model is None or tokenizer is None:
-        raise HTTPException(status_code=503, detail="模型未加载")
-    
+    model_name = resolve_model(request.model)
+    tenant = rate_limiter.resolve(request.user, raw_request.headers.get("authorization"))
+    req_metrics = metrics.RequestMetrics(model_name, "/v1/chat/completions")
+    # 请求处理期间持有模型引用，模型不会被卸载；流式请求在流结束时释放
+    served = None
     try:
-        # 使用tokenizer的chat template（如果支持）
-        if hasattr(tokenizer, 'apply_chat_template'):
-            messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
-            prompt = tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )
-        else:
-            # 手动构建prompt
-            prompt = ""
-            for msg in request.messages:
-                if msg.role == "system":
-                    prompt += f"<|im_start|>system\n{msg.content}<|im_end|>\n"
-                elif msg.role == "user":
-                    prompt += f"<|im_start|>user\n{msg.content}<|im_end|>\n"
-                elif msg.role == "assistant":
-                    prompt += f"<|im_start|>assistant\n{msg.content}<|im_end|>\n"
-            prompt += "<|im_start|>assistant\n"
-        
-        # Tokenize
-        inputs = tokenizer(prompt, return_tensors="pt")
-        input_token_count = inputs['input_ids'].shape[1]
-        
-        # 处理停止词
-        stop_sequences = []
-        if request.stop:
-            if isinstance(request.stop, str):
-                stop_sequences = [request.stop]
-            else:
-                stop_sequences = request.stop
+        deadline = deadline_for(request, raw_request)
+        served = await registry.acquire(model_name)
+        tokenizer = served.tokenizer
+        prompt_token_ids = chat_token_ids(tokenizer, request.messages)
+        input_token_count = len(prompt_token_ids)
+        req_metrics.tokenized()
+        params = chat_sampling_params(request, deadline)
+        params.validate()
+        if request.stream and params.num_sequences > params.n:
+            raise ValueError("流式输出不支持 best_of > n")
+        if request.session_id is not None and params.num_sequences > 1:
+            raise ValueError("session_id 不支持多个候选（n / best_of > 1）")
+        cache_key = response_cache_key(model_name, prompt_token_ids, params)
+        # 按 prompt + 生成上限预扣租户的 token 额度，结束后退还未用完的部分
+        rate_headers = rate_limiter.check(tenant.name, request_cost(prompt_token_ids, params))
+        reserved_tokens = params.max_tokens * params.num_sequences
         
-        # 流式输出
+        # 流式输出：命中缓存直接回放；否则先排队获取名额，名额在流结束时归还
         if request.stream:
-            return StreamingResponse(
+            cached = await response_cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                req_metrics.finished(cached["finish_reason"], cached["prompt_tokens"], cached["completion_tokens"])
+                rate_limiter.refund(tenant.name, reserved_tokens - cached["completion_tokens"])
+                return StreamingResponse(
+                    replay_cached_stream(cached, model_name),
+                    media_type="text/event-stream",
+                    headers=rate_headers,
+                )
+            req_metrics.queue_started()
+            try:
+                grant = await served.admission.acquire(
+                    tenant, request_cost(prompt_token_ids, params), deadline=params.deadline,
+                    prompt_tokens=input_token_count, max_tokens=params.max_tokens,
+                )
+            except BaseException:
+                rate_limiter.refund(tenant.name, reserved_tokens)
+                raise
+            req_metrics.admitted()
+            streaming_response = StreamingResponse(
                 stream_chat_completions(
-                    inputs=inputs,
-                    max_new_tokens=request.max_tokens,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                    stop_sequences=stop_sequences,
-                    model_name=request.model or config.MODEL_NAME,
-                    input_token_count=input_token_count
+                    served=served,
+                    prompt_token_ids=prompt_token_ids,
+                    params=params,
+                    model_name=model_name,
+                    grant=grant,
+                    raw_request=raw_request,
+                    req_metrics=req_metrics,
+                    cache_key=cache_key,
+                    session_id=request.session_id,
                 ),
-                media_type="text/event-stream"
+                media_type="text/event-stream",
+                headers=rate_headers,
             )
+            served = None
+            return streaming_response
         
-        # 非流式输出
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=request.max_tokens,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-            )
-        
-        # 解码
-        generated_text = tokenizer.decode(
-            outputs[0][input_token_count:],
-            skip_special_tokens=True
+        # 非流式输出：由引擎与其他请求合并批处理，命中停止词或达到长度后立即结束
+        result = await collect_generation(
+            served, tenant, prompt_token_ids, params, req_metrics, cache_key, request.session_id
         )
-        
-        # 处理停止词
-        if stop_sequences:
-            for stop_seq in stop_sequences:
-                if stop_seq in generated_text:
-                    generated_text = generated_text[:generated_text.index(stop_seq)]
-                    break
-        
-        # 统计输出 tokens
-        output_token_count = len(tokenizer.encode(generated_text, add_special_tokens=False))
+        response.headers.update(rate_headers)
         
         # 返回 OpenAI 兼容格式
-        return {
-            "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": request.model or config.MODEL_NAME,
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": generated_text
-                },
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": input_token_count,
-                "completion_tokens": output_token_count,
-                "total_tokens": input_token_count + output_token_count
-            }
-        }
+        return chat_completion_response(
+            dict(result, prompt_tokens=input_token_count), model_name
+        )
+    except RateLimitError as e:
+        req_metrics.error(metrics.ERROR_RATE_LIMITED)
+        raise rate_limited_exception(e)
+    except OverloadedError as e:
+        req_metrics.error(metrics.ERROR_OVERLOADED)
+        raise overloaded_exception(e)
+    except ValueError as e:
+        req_metrics.error(metrics.ERROR_INVALID_REQUEST)
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
         logger.error(f"聊天生成失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if served is not None:
+            registry.release(served)
 
 
 async def stream_chat_completions(
-    inputs,
-    max_new_tokens: int,
-    temperature: float,
-    top_p: float,
-    stop_sequences: List[str],
+    served: LoadedModel,
+    prompt_token_ids: List[int],
+    params: SamplingParams,
     model_name: str,
-    input_token_count: int
+    grant: Grant,
+    raw_request: Request,
+    req_metrics: metrics.RequestMetrics,
+    cache_key: Optional[str] = None,
+    session_id: Optional[str] = None,
 ):
-    """流式生成聊天响应（OpenAI 兼容）"""
+    """流式生成聊天响应（OpenAI 兼容），结束时归还准入名额、退还未用完的 token 额度并释放模型引用"""
+    generated_tokens = 0
+    prefill_seconds = None
     try:
-        streamer = TextIteratorStreamer(
-            tokenizer,
-            skip_prompt=True,
-            skip_special_tokens=True
+        request_id = uuid.uuid4().hex
+        encoder = sse.ChatStreamEncoder(
+            f"chatcmpl-{request_id[:8]}", int(time.time()), model_name,
+            coalesce_seconds=config.SSE_CONFIG["coalesce_ms"] / 1000,
+            coalesce_bytes=config.SSE_CONFIG["coalesce_bytes"],
         )
+        text = ""
+        # 每个候选结束时的 (finish_reason, completion_tokens)
+        finished = {}
+        disconnected = sse.DisconnectCheck(raw_request, config.SSE_CONFIG["disconnect_check_ms"] / 1000)
         
-        generation_kwargs = {
-            **inputs,
-            "max_new_tokens": max_new_tokens,
-            "temperature": temperature,
-            "top_p": top_p,
-            "do_sample": True,
-            "pad_token_id": tokenizer.eos_token_id,
-            "streamer": streamer,
-        }
-        
-        # 在后台线程中生成
-        thread = Thread(target=model.generate, kwargs=generation_kwargs)
-        thread.start()
-        
-        chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
-        created_time = int(time.time())
-        
-        # 流式返回
-        for text in streamer:
-            # 检查停止词
-            should_stop = False
-            for stop_seq in stop_sequences:
-                if stop_seq in text:
-                    text = text[:text.index(stop_seq)]
-                    should_stop = True
-                    break
-            
-            chunk = {
-                "id": chunk_id,
-                "object": "chat.completion.chunk",
-                "created": created_time,
-                "model": model_name,
-                "choices": [{
-                    "index": 0,
-                    "delta": {
-                        "role": "assistant",
-                        "content": text
-                    },
-                    "finish_reason": None
-                }]
-            }
-            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-            
-            if should_stop:
-                break
-        
-        # 发送结束标记
-        final_chunk = {
-            "id": chunk_id,
-            "object": "chat.completion.chunk",
-            "created": created_time,
-            "model": model_name,
-            "choices": [{
-                "index": 0,
-                "delta": {},
-                "finish_reason": "stop"
-            }]
-        }
-        yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
-        yield "data: [DONE]\n\n"
-        
-        thread.join()
+        # 流式返回：引擎每 decode 一步推送一次增量文本（按配置合并后发送），多个候选的 chunk 按 index 区分
+        engine = served.engine
+        async for output in engine.generate(prompt_token_ids, params, request_id, session_id):
+            # 客户端断开后取消生成，释放 batch 名额（按间隔检查，不在每个 token 上轮询连接）
+            if await disconnected():
+                logger.info(f"客户端已断开，取消生成: {request_id}")
+                engine.abort(request_id)
+                req_metrics.error(metrics.ERROR_CANCELLED)
+                return
+            generated_tokens += len(output.token_ids)
+            if output.index == 0:
+                req_metrics.tokens(len(output.token_ids), output.prefill_time)
+                prefill_seconds = output.prefill_time
+                text += output.text
+            encoder.add_content(output.text, output.index)
+            if output.finished:
+                finished[output.index] = (output.finish_reason, output.completion_tokens)
+                usage = None
+                if len(finished) == params.n:
+                    # 最后一个候选结束：汇总所有候选的 usage
+                    completion_tokens = sum(tokens for _, tokens in finished.values())
+                    usage = sse.usage_dict(output.prompt_tokens, completion_tokens)
+                    req_metrics.finished(finished[0][0], output.prompt_tokens, completion_tokens)
+                    cache_result(cache_key, {
+                        "text": text,
+                        "finish_reason": finished[0][0],
+                        "prompt_tokens": output.prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                    }, params)
+                # 发送结束标记
+                encoder.add_finish(output.finish_reason, usage, output.index)
+            data = encoder.poll()
+            if data:
+                yield data
+        yield encoder.finish_stream()
         
+    except asyncio.CancelledError:
+        # 客户端断开时服务器可能直接取消该生成器，引擎随之中止请求
+        req_metrics.error(metrics.ERROR_CANCELLED)
+        raise
     except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
         logger.error(f"流式生成失败: {str(e)}")
-        error_chunk = {
-            "error": {
-                "message": str(e),
-                "type": "server_error",
-                "code": 500
-            }
-        }
-        yield f"data: {json.dumps(error_chunk)}\n\n"
+        yield sse.error_event(str(e))
+    finally:
+        served.admission.release(grant, generated_tokens // params.num_sequences, prefill_seconds)
+        rate_limiter.refund(grant.tenant.name, params.max_tokens * params.num_sequences - generated_tokens)
+        registry.release(served)
+
+
+async def replay_cached_stream(cached: dict, model_name: str):
+    """以 SSE 流的形式回放缓存的结果"""
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created_time = int(time.time())
+    if cached["text"]:
+        yield sse.chat_chunk(chunk_id, created_time, model_name, content=cached["text"])
+    yield sse.chat_chunk(
+        chunk_id, created_time, model_name,
+        finish_reason=cached["finish_reason"],
+        usage=sse.usage_dict(cached["prompt_tokens"], cached["completion_tokens"]),
+    )
+    yield sse.DONE_EVENT
+
+
+@app.post("/v1/completions")
+async def completions(request: CompletionRequest, raw_request: Request, response: Response):
+    """OpenAI 兼容的文本补全接口：prompt 可为列表，各 prompt 由引擎按长度分组批量 prefill"""
+    model_name = resolve_model(request.model)
+    tenant = rate_limiter.resolve(request.user, raw_request.headers.get("authorization"))
+    req_metrics = metrics.RequestMetrics(model_name, "/v1/completions")
+    served = None
+    try:
+        if request.stream:
+            raise ValueError("/v1/completions 暂不支持流式输出，流式请使用 /v1/chat/completions")
+        prompts = prompt_list(request.prompt)
+        params = chat_sampling_params(request, deadline_for(request, raw_request))
+        params.validate()
+        served = await registry.acquire(model_name)
+        prompts_token_ids = [get_prompt_builder(served.tokenizer).token_ids(prompt) for prompt in prompts]
+        req_metrics.tokenized()
+        cost = sum(request_cost(prompt_token_ids, params) for prompt_token_ids in prompts_token_ids)
+        response.headers.update(rate_limiter.check(tenant.name, cost))
+
+        results = await collect_generations(served, tenant, prompts_token_ids, params, model_name, "/v1/completions")
+        return completion_response(results, model_name, params.n)
+    except RateLimitError as e:
+        req_metrics.error(metrics.ERROR_RATE_LIMITED)
+        raise rate_limited_exception(e)
+    except OverloadedError as e:
+        req_metrics.error(metrics.ERROR_OVERLOADED)
+        raise overloaded_exception(e)
+    except ValueError as e:
+        req_metrics.error(metrics.ERROR_INVALID_REQUEST)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        req_metrics.error(metrics.ERROR_INTERNAL)
+        logger.error(f"文本补全失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if served is not None:
+            registry.release(served)
+
+
+@app.post("/v1/files")
+async def upload_file(file: UploadFile = File(...), purpose: str = Form("batch")):
+    """上传批处理输入文件（JSONL）"""
+    if batch_manager is None:
+        raise HTTPException(status_code=503, detail="模型未加载")
+    if purpose != "batch":
+        raise HTTPException(status_code=400, detail=f"不支持的 purpose: {purpose}")
+    # 上传文件可能有几十万行，在线程池中写入磁盘
+    return await asyncio.get_running_loop().run_in_executor(
+        None, batch_manager.create_file, file.file, file.filename or "input.jsonl", purpose
+    )
+
+
+@app.get("/v1/files/{file_id}")
+async def get_file(file_id: str):
+    meta = batch_manager.get_file(file_id) if batch_manager is not None else None
+    if meta is None:
+        raise HTTPException(status_code=404, detail=f"文件不存在: {file_id}")
+    return meta
+
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str):
+    """下载文件内容（批处理结果在任务运行中即可下载已完成的部分）"""
+    meta = batch_manager.get_file(file_id) if batch_manager is not None else None
+    if meta is None:
+        raise HTTPException(status_code=404, detail=f"文件不存在: {file_id}")
+    return FileResponse(batch_manager.file_path(file_id), media_type="application/jsonl", filename=meta["filename"])
+
+
+@app.post("/v1/batches")
+async def create_batch(request: BatchRequest):
+    """创建离线批处理任务，按顺序在后台执行"""
+    if batch_manager is None:
+        raise HTTPException(status_code=503, detail="模型未加载")
+    try:
+        return await batch_manager.create_batch(
+            request.input_file_id, request.endpoint, request.completion_window, request.metadata
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/v1/batches")
+async def list_batches(limit: int = 20):
+    if batch_manager is None:
+        raise HTTPException(status_code=503, detail="模型未加载")
+    batches = batch_manager.list_batches(limit)
+    return {"object": "list", "data": batches, "has_more": False}
+
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    batch = batch_manager.get_batch(batch_id) if batch_manager is not None else None
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"批处理任务不存在: {batch_id}")
+    return batch
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    batch = batch_manager.cancel_batch(batch_id) if batch_manager is not None else None
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"批处理任务不存在: {batch_id}")
+    return batch
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+"""
+Prometheus 监控指标 - GPU / CPU 两个服务共用同一套指标名
+- 请求级：排队、分词（含 chat 模板）、prefill、首 token、token 间隔、总耗时的直方图，token 计数，按类型的错误数
+- 服务级：运行中 / 等待中的序列数、排队深度、缓存命中（按模型），在每次抓取 /metrics 时从各组件的 stats() 读取
+- 启动：模型加载各阶段（读权重、量化、预热等）的耗时
+"""
+import time
+from typing import Callable, Dict, Optional
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+LABELS = ["model", "endpoint"]
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.06, 0.08, 0.1, 0.15, 0.2, 0.3, 0.5, 1, 2.5)
+THROUGHPUT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+QUEUE_WAIT = Histogram("llm_queue_wait_seconds", "请求排队等待时间", LABELS, buckets=LATENCY_BUCKETS)
+TOKENIZE = Histogram("llm_tokenize_seconds", "chat 模板渲染与分词耗时", LABELS, buckets=LATENCY_BUCKETS)
+PREFILL = Histogram("llm_prefill_seconds", "prefill 耗时（开始调度到产生第一个 token）", LABELS, buckets=LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "首 token 延迟", LABELS, buckets=LATENCY_BUCKETS)
+INTER_TOKEN_LATENCY = Histogram("llm_inter_token_latency_seconds", "token 间隔", LABELS, buckets=TOKEN_LATENCY_BUCKETS)
+REQUEST_LATENCY = Histogram("llm_request_latency_seconds", "请求总耗时", LABELS, buckets=LATENCY_BUCKETS)
+DECODE_THROUGHPUT = Histogram(
+    "llm_decode_tokens_per_second", "单个请求 decode 阶段的生成速度", LABELS, buckets=THROUGHPUT_BUCKETS
+)
+
+REQUESTS = Counter("llm_requests", "请求数（按结束原因）", LABELS + ["finish_reason"])
+PROMPT_TOKENS = Counter("llm_prompt_tokens", "prompt token 数", LABELS)
+COMPLETION_TOKENS = Counter("llm_completion_tokens", "生成 token 数", LABELS)
+ERRORS = Counter("llm_errors", "错误数（按类型）", LABELS + ["error_type"])
+
+# 错误类型
+ERROR_OVERLOADED = "overloaded"
+ERROR_RATE_LIMITED = "rate_limited"
+ERROR_INVALID_REQUEST = "invalid_request"
+ERROR_CANCELLED = "cancelled"
+ERROR_INTERNAL = "internal"
+
+
+class RequestMetrics:
+    """单个请求的计时与计数，在请求处理的各阶段调用对应方法"""
+
+    def __init__(self, model: str, endpoint: str):
+        self.labels = (model, endpoint)
+        self.start = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+        self.last_token_time: Optional[float] = None
+        self._queue_start: Optional[float] = None
+
+    def tokenized(self) -> None:
+        """分词完成（请求开始即进入分词阶段）"""
+        TOKENIZE.labels(*self.labels).observe(time.perf_counter() - self.start)
+
+    def queue_started(self) -> None:
+        self._queue_start = time.perf_counter()
+
+    def admitted(self) -> None:
+        if self._queue_start is not None:
+            QUEUE_WAIT.labels(*self.labels).observe(time.perf_counter() - self._queue_start)
+
+    def tokens(self, count: int, prefill_time: Optional[float] = None) -> None:
+        """收到 count 个新 token；同一次输出中的多个 token 平分间隔"""
+        if count <= 0:
+            return
+        now = time.perf_counter()
+        if self.first_token_time is None:
+            self.first_token_time = now
+            TIME_TO_FIRST_TOKEN.labels(*self.labels).observe(now - self.start)
+            if prefill_time is not None:
+                PREFILL.labels(*self.labels).observe(prefill_time)
+            count -= 1
+        else:
+            interval = (now - self.last_token_time) / count
+            histogram = INTER_TOKEN_LATENCY.labels(*self.labels)
+            for _ in range(count):
+                histogram.observe(interval)
+        self.last_token_time = now
+
+    def finished(self, finish_reason: str, prompt_tokens: int, completion_tokens: int) -> None:
+        now = time.perf_counter()
+        REQUEST_LATENCY.labels(*self.labels).observe(now - self.start)
+        REQUESTS.labels(*self.labels, finish_reason or "unknown").inc()
+        PROMPT_TOKENS.labels(*self.labels).inc(prompt_tokens)
+        COMPLETION_TOKENS.labels(*self.labels).inc(completion_tokens)
+        if self.first_token_time is not None and completion_tokens > 1 and now > self.first_token_time:
+            DECODE_THROUGHPUT.labels(*self.labels).observe((completion_tokens - 1) / (now - self.first_token_time))
+
+    def error(self, error_type: str) -> None:
+        ERRORS.labels(*self.labels, error_type).inc()
+
+
+class StatsCollector:
+    """
+    抓取时读取服务状态，stats_fn 返回 {模型名: 该模型的状态}，每个模型的状态为:
+        {"running": int, "waiting": int, "queue_depth": int,
+         "cache": {缓存名: {"hits": int, "misses": int}},
+         "speculative": {"proposed": int, "accepted": int},  # 可选，启用投机解码时提供
+         "startup": {阶段名: 秒}}  # 可选，模型加载各阶段耗时
+    """
+
+    def __init__(self, stats_fn: Callable[[], Dict[str, Dict]]):
+        self.stats_fn = stats_fn
+
+    def describe(self):
+        # 注册时不调用 collect()，服务启动前组件可能尚未初始化
+        return []
+
+    def collect(self):
+        all_stats = self.stats_fn()
+        for metric, key, doc in (
+            ("llm_running_sequences", "running", "运行中的序列数"),
+            ("llm_waiting_sequences", "waiting", "引擎内等待调度的序列数"),
+            ("llm_queue_depth", "queue_depth", "准入队列中排队的请求数"),
+        ):
+            gauge = GaugeMetricFamily(metric, doc, labels=["model"])
+            for model, stats in all_stats.items():
+                gauge.add_metric([model], stats.get(key, 0))
+            yield gauge
+
+        hits = CounterMetricFamily("llm_cache_hits", "缓存命中次数", labels=["model", "cache"])
+        misses = CounterMetricFamily("llm_cache_misses", "缓存未命中次数", labels=["model", "cache"])
+        for model, stats in all_stats.items():
+            for cache, values in stats.get("cache", {}).items():
+                hits.add_metric([model, cache], values.get("hits", 0))
+                misses.add_metric([model, cache], values.get("misses", 0))
+        yield hits
+        yield misses
+
+        for metric, key, doc in (
+            ("llm_spec_draft_tokens", "proposed", "投机解码草稿模型提议的 token 数"),
+            ("llm_spec_accepted_tokens", "accepted", "投机解码被主模型接受的 token 数"),
+        ):
+            counter = CounterMetricFamily(metric, doc, labels=["model"])
+            for model, stats in all_stats.items():
+                if stats.get("speculative") is not None:
+                    counter.add_metric([model], stats["speculative"][key])
+            if counter.samples:
+                yield counter
+
+        startup = GaugeMetricFamily("llm_startup_phase_seconds", "模型加载各阶段耗时", labels=["model", "phase"])
+        for model, stats in all_stats.items():
+            for phase, seconds in stats.get("startup", {}).items():
+                startup.add_metric([model, phase], seconds)
+        if startup.samples:
+            yield startup
+
+
+def register_stats(model: str, stats_fn: Callable[[], Dict]) -> None:
+    """单模型服务：stats_fn 返回该模型的状态"""
+    REGISTRY.register(StatsCollector(lambda: {model: stats_fn()}))
+
+
+def register_model_stats(stats_fn: Callable[[], Dict[str, Dict]]) -> None:
+    """多模型服务：stats_fn 返回 {模型名: 状态}"""
+    REGISTRY.register(StatsCollector(stats_fn))
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,111 @@
+"""
+CPU 模型加载与推理引擎构建（单进程服务与多进程 worker 共用）
+"""
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import config
+import quantization
+from batch_engine import ContinuousBatchingEngine
+from prefix_cache import PrefixCache
+from session_cache import SessionCache
+from weight_cache import WeightCache
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def _phase(timings: Optional[Dict[str, float]], name: str):
+    """累计启动阶段耗时（秒）到 timings"""
+    start = time.perf_counter()
+    yield
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def load_tokenizer(model_path: str = config.MODEL_PATH):
+    return AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+
+
+def load_model(
+    model_path: str = config.MODEL_PATH,
+    precision: str = config.CPU_PRECISION_CONFIG["mode"],
+    int4_group_size: int = config.CPU_PRECISION_CONFIG["int4_group_size"],
+    timings: Optional[Dict[str, float]] = None,
+):
+    """
+    按精度模式加载 CPU 模型，各阶段耗时累计到 timings（weights / quantize / cache_write）
+    配置了权重缓存时优先从缓存 mmap 加载，未命中则转换后写入缓存供下次启动使用
+    low_cpu_mem_usage 下 safetensors 权重以 mmap 方式读取，dtype 与文件一致时不会复制，
+    多个进程加载同一文件可共享操作系统页缓存（量化模式会生成新的权重，不再共享）
+    """
+    cache_dir = config.STARTUP_CONFIG["weight_cache_dir"]
+    cache = WeightCache(cache_dir) if cache_dir else None
+    with _phase(timings, "weights"):
+        model = cache.load(model_path, precision, int4_group_size) if cache is not None else None
+    if model is None:
+        with _phase(timings, "weights"):
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                torch_dtype=quantization.LOAD_DTYPES[precision],
+                device_map="cpu",
+                trust_remote_code=True,
+                low_cpu_mem_usage=True,  # 低内存模式
+            )
+        # int8 的打包权重无法 mmap，缓存量化前的权重
+        if cache is not None and precision == "int8":
+            with _phase(timings, "cache_write"):
+                cache.save(model, model_path, precision, int4_group_size)
+        with _phase(timings, "quantize"):
+            model = quantization.apply_precision(model, precision, int4_group_size)
+        if cache is not None and precision != "int8":
+            with _phase(timings, "cache_write"):
+                cache.save(model, model_path, precision, int4_group_size)
+    elif precision == "int8":
+        with _phase(timings, "quantize"):
+            model = quantization.apply_precision(model, precision, int4_group_size)
+    logger.info(f"模型精度: {quantization.precision_info(model, precision)}")
+    return model
+
+
+def load_draft_model(timings: Optional[Dict[str, float]] = None):
+    """加载投机解码的草稿模型（与主模型使用相同精度），未配置时返回 None；耗时记为 timings["draft"]"""
+    draft_model_path = config.SPECULATIVE_CONFIG["draft_model_path"]
+    if not draft_model_path:
+        return None
+    logger.info(f"正在加载草稿模型: {draft_model_path}")
+    with _phase(timings, "draft"):
+        return load_model(draft_model_path)
+
+
+def build_engine(model, tokenizer, draft_model=None) -> ContinuousBatchingEngine:
+    """按 config 构建连续批处理引擎（含可选的前缀缓存、会话缓存与投机解码）"""
+    prefix_cache = None
+    if config.PREFIX_CACHE_CONFIG["enabled"]:
+        prefix_cache = PrefixCache(
+            max_bytes=config.PREFIX_CACHE_CONFIG["max_memory_mb"] * 1024 * 1024,
+            min_match_tokens=config.PREFIX_CACHE_CONFIG["min_match_tokens"],
+        )
+    session_cache = None
+    session_config = config.SESSION_CACHE_CONFIG
+    if session_config["enabled"]:
+        session_cache = SessionCache(
+            max_bytes=session_config["max_memory_mb"] * 1024 * 1024,
+            spill_dir=session_config["spill_dir"],
+            max_disk_bytes=session_config["max_disk_mb"] * 1024 * 1024,
+            idle_seconds=session_config["idle_seconds"],
+            ttl_seconds=session_config["ttl_seconds"],
+        )
+    return ContinuousBatchingEngine(
+        model,
+        tokenizer,
+        prefix_cache=prefix_cache,
+        session_cache=session_cache,
+        draft_model=draft_model,
+        num_speculative_tokens=config.SPECULATIVE_CONFIG["num_speculative_tokens"],
+        **config.CPU_ENGINE_CONFIG,
+    )
@@ -0,0 +1,271 @@
+"""
+多模型注册表（CPU 服务）- 按请求的 model 名称路由到不同的模型
+- 模型在首次被请求时加载，已加载模型的权重总内存超过预算时按 LRU 卸载
+- 请求处理期间持有模型引用（pin），正在使用的模型不会被卸载
+- 分词器与权重分开管理：分词器很小，加载后常驻，批处理等场景可以只分词不加载权重
+- 加载后先预热再对外可用，各阶段耗时记录在 LoadedModel.startup 中
+"""
+import asyncio
+import gc
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from admission import AdmissionController, OverloadedError
+
+logger = logging.getLogger(__name__)
+
+WEIGHT_FILE_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth")
+
+
+class ModelNotFoundError(KeyError):
+    """请求的模型未注册"""
+
+
+def parse_model_specs(specs: str, default_name: str, default_path: str) -> Dict[str, str]:
+    """
+    解析 "名称=路径;名称=路径"，默认模型总是注册在第一个
+    格式错误或名称重复时抛出 ValueError
+    """
+    models = {default_name: default_path}
+    for part in specs.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, path = part.partition("=")
+        name, path = name.strip(), path.strip()
+        if not sep or not name or not path:
+            raise ValueError(f"模型配置格式错误: {part!r}，应为 名称=路径")
+        if name in models and models[name] != path:
+            raise ValueError(f"模型名称重复: {name}")
+        models[name] = path
+    return models
+
+
+def estimate_weight_bytes(model_path: str) -> int:
+    """按权重文件大小估算加载后的内存（加载前用于腾出空间，加载后以实际值为准）"""
+    if not os.path.isdir(model_path):
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(model_path, name))
+        for name in os.listdir(model_path)
+        if name.endswith(WEIGHT_FILE_SUFFIXES)
+    )
+
+
+@dataclass
+class LoadedModel:
+    """一个已加载的模型及其推理引擎"""
+    name: str
+    path: str
+    engine: Any
+    tokenizer: Any
+    admission: AdmissionController
+    memory_bytes: int
+    info: Dict = field(default_factory=dict)
+    startup: Dict[str, float] = field(default_factory=dict)  # 加载各阶段耗时（秒）
+    loaded_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.monotonic)
+    refs: int = 0  # 正在使用该模型的请求数
+
+    def stats(self) -> Dict:
+        return {
+            "memory_mb": round(self.memory_bytes / 1024 / 1024, 1),
+            "in_use": self.refs,
+            "loaded_at": int(self.loaded_at),
+            **self.info,
+            "startup_seconds": {phase: round(seconds, 3) for phase, seconds in self.startup.items()},
+            "engine": self.engine.stats(),
+            "queue": self.admission.stats(),
+        }
+
+
+class ModelRegistry:
+    """
+    在事件循环中使用
+    load_tokenizer(name, path) -> tokenizer
+    load_engine(name, path, tokenizer) -> (未启动的引擎, 权重内存字节数, 附加信息)，在线程池中执行；
+        附加信息中的 "startup" 为加载内部各阶段耗时
+    make_admission() -> 该模型引擎的准入队列
+    warm_up(model) -> 引擎启动后、对外可用前执行的预热（可选）
+    """
+
+    def __init__(
+        self,
+        models: Dict[str, str],
+        default_model: str,
+        load_tokenizer: Callable[[str, str], Any],
+        load_engine: Callable[[str, str, Any], Tuple[Any, int, Dict]],
+        make_admission: Callable[[], AdmissionController],
+        memory_budget_bytes: int = 0,
+        warm_up: Optional[Callable[[LoadedModel], Awaitable[None]]] = None,
+    ):
+        self.models = models
+        self.default_model = default_model
+        self.memory_budget_bytes = memory_budget_bytes
+        self._load_tokenizer = load_tokenizer
+        self._load_engine = load_engine
+        self._make_admission = make_admission
+        self._warm_up = warm_up
+
+        self._tokenizers: Dict[str, Any] = {}
+        self._loaded: Dict[str, LoadedModel] = {}
+        self._locks: Dict[str, asyncio.Lock] = {name: asyncio.Lock() for name in models}
+        self.loads_total = 0
+        self.evictions_total = 0
+
+    def resolve(self, name: Optional[str]) -> str:
+        """请求中的模型名 -> 注册名，未指定时使用默认模型"""
+        if not name:
+            return self.default_model
+        if name not in self.models:
+            raise ModelNotFoundError(name)
+        return name
+
+    def tokenizer(self, name: str):
+        tokenizer = self._tokenizers.get(name)
+        if tokenizer is None:
+            tokenizer = self._tokenizers[name] = self._load_tokenizer(name, self.models[name])
+        return tokenizer
+
+    def get_loaded(self, name: str) -> Optional[LoadedModel]:
+        return self._loaded.get(name)
+
+    def loaded(self) -> List[LoadedModel]:
+        return list(self._loaded.values())
+
+    @property
+    def loaded_bytes(self) -> int:
+        return sum(m.memory_bytes for m in self._loaded.values())
+
+    async def acquire(self, name: str) -> LoadedModel:
+        """取得模型（需要时加载）并持有引用，用完必须调用 release()"""
+        model = self._loaded.get(name)
+        if model is None:
+            async with self._locks[name]:
+                # 等锁期间可能已被其他请求加载
+                model = self._loaded.get(name)
+                if model is None:
+                    model = await self._load(name)
+        model.refs += 1
+        model.last_used = time.monotonic()
+        return model
+
+    def release(self, model: LoadedModel) -> None:
+        model.refs -= 1
+        model.last_used = time.monotonic()
+        # 之前因模型都在使用中而暂时超出预算，有模型空闲后补做卸载
+        if 0 < self.memory_budget_bytes < self.loaded_bytes and any(
+            m.refs == 0 and m is not model for m in self._loaded.values()
+        ):
+            self._make_room(0, exclude=model.name)
+
+    async def _load(self, name: str) -> LoadedModel:
+        path = self.models[name]
+        self._make_room(estimate_weight_bytes(path), exclude=name)
+        logger.info(f"正在加载模型 {name}: {path}")
+        start = time.perf_counter()
+        timings: Dict[str, float] = {}
+        loop = asyncio.get_running_loop()
+
+        phase_start = time.perf_counter()
+        tokenizer = await loop.run_in_executor(None, self.tokenizer, name)
+        timings["tokenizer"] = time.perf_counter() - phase_start
+
+        phase_start = time.perf_counter()
+        engine, memory_bytes, info = await loop.run_in_executor(None, self._load_engine, name, path, tokenizer)
+        loader_timings = info.pop("startup", {})
+        timings.update(loader_timings)
+        # 加载耗时中未单独统计的部分（构建引擎、fork worker 等）
+        timings["engine_build"] = max(0.0, time.perf_counter() - phase_start - sum(loader_timings.values()))
+
+        # 引擎在事件循环中启动（假引擎需要事件循环）
+        phase_start = time.perf_counter()
+        engine.start()
+        timings["engine_start"] = time.perf_counter() - phase_start
+
+        model = LoadedModel(name, path, engine, tokenizer, self._make_admission(), memory_bytes, info, timings)
+        if self._warm_up is not None:
+            phase_start = time.perf_counter()
+            try:
+                await self._warm_up(model)
+            except BaseException:
+                engine.stop()
+                raise
+            timings["warmup"] = time.perf_counter() - phase_start
+        timings["total"] = time.perf_counter() - start
+
+        self._loaded[name] = model
+        self.loads_total += 1
+        logger.info(
+            f"✅ 模型 {name} 加载完成，耗时 {timings['total']:.1f}s"
+            f"（{', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in timings.items() if phase != 'total')}），"
+            f"权重 {memory_bytes / 1024 / 1024:.0f}MB，已加载 {len(self._loaded)} 个模型"
+        )
+        # 实际占用可能与估算不同，加载后再检查一次（新模型本身不会被卸载）
+        self._make_room(0, exclude=name)
+        return model
+
+    def _make_room(self, needed_bytes: int, exclude: str) -> None:
+        """按最久未使用的顺序卸载空闲模型，直到放得下 needed_bytes；正在使用的模型不卸载"""
+        if self.memory_budget_bytes <= 0:
+            return
+        while self.loaded_bytes + needed_bytes > self.memory_budget_bytes:
+            others = [m for m in self._loaded.values() if m.name != exclude]
+            idle = [m for m in others if m.refs == 0]
+            if idle:
+                self.unload(min(idle, key=lambda m: m.last_used).name)
+                self.evictions_total += 1
+                continue
+            if needed_bytes == 0 or not others:
+                # 新模型已经加载（或单个模型就超出预算），只能暂时超出，等其他模型空闲后再卸载
+                logger.warning(f"已加载模型共 {self.loaded_bytes / 1024 / 1024:.0f}MB，超出内存预算")
+                return
+            raise OverloadedError(
+                f"内存预算不足以加载模型 {exclude}：已加载的模型都在使用中",
+                retry_after=max(m.admission.estimate_retry_after() for m in others),
+            )
+
+    def unload(self, name: str) -> None:
+        model = self._loaded.pop(name, None)
+        if model is None:
+            return
+        model.engine.stop()
+        del model
+        gc.collect()
+        logger.info(f"已卸载模型 {name}，已加载 {len(self._loaded)} 个模型")
+
+    def stop(self) -> None:
+        for name in list(self._loaded):
+            self.unload(name)
+
+    def list_models(self) -> List[Dict]:
+        """OpenAI /v1/models 格式，附带加载状态"""
+        data = []
+        for name, path in self.models.items():
+            model = self._loaded.get(name)
+            entry = {
+                "id": name,
+                "object": "model",
+                "created": int(model.loaded_at) if model is not None else 0,
+                "owned_by": "local",
+                "loaded": model is not None,
+                "default": name == self.default_model,
+            }
+            if model is not None:
+                entry["memory_mb"] = round(model.memory_bytes / 1024 / 1024, 1)
+                entry["in_use"] = model.refs
+            data.append(entry)
+        return data
+
+    def stats(self) -> Dict:
+        return {
+            "registered": list(self.models),
+            "loaded": {name: model.stats() for name, model in self._loaded.items()},
+            "memory_budget_mb": round(self.memory_budget_bytes / 1024 / 1024, 1) if self.memory_budget_bytes else None,
+            "loaded_memory_mb": round(self.loaded_bytes / 1024 / 1024, 1),
+            "loads_total": self.loads_total,
+            "evictions_total": self.evictions_total,
+        }
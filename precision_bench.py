@@ -0,0 +1,145 @@
+"""
+CPU 精度模式对比工具 - 比较各精度 / 量化模式的内存、速度与输出质量
+以 fp32 为基准：
+- 质量：评测文本上的困惑度、下一 token 预测与 fp32 的一致率、贪心生成与 fp32 的 token 一致率
+- 速度：prefill 延迟、decode 吞吐（tokens/s）、加载耗时
+
+用法:
+    python precision_bench.py --modes fp32,bf16,int8,int4 --threads 16
+"""
+import argparse
+import gc
+import json
+import time
+from typing import Dict, List
+
+import torch
+
+import config
+import model_loader
+import quantization
+
+EVAL_TEXTS = [
+    "人工智能是计算机科学的一个分支，它企图了解智能的实质，并生产出一种新的能以人类智能相似的方式做出反应的智能机器。",
+    "The quick brown fox jumps over the lazy dog. Machine learning models learn patterns from data and use them to make predictions.",
+    "def fibonacci(n):\n    if n < 2:\n        return n\n    return fibonacci(n - 1) + fibonacci(n - 2)\n",
+]
+GENERATION_PROMPT = "请用三句话介绍一下大语言模型的推理优化方法："
+
+
+@torch.inference_mode()
+def evaluate_logits(model, tokenizer) -> List[torch.Tensor]:
+    """返回每段评测文本的 logits（fp32），用于计算困惑度与一致率"""
+    outputs = []
+    for text in EVAL_TEXTS:
+        input_ids = torch.tensor([tokenizer(text)["input_ids"]])
+        outputs.append(model(input_ids=input_ids).logits[0].float())
+    return outputs
+
+
+def perplexity(logits_list: List[torch.Tensor], tokenizer) -> float:
+    total_nll, total_tokens = 0.0, 0
+    for logits, text in zip(logits_list, EVAL_TEXTS):
+        labels = torch.tensor(tokenizer(text)["input_ids"][1:])
+        nll = torch.nn.functional.cross_entropy(logits[:-1], labels, reduction="sum")
+        total_nll += nll.item()
+        total_tokens += len(labels)
+    return float(torch.exp(torch.tensor(total_nll / total_tokens)))
+
+
+@torch.inference_mode()
+def measure_speed(model, tokenizer, prompt_tokens: int, decode_tokens: int) -> Dict:
+    prompt_ids = tokenizer(GENERATION_PROMPT)["input_ids"]
+    prompt_ids = (prompt_ids * (prompt_tokens // len(prompt_ids) + 1))[:prompt_tokens]
+    input_ids = torch.tensor([prompt_ids])
+
+    start = time.perf_counter()
+    model(input_ids=input_ids, logits_to_keep=1)
+    prefill_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output = model.generate(
+        input_ids,
+        max_new_tokens=decode_tokens,
+        min_new_tokens=decode_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+    )
+    total_s = time.perf_counter() - start
+    decode_s = max(total_s - prefill_s, 1e-6)
+    return {
+        "prefill_ms": round(prefill_s * 1000, 1),
+        "decode_tokens_per_s": round((decode_tokens - 1) / decode_s, 2),
+        "greedy_tokens": output[0, len(prompt_ids):].tolist(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU 精度模式对比")
+    parser.add_argument("--model", default=config.MODEL_PATH, help="模型路径")
+    parser.add_argument("--modes", default="fp32,bf16,int8,int4", help="逗号分隔的精度模式，首个作为基准")
+    parser.add_argument("--int4-group-size", type=int, default=config.CPU_PRECISION_CONFIG["int4_group_size"])
+    parser.add_argument("--threads", type=int, default=0, help="torch 线程数，0 表示默认")
+    parser.add_argument("--prompt-tokens", type=int, default=512, help="测速 prompt 长度")
+    parser.add_argument("--decode-tokens", type=int, default=64, help="测速生成长度")
+    parser.add_argument("--output", default="", help="结果另存为 JSON 文件")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    for mode in modes:
+        quantization.validate_precision(mode, args.int4_group_size)
+
+    tokenizer = model_loader.load_tokenizer(args.model)
+    results = []
+    baseline = None
+    for mode in modes:
+        start = time.perf_counter()
+        model = model_loader.load_model(args.model, mode, args.int4_group_size)
+        load_s = time.perf_counter() - start
+
+        logits = evaluate_logits(model, tokenizer)
+        speed = measure_speed(model, tokenizer, args.prompt_tokens, args.decode_tokens)
+        result = {
+            **quantization.precision_info(model, mode),
+            "load_s": round(load_s, 1),
+            "perplexity": round(perplexity(logits, tokenizer), 3),
+            "prefill_ms": speed["prefill_ms"],
+            "decode_tokens_per_s": speed["decode_tokens_per_s"],
+        }
+        if baseline is None:
+            baseline = {"logits": logits, "greedy_tokens": speed["greedy_tokens"]}
+        else:
+            agree = [
+                (a.argmax(-1) == b.argmax(-1)).float().mean().item()
+                for a, b in zip(logits, baseline["logits"])
+            ]
+            result["top1_agreement"] = round(sum(agree) / len(agree), 4)
+            ref = baseline["greedy_tokens"]
+            same = next((i for i, (a, b) in enumerate(zip(speed["greedy_tokens"], ref)) if a != b), len(ref))
+            result["greedy_match_prefix"] = f"{same}/{len(ref)}"
+        results.append(result)
+        print(json.dumps(result, ensure_ascii=False))
+
+        del model
+        gc.collect()
+
+    print("\n" + "=" * 100)
+    header = f"{'mode':<6}{'memory_mb':>12}{'load_s':>9}{'prefill_ms':>12}{'decode_tok/s':>14}{'ppl':>10}{'top1_agree':>12}{'greedy_match':>14}"
+    print(header)
+    print("-" * 100)
+    for r in results:
+        print(
+            f"{r['mode']:<6}{r['memory_mb']:>12}{r['load_s']:>9}{r['prefill_ms']:>12}"
+            f"{r['decode_tokens_per_s']:>14}{r['perplexity']:>10}"
+            f"{r.get('top1_agreement', '-'):>12}{r.get('greedy_match_prefix', '-'):>14}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
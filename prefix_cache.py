@@ -0,0 +1,172 @@
+"""
+前缀 KV 缓存 - 以 token id 前缀为键的基数树（radix tree），复用公共前缀（如系统提示词）的 KV
+- 每个节点保存其边上那段 token 对应的 KV 片段，根到节点的路径拼起来就是完整前缀的 KV
+- 按字节数限制内存占用，超出时按 LRU 淘汰叶子节点
+- 只在引擎线程中访问，不需要加锁
+"""
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+# 每层一个 (key, value)，形状均为 [1, heads, seq_len, head_dim]
+KVCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def _slice_kv(kv: KVCache, start: int, end: Optional[int] = None) -> KVCache:
+    """截取时间维度 [start, end)，并复制一份以免持有整个 batch 张量的内存"""
+    return tuple((k[:, :, start:end].clone(), v[:, :, start:end].clone()) for k, v in kv)
+
+
+def _kv_nbytes(kv: KVCache) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+
+class _Node:
+    __slots__ = ("tokens", "kv", "children", "parent", "last_access", "nbytes")
+
+    def __init__(self, tokens: Tuple[int, ...], kv: Optional[KVCache], parent: Optional["_Node"]):
+        self.tokens = tokens
+        self.kv = kv
+        self.children: Dict[int, "_Node"] = {}
+        self.parent = parent
+        self.last_access = time.monotonic()
+        self.nbytes = _kv_nbytes(kv) if kv is not None else 0
+
+
+def _common_length(a: Tuple[int, ...], b: List[int], start: int) -> int:
+    n = 0
+    limit = min(len(a), len(b) - start)
+    while n < limit and a[n] == b[start + n]:
+        n += 1
+    return n
+
+
+class PrefixCache:
+    """基于基数树的前缀 KV 缓存"""
+
+    def __init__(self, max_bytes: int, min_match_tokens: int = 16):
+        self.max_bytes = max_bytes
+        self.min_match_tokens = min_match_tokens
+        self._root = _Node((), None, None)
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.lookup_tokens = 0
+        self.evictions = 0
+
+    def match(self, token_ids: List[int], max_length: Optional[int] = None) -> Tuple[int, Optional[KVCache]]:
+        """
+        查找最长的已缓存前缀
+        返回 (命中长度, 对应的 KV)；命中长度不足 min_match_tokens 时视为未命中
+        """
+        limit = len(token_ids) if max_length is None else min(max_length, len(token_ids))
+        now = time.monotonic()
+        node = self._root
+        matched = 0
+        segments = []
+        while matched < limit:
+            child = node.children.get(token_ids[matched])
+            if child is None:
+                break
+            n = min(_common_length(child.tokens, token_ids, matched), limit - matched)
+            if n == 0:
+                break
+            child.last_access = now
+            segments.append((child, n))
+            matched += n
+            if n < len(child.tokens):
+                break
+            node = child
+
+        self.lookup_tokens += len(token_ids)
+        if matched < max(self.min_match_tokens, 1):
+            self.misses += 1
+            return 0, None
+
+        self.hits += 1
+        self.hit_tokens += matched
+        num_layers = len(segments[0][0].kv)
+        kv = tuple(
+            (
+                torch.cat([seg.kv[layer][0][:, :, :n] for seg, n in segments], dim=2),
+                torch.cat([seg.kv[layer][1][:, :, :n] for seg, n in segments], dim=2),
+            )
+            for layer in range(num_layers)
+        )
+        return matched, kv
+
+    def insert(self, token_ids: List[int], kv: KVCache) -> None:
+        """插入完整序列的 KV（时间维度长度与 token_ids 一致），只保存树中尚不存在的部分"""
+        now = time.monotonic()
+        node = self._root
+        pos = 0
+        while pos < len(token_ids):
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                new_node = _Node(tuple(token_ids[pos:]), _slice_kv(kv, pos), node)
+                node.children[token_ids[pos]] = new_node
+                self.total_bytes += new_node.nbytes
+                break
+            n = _common_length(child.tokens, token_ids, pos)
+            if n < len(child.tokens):
+                self._split(child, n)
+            child.last_access = now
+            node = child
+            pos += n
+        self._evict()
+
+    def _split(self, node: _Node, length: int) -> None:
+        """把节点的边在 length 处切开：node 保留前半段，后半段成为其唯一子节点"""
+        rest = _Node(node.tokens[length:], _slice_kv(node.kv, length), node)
+        rest.children = node.children
+        rest.last_access = node.last_access
+        for child in rest.children.values():
+            child.parent = rest
+
+        self.total_bytes -= node.nbytes
+        node.tokens = node.tokens[:length]
+        node.kv = _slice_kv(node.kv, 0, length)
+        node.nbytes = _kv_nbytes(node.kv)
+        node.children = {rest.tokens[0]: rest}
+        self.total_bytes += node.nbytes + rest.nbytes
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes:
+            leaves = self._leaves()
+            if not leaves:
+                break
+            victim = min(leaves, key=lambda n: n.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self.total_bytes -= victim.nbytes
+            self.evictions += 1
+
+    def _leaves(self) -> List[_Node]:
+        leaves = []
+        stack = list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                leaves.append(node)
+        return leaves
+
+    def clear(self) -> None:
+        self._root = _Node((), None, None)
+        self.total_bytes = 0
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "hit_tokens": self.hit_tokens,
+            "token_hit_rate": round(self.hit_tokens / self.lookup_tokens, 4) if self.lookup_tokens else 0.0,
+            "evictions": self.evictions,
+            "memory_mb": round(self.total_bytes / 1024 / 1024, 2),
+            "max_memory_mb": round(self.max_bytes / 1024 / 1024, 2),
+        }
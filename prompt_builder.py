@@ -0,0 +1,166 @@
+"""
+Prompt 构建 - 把对话消息 / 文本直接转换为 token id（CPU / GPU 服务、离线批处理共用）
+- 对话按模型的 chat template 渲染（没有 template 时使用 ChatML 格式），再分段分词
+- 分词器先按特殊 token（如 <|im_start|>、<|im_end|>）切分文本，各段再独立分词，因此在特殊 token 处切开、
+  逐段分词后拼接与整体分词结果相同；每段文本的 token id 按 LRU 缓存，重复出现的系统提示词、few-shot 示例
+  与多轮对话的历史消息不再重复分词，每个请求只对新增的段分词（一次批量调用）
+- 构建时用示例对话校验分段结果与整体分词一致，不一致（如特殊 token 会吞掉相邻空白的分词器、假分词器）时退回整体分词
+- 用量（usage）直接按 token id 计数，不再对文本重新分词
+- 在线请求在事件循环中使用，离线批处理在线程池中使用：缓存的读写加锁，分词本身在锁外执行
+"""
+import logging
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 校验分段分词用的示例对话：覆盖中文、首尾空白、连续换行
+PROBE_MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant.  "},
+    {"role": "user", "content": " 你好，请介绍一下连续批处理。\n\n"},
+    {"role": "assistant", "content": "连续批处理（continuous batching）按 token 步合并请求。 "},
+    {"role": "user", "content": "\tThanks!"},
+]
+
+
+def render_chatml(messages: List[Dict[str, str]], add_generation_prompt: bool = True) -> str:
+    """没有 chat template 的分词器使用 ChatML 格式（Qwen 系列）"""
+    prompt = "".join(f"<|im_start|>{msg['role']}\n{msg['content']}<|im_end|>\n" for msg in messages)
+    return prompt + "<|im_start|>assistant\n" if add_generation_prompt else prompt
+
+
+class PromptBuilder:
+    """单个分词器的 prompt 构建与分段 token id 缓存"""
+
+    def __init__(self, tokenizer, max_cached_chars: int = 4 * 1024 * 1024):
+        self.tokenizer = tokenizer
+        self.max_cached_chars = max_cached_chars
+        self._blocks: "OrderedDict[str, List[int]]" = OrderedDict()  # 段文本 -> token id（LRU）
+        self._lock = threading.Lock()  # 保护 _blocks 与统计
+        self.cached_chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_chars = 0
+        self.lookup_chars = 0
+
+        self._special_ids: Dict[str, int] = {}
+        self._pattern: Optional[re.Pattern] = None
+        self._prefix_ids: List[int] = []
+        self._init_segments()
+
+    def _init_segments(self) -> None:
+        """按分词器的 added tokens 构造切分规则，校验失败时不分段"""
+        get_added_vocab = getattr(self.tokenizer, "get_added_vocab", None)
+        if get_added_vocab is None or self.max_cached_chars <= 0:
+            return
+        try:
+            added = get_added_vocab()
+            if not added:
+                return
+            # 长的 token 优先匹配，避免被其前缀截断
+            tokens = sorted(added, key=len, reverse=True)
+            self._special_ids = dict(added)
+            self._pattern = re.compile("(" + "|".join(re.escape(token) for token in tokens) + ")")
+            # add_special_tokens 在开头加入的 token（如 BOS），逐段分词时不加，统一放在最前面
+            self._prefix_ids = self.tokenizer("")["input_ids"]
+            probes = [self.render_chat(PROBE_MESSAGES), self.render_chat(PROBE_MESSAGES[1:]), " plain text 文本 "]
+            for text in probes:
+                if self._encode_segments(text) != self.tokenizer(text)["input_ids"]:
+                    raise ValueError("分段分词结果与整体分词不一致")
+        except Exception as e:
+            logger.info(f"prompt 分段缓存不可用，使用整体分词: {e}")
+            self._pattern = None
+        finally:
+            self._blocks.clear()
+            self.cached_chars = self.hits = self.misses = self.hit_chars = self.lookup_chars = 0
+
+    def render_chat(self, messages: List[Dict[str, str]], add_generation_prompt: bool = True) -> str:
+        """按模型的 chat template 把对话渲染为 prompt 文本"""
+        if getattr(self.tokenizer, "chat_template", None):
+            return self.tokenizer.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=add_generation_prompt
+            )
+        return render_chatml(messages, add_generation_prompt)
+
+    def chat_token_ids(self, messages: List[Dict[str, str]], add_generation_prompt: bool = True) -> List[int]:
+        return self.token_ids(self.render_chat(messages, add_generation_prompt))
+
+    def token_ids(self, text: str) -> List[int]:
+        """文本 -> token id（与 tokenizer(text)["input_ids"] 相同）"""
+        if self._pattern is None:
+            return self.tokenizer(text)["input_ids"]
+        return self._encode_segments(text)
+
+    def _encode_segments(self, text: str) -> List[int]:
+        # split 带捕获组：奇数下标为特殊 token，偶数下标为其间的普通文本（可能为空）
+        pieces = self._pattern.split(text)
+        blocks = self._blocks
+        cached: Dict[str, List[int]] = {}
+        missing: Dict[str, None] = {}  # 未缓存的段（去重、保持顺序）
+        with self._lock:
+            for piece in pieces[0::2]:
+                if not piece:
+                    continue
+                self.lookup_chars += len(piece)
+                if piece in cached:
+                    self.hits += 1
+                    self.hit_chars += len(piece)
+                elif piece in blocks:
+                    blocks.move_to_end(piece)
+                    cached[piece] = blocks[piece]
+                    self.hits += 1
+                    self.hit_chars += len(piece)
+                else:
+                    missing[piece] = None
+            self.misses += len(missing)
+        encoded = {}
+        if missing:
+            encoded = dict(zip(missing, self.tokenizer(list(missing), add_special_tokens=False)["input_ids"]))
+
+        token_ids = list(self._prefix_ids)
+        for i, piece in enumerate(pieces):
+            if i % 2:
+                token_ids.append(self._special_ids[piece])
+            elif piece:
+                token_ids.extend(cached[piece] if piece in cached else encoded[piece])
+        if encoded:
+            with self._lock:
+                for piece, ids in encoded.items():
+                    self._store(piece, ids)
+        return token_ids
+
+    def _store(self, piece: str, ids: List[int]) -> None:
+        if len(piece) > self.max_cached_chars or piece in self._blocks:
+            return
+        self._blocks[piece] = ids
+        self.cached_chars += len(piece)
+        while self.cached_chars > self.max_cached_chars:
+            evicted, _ = self._blocks.popitem(last=False)
+            self.cached_chars -= len(evicted)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "segmented": self._pattern is not None,
+                "blocks": len(self._blocks),
+                "cached_chars": self.cached_chars,
+                "hits": self.hits,
+                "misses": self.misses,
+                "char_hit_rate": round(self.hit_chars / self.lookup_chars, 4) if self.lookup_chars else 0.0,
+            }
+
+
+_builders: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_builders_lock = threading.Lock()
+
+
+def for_tokenizer(tokenizer, max_cached_chars: int = 4 * 1024 * 1024) -> PromptBuilder:
+    """每个分词器对应一个 PromptBuilder（分词器被释放时随之释放）"""
+    with _builders_lock:
+        builder = _builders.get(tokenizer)
+        if builder is None:
+            builder = _builders[tokenizer] = PromptBuilder(tokenizer, max_cached_chars)
+        return builder
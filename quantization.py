@@ -0,0 +1,147 @@
+"""
+CPU 推理精度 / 量化模式
+- fp32 / fp16 / bf16：直接以对应 dtype 加载
+- int8：线性层动态量化（权重 int8，激活运行时量化），其余部分 fp32
+- int4：线性层仅权重量化（分组非对称 int4，两个值打包进一个字节），计算时反量化为 bf16
+lm_head 不做量化，避免输出分布明显偏移
+"""
+import logging
+from typing import Dict
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+PRECISION_MODES = ("fp32", "fp16", "bf16", "int8", "int4")
+
+# 各模式加载权重时使用的 dtype；量化模式先以 bf16 低内存加载，再逐层量化
+LOAD_DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "int8": torch.bfloat16,
+    "int4": torch.bfloat16,
+}
+
+SKIP_MODULES = ("lm_head",)
+
+
+def validate_precision(mode: str, int4_group_size: int = 128) -> None:
+    """启动时校验精度配置，不可用时抛出 ValueError；可用但可能较慢时给出警告"""
+    if mode not in PRECISION_MODES:
+        raise ValueError(f"不支持的 CPU 精度模式: {mode}，可选: {', '.join(PRECISION_MODES)}")
+
+    capability = torch.backends.cpu.get_cpu_capability()
+    if mode == "fp16":
+        logger.warning("⚠️  多数 x86 CPU 没有原生 fp16 矩阵乘，fp16 通常比 bf16/fp32 更慢")
+    elif mode in ("bf16", "int4") and capability != "AVX512":
+        logger.warning(f"⚠️  当前 CPU 指令集为 {capability}，bf16 计算可能较慢，可考虑 fp32 或 int8")
+    elif mode == "int8":
+        engines = torch.backends.quantized.supported_engines
+        if not any(e in engines for e in ("x86", "fbgemm", "onednn", "qnnpack")):
+            raise ValueError(f"当前 PyTorch 不支持 int8 动态量化 (可用量化后端: {engines})")
+    if mode == "int4" and (int4_group_size <= 0 or int4_group_size % 2):
+        raise ValueError(f"int4 分组大小必须为正偶数: {int4_group_size}")
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """权重分组 int4 量化的线性层，前向时按分组反量化后做普通矩阵乘"""
+
+    def __init__(self, linear: nn.Linear, group_size: int = 128):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.group_size = group_size
+        self.compute_dtype = linear.weight.dtype
+
+        weight = linear.weight.detach().float().reshape(self.out_features, -1, group_size)
+        w_min = weight.amin(dim=-1, keepdim=True)
+        w_max = weight.amax(dim=-1, keepdim=True)
+        scales = ((w_max - w_min) / 15).clamp(min=1e-8)
+        q = ((weight - w_min) / scales).round().clamp(0, 15).to(torch.uint8)
+        q = q.reshape(self.out_features, -1)
+
+        self.register_buffer("qweight", q[:, 0::2] | (q[:, 1::2] << 4))
+        self.register_buffer("scales", scales.squeeze(-1).to(self.compute_dtype))
+        self.register_buffer("mins", w_min.squeeze(-1).to(self.compute_dtype))
+        self.bias = linear.bias
+
+    def dequantize(self) -> torch.Tensor:
+        q = torch.stack([self.qweight & 0x0F, self.qweight >> 4], dim=-1)
+        q = q.reshape(self.out_features, -1, self.group_size).to(self.compute_dtype)
+        weight = q * self.scales.unsqueeze(-1) + self.mins.unsqueeze(-1)
+        return weight.reshape(self.out_features, self.in_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return F.linear(x.to(self.compute_dtype), self.dequantize(), self.bias)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+def _replace_linears(module: nn.Module, convert) -> int:
+    """逐层替换线性层（替换后原权重即可释放，峰值内存不超过一层）"""
+    replaced = 0
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            if name in SKIP_MODULES:
+                continue
+            new_child = convert(child)
+            if new_child is not None:
+                setattr(module, name, new_child)
+                replaced += 1
+        else:
+            replaced += _replace_linears(child, convert)
+    return replaced
+
+
+def _to_int8_dynamic(linear: nn.Linear) -> nn.Module:
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from torch.ao.quantization import default_dynamic_qconfig
+
+    linear = linear.float()
+    linear.qconfig = default_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(linear)
+
+
+def apply_precision(model: nn.Module, mode: str, int4_group_size: int = 128) -> nn.Module:
+    """对已加载（LOAD_DTYPES[mode]）的模型应用量化，返回可直接推理的模型"""
+    if mode == "int8":
+        # 动态量化线性层的输入输出均为 fp32，其余模块同步转换为 fp32
+        count = _replace_linears(model, _to_int8_dynamic)
+        model.float()
+        logger.info(f"int8 动态量化完成，共量化 {count} 个线性层")
+    elif mode == "int4":
+        def convert(linear: nn.Linear):
+            if linear.in_features % int4_group_size:
+                return None
+            return Int4WeightOnlyLinear(linear, int4_group_size)
+
+        count = _replace_linears(model, convert)
+        logger.info(f"int4 仅权重量化完成，共量化 {count} 个线性层 (group_size={int4_group_size})")
+    return model
+
+
+def model_memory_bytes(model: nn.Module) -> int:
+    """模型权重实际占用的字节数（含量化后的打包权重）"""
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+    total = 0
+    seen = set()
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.data_ptr() not in seen:
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    for module in model.modules():
+        if isinstance(module, DynamicQuantizedLinear):
+            weight, bias = module._weight_bias()
+            total += weight.numel() * weight.element_size()
+            if bias is not None:
+                total += bias.numel() * bias.element_size()
+    return total
+
+
+def precision_info(model: nn.Module, mode: str) -> Dict:
+    return {"mode": mode, "memory_mb": round(model_memory_bytes(model) / 1024 / 1024, 1)}
@@ -0,0 +1,232 @@
+"""
+按租户的令牌桶限流与调度参数
+- 租户：带 API key（Authorization: Bearer）的请求按 key 确定租户、额度与优先级，user 字段不参与：
+  配置了 key 的租户取其配置，其余 key 各自为一个默认配置的租户，名称为 key 的哈希（不在日志与错误信息中暴露 key）；
+  没有 key 的请求按 user 字段区分，只能匹配未配置 key 的租户，都没有时为 anonymous
+- 每个租户两个令牌桶：请求数 / 分钟、token 数 / 分钟（prompt token + 请求的生成 token 上限），
+  准入时按上限预扣，生成结束后退还未用完的部分
+- 超限时抛出 RateLimitError，服务返回 429 并附带 OpenAI 风格的 x-ratelimit-* 响应头
+"""
+import hashlib
+import math
+import time
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+
+from admission import PRIORITY_CLASSES, Tenant
+
+ANONYMOUS = "anonymous"
+
+
+class RateLimitError(Exception):
+    """租户超出限流额度"""
+
+    def __init__(self, message: str, retry_after: int, headers: Dict[str, str]):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.headers = headers
+
+
+@dataclass(frozen=True)
+class TenantConfig:
+    weight: float = 1.0
+    priority: str = PRIORITY_CLASSES[0]
+    requests_per_minute: int = 0  # 0 表示不限制
+    tokens_per_minute: int = 0
+    api_key: str = ""  # 按该 API key 识别租户；为空时按 user 字段识别（只用于没有 key 的请求）
+
+
+def parse_tenant_specs(specs: str, default: TenantConfig) -> Dict[str, TenantConfig]:
+    """
+    解析 "名称=key:sk-xxx,weight:4,priority:batch,rpm:60,tpm:100000;名称=..."，未写的字段取默认值
+    格式错误时抛出 ValueError
+    """
+    fields = {"weight": ("weight", float), "priority": ("priority", str),
+              "rpm": ("requests_per_minute", int), "tpm": ("tokens_per_minute", int), "key": ("api_key", str)}
+    tenants = {}
+    for part in specs.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, options = part.partition("=")
+        name = name.strip()
+        if not sep or not name:
+            raise ValueError(f"租户配置格式错误: {part!r}，应为 名称=key:sk-xxx,weight:1,priority:interactive,rpm:60,tpm:100000")
+        values = {}
+        for option in filter(None, (o.strip() for o in options.split(","))):
+            key, _, value = option.partition(":")
+            if key.strip() not in fields:
+                raise ValueError(f"未知的租户配置项: {key}（可选: {', '.join(fields)}）")
+            field_name, cast = fields[key.strip()]
+            values[field_name] = cast(value.strip())
+        config = replace(default, **values)
+        if config.priority not in PRIORITY_CLASSES:
+            raise ValueError(f"未知的优先级: {config.priority}（可选: {', '.join(PRIORITY_CLASSES)}）")
+        if config.weight <= 0:
+            raise ValueError(f"租户 {name} 的权重必须为正数")
+        tenants[name] = config
+    return tenants
+
+
+class TokenBucket:
+    """容量为每分钟额度的令牌桶，按秒连续补充"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """取出 amount 个令牌需要等待的秒数，0 表示可以立即取出；超过容量的请求永远无法满足"""
+        self._refill()
+        if amount > self.capacity:
+            return math.inf
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def give(self, amount: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def reset_seconds(self) -> float:
+        """桶补满所需的秒数"""
+        self._refill()
+        return (self.capacity - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """租户配置、公平调度参数与令牌桶（在事件循环中使用）"""
+
+    def __init__(self, tenants: Dict[str, TenantConfig], default: TenantConfig):
+        if default.priority not in PRIORITY_CLASSES:
+            raise ValueError(f"未知的默认优先级: {default.priority}（可选: {', '.join(PRIORITY_CLASSES)}）")
+        self.tenants = tenants
+        self.default = default
+        self._key_tenants: Dict[str, str] = {}  # API key -> 配置的租户名
+        for name, tenant_config in tenants.items():
+            if tenant_config.api_key:
+                if tenant_config.api_key in self._key_tenants:
+                    raise ValueError(f"租户 {self._key_tenants[tenant_config.api_key]} 与 {name} 配置了相同的 key")
+                self._key_tenants[tenant_config.api_key] = name
+        self._buckets: Dict[str, tuple] = {}  # 租户 -> (请求数桶, token 数桶)，不限制的一项为 None
+        self.limited_total = 0
+
+    def config(self, name: str) -> TenantConfig:
+        return self.tenants.get(name, self.default)
+
+    def tenant(self, name: str) -> Tenant:
+        config = self.config(name)
+        return Tenant(name, config.weight, config.priority)
+
+    def tenant_name(self, user: Optional[str], authorization: Optional[str]) -> str:
+        """请求的租户：有 API key 时只按 key 确定，否则按 user 字段"""
+        api_key = bearer_key(authorization)
+        if api_key:
+            return self._key_tenants.get(api_key) or key_tenant_name(api_key)
+        if user:
+            config = self.tenants.get(user)
+            # 配置了 key 的租户只能用 key 认领，同名的 user 作为独立的默认租户
+            return user if config is None or not config.api_key else f"user:{user}"
+        return ANONYMOUS
+
+    def resolve(self, user: Optional[str], authorization: Optional[str]) -> Tenant:
+        return self.tenant(self.tenant_name(user, authorization))
+
+    def _get_buckets(self, name: str) -> tuple:
+        buckets = self._buckets.get(name)
+        if buckets is None:
+            config = self.config(name)
+            buckets = (
+                TokenBucket(config.requests_per_minute) if config.requests_per_minute > 0 else None,
+                TokenBucket(config.tokens_per_minute) if config.tokens_per_minute > 0 else None,
+            )
+            if buckets == (None, None):
+                return buckets
+            if len(self._buckets) >= 10000:
+                # 已补满的桶与新建的等价，可以清理
+                self._buckets = {
+                    n: b for n, b in self._buckets.items()
+                    if any(bucket is not None and bucket.reset_seconds() > 0 for bucket in b)
+                }
+            self._buckets[name] = buckets
+        return buckets
+
+    def check(self, name: str, tokens: int) -> Dict[str, str]:
+        """预扣 1 个请求和 tokens 个 token，返回限流响应头；超限时抛出 RateLimitError（不扣除）"""
+        requests_bucket, tokens_bucket = self._get_buckets(name)
+        waits = [
+            (bucket.wait_time(amount), label)
+            for bucket, amount, label in ((requests_bucket, 1, "请求数"), (tokens_bucket, tokens, "token 数"))
+            if bucket is not None
+        ]
+        wait, label = max(waits, default=(0.0, ""))
+        if wait > 0:
+            self.limited_total += 1
+            if math.isinf(wait):
+                message = f"请求的 token 数 {tokens} 超过租户每分钟额度 {self.config(name).tokens_per_minute}"
+                retry_after = 60
+            else:
+                message = f"租户 {name} 超出每分钟{label}限制"
+                retry_after = max(1, math.ceil(wait))
+            headers = self.headers(name)
+            headers["Retry-After"] = str(retry_after)
+            raise RateLimitError(message, retry_after, headers)
+        if requests_bucket is not None:
+            requests_bucket.take(1)
+        if tokens_bucket is not None:
+            tokens_bucket.take(tokens)
+        return self.headers(name)
+
+    def refund(self, name: str, tokens: int) -> None:
+        """退还预扣但未使用的 token"""
+        _, tokens_bucket = self._get_buckets(name)
+        if tokens_bucket is not None and tokens > 0:
+            tokens_bucket.give(tokens)
+
+    def headers(self, name: str) -> Dict[str, str]:
+        headers = {}
+        for bucket, kind in zip(self._get_buckets(name), ("requests", "tokens")):
+            if bucket is None:
+                continue
+            headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.capacity))
+            headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(bucket.tokens)))
+            headers[f"x-ratelimit-reset-{kind}"] = f"{bucket.reset_seconds():.1f}s"
+        return headers
+
+    def stats(self) -> Dict:
+        return {
+            "tenants_configured": len(self.tenants),
+            "tenants_limited": len(self._buckets),
+            "limited_total": self.limited_total,
+        }
+
+
+def build_rate_limiter(tenant_config: Dict) -> RateLimiter:
+    """按 config.TENANT_CONFIG 构建"""
+    default = TenantConfig(
+        weight=tenant_config["default_weight"],
+        priority=tenant_config["default_priority"],
+        requests_per_minute=tenant_config["requests_per_minute"],
+        tokens_per_minute=tenant_config["tokens_per_minute"],
+    )
+    return RateLimiter(parse_tenant_specs(tenant_config["tenants"], default), default)
+
+
+def bearer_key(authorization: Optional[str]) -> str:
+    """Authorization: Bearer 中的 API key，没有时返回空字符串"""
+    if authorization and authorization.lower().startswith("bearer "):
+        return authorization[7:].strip()
+    return ""
+
+
+def key_tenant_name(api_key: str) -> str:
+    """未单独配置的 API key 对应的租户名（key 的哈希，可出现在日志与错误信息中）"""
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,174 @@
+"""
+确定性响应缓存 - 缓存 temperature=0 或指定 seed 的请求结果
+- 键：模型名 + prompt token ids + 采样参数 的哈希
+- 内存层：按字节数和 TTL 限制的 LRU
+- 磁盘层（可选）：SQLite 文件，服务重启后仍可命中；读取在线程池中执行，写入由后台线程批量提交，
+  不阻塞事件循环
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def is_cacheable(temperature: float, seed: Optional[int]) -> bool:
+    """只有结果可复现的请求才能缓存"""
+    return temperature <= 1e-5 or seed is not None
+
+
+def make_key(model: str, prompt_token_ids: List[int], params: Dict) -> str:
+    # 不能直接序列化的参数值（枚举、集合、对象等）按 repr 参与哈希
+    payload = json.dumps(
+        {"model": model, "prompt": prompt_token_ids, "params": params},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=repr,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """两级（内存 LRU + 可选磁盘）响应缓存，缓存值为可 JSON 序列化的 dict"""
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, disk_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (过期时间, 字节数, 值)
+        self.total_bytes = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._writes: "queue.Queue[Optional[tuple]]" = queue.Queue()  # 待写入磁盘的 (key, value, 过期时间)，None 表示停止
+        self._writer: Optional[threading.Thread] = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+            self._writer = threading.Thread(target=self._write_loop, name="response-cache-writer", daemon=True)
+            self._writer.start()
+            logger.info(f"响应缓存磁盘层: {disk_path}")
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+
+    async def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, size, value = entry
+            if expires_at >= now:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                self._record_saved(value)
+                return value
+            self._remove(key)
+
+        value = None
+        if self._db is not None:
+            value = await asyncio.get_running_loop().run_in_executor(None, self._disk_get, key, now)
+        if value is not None:
+            self.disk_hits += 1
+            self._record_saved(value)
+            self._put_memory(key, value, now + self.ttl_seconds)
+            return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: Dict) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        text = json.dumps(value, ensure_ascii=False)
+        self._put_memory(key, value, expires_at, len(text.encode("utf-8")))
+        if self._writer is not None:
+            self._writes.put((key, text, expires_at))
+
+    def _write_loop(self) -> None:
+        """后台线程：把排队的写入合并为一个事务提交"""
+        while True:
+            batch = [self._writes.get()]
+            while True:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [row for row in batch if row is not None]
+            if rows:
+                try:
+                    with self._db_lock:
+                        self._db.executemany(
+                            "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)", rows
+                        )
+                        self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"响应缓存写入磁盘失败: {str(e)}")
+            if len(rows) < len(batch):
+                return
+
+    def close(self) -> None:
+        """写完排队中的磁盘写入并关闭数据库"""
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _put_memory(self, key: str, value: Dict, expires_at: float, size: Optional[int] = None) -> None:
+        if size is None:
+            size = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, size, value)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def _disk_get(self, key: str, now: float) -> Optional[Dict]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < now:
+            return None
+        return json.loads(row[0])
+
+    def _record_saved(self, value: Dict) -> None:
+        self.saved_prompt_tokens += value.get("prompt_tokens", 0)
+        self.saved_completion_tokens += value.get("completion_tokens", 0)
+
+    def stats(self) -> Dict:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "memory_mb": round(self.total_bytes / 1024 / 1024, 2),
+            "max_memory_mb": round(self.max_bytes / 1024 / 1024, 2),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "saved_prompt_tokens": self.saved_prompt_tokens,
+            "saved_completion_tokens": self.saved_completion_tokens,
+        }
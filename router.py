@@ -0,0 +1,324 @@
+"""
+请求路由 - 部署在多个服务副本前，转发 OpenAI 兼容请求，让共享系统提示词 / 同一对话的请求落到同一副本，
+复用该副本上已有的前缀 KV、会话 KV 与响应缓存
+- 亲和键：session_id > user > prompt 前缀哈希（messages 或 prompt 的前 prefix_chars 个字符）
+- 按亲和键做 rendezvous 哈希得到各副本的优先顺序，选择第一个负载不超过 平均负载 × load_factor + load_slack 的副本
+  （有界负载的一致性哈希）：负载均衡时亲和稳定，亲和副本排队过多时溢出到顺序中的下一个副本；
+  副本增减时只有落在该副本上的键会改变去向
+- 副本负载 = 路由转发中、尚未结束的请求数 + 副本 /health/ready 上报的排队数
+- 定期检查各副本 /health/ready；连接失败的副本立即标记为不可用，请求在响应开始前切换到下一个副本，
+  副本返回 502/503/504（如排队已满）时同样切换；请求发出后的错误（如读超时）副本可能已在处理，不重试，
+  直接返回 504 / 502
+- 与副本之间使用长连接（同一个 httpx 连接池），流式响应按原样逐块转发
+
+用法:
+    ROUTER_BACKENDS=http://10.0.0.1:8000,http://10.0.0.2:8000 python router.py
+
+本地测试（多个无权重假引擎副本）:
+    CPU_ENGINE_BACKEND=fake SERVICE_PORT=8001 python llm_service_cpu.py &
+    CPU_ENGINE_BACKEND=fake SERVICE_PORT=8002 python llm_service_cpu.py &
+    ROUTER_BACKENDS=http://localhost:8001,http://localhost:8002 python router.py
+    python benchmark.py --url http://localhost:9000/v1/chat/completions
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+import config
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# 按亲和键路由的接口（请求体为 JSON）
+AFFINITY_PATHS = {"v1/chat/completions", "v1/completions", "generate"}
+# 文件与批处理任务保存在副本本地，全部固定转发到同一个副本
+PINNED_PATH_PREFIXES = ("v1/files", "v1/batches")
+PINNED_KEY = "pinned:batch"
+# 副本返回这些状态码时，在响应开始前切换到下一个副本
+RETRY_STATUS_CODES = {502, 503, 504}
+# 请求尚未发出到副本的错误：标记副本不可用并切换到下一个副本
+FAILOVER_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# 逐跳头部，不转发
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+
+class Backend:
+    """单个服务副本的状态"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = False  # 首次健康检查通过后才接收请求
+        self.in_flight = 0  # 经路由转发、尚未结束的请求数
+        self.reported_queue_depth = 0  # 副本 /health/ready 上报的排队数
+        self.requests_total = 0
+        self.failures_total = 0
+        self.last_error: Optional[str] = None
+        self.last_check = 0.0
+
+    @property
+    def load(self) -> int:
+        return self.in_flight + self.reported_queue_depth
+
+    def stats(self) -> Dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "queue_depth": self.reported_queue_depth,
+            "requests_total": self.requests_total,
+            "failures_total": self.failures_total,
+            "last_error": self.last_error,
+        }
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def affinity_key(payload: Dict, prefix_chars: int) -> Optional[str]:
+    """请求的亲和键：会话 / 用户优先，其次是 prompt 前缀；都没有时返回 None（按负载选择）"""
+    session = payload.get("session_id") or payload.get("user")
+    if session:
+        return f"session:{session}"
+    messages = payload.get("messages")
+    if isinstance(messages, list):
+        parts = []
+        length = 0
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            content = message.get("content")
+            part = f"{message.get('role')}:{content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)}\n"
+            parts.append(part)
+            length += len(part)
+            if length >= prefix_chars:
+                break
+        text = "".join(parts)
+    else:
+        prompt = payload.get("prompt")
+        if isinstance(prompt, list):
+            prompt = prompt[0] if prompt else ""
+        text = prompt if isinstance(prompt, str) else ""
+    if not text:
+        return None
+    return f"prefix:{_hash(text[:prefix_chars]):016x}"
+
+
+class Router:
+    """按亲和键与负载选择副本"""
+
+    def __init__(self, backend_urls: List[str], load_factor: float = 1.25, load_slack: int = 4):
+        if not backend_urls:
+            raise ValueError("未配置后端副本（ROUTER_BACKENDS）")
+        self.backends = [Backend(url) for url in backend_urls]
+        self.load_factor = max(1.0, load_factor)
+        self.load_slack = max(0, load_slack)
+        self.affinity_hits = 0  # 转发到亲和键首选副本的请求数
+        self.affinity_spills = 0  # 首选副本负载过高或不可用、转发到其他副本的请求数
+
+    def candidates(self, key: Optional[str]) -> List[Backend]:
+        """按尝试顺序返回可用副本，第一个为选中的副本，其余为失败时的备选"""
+        healthy = [b for b in self.backends if b.healthy]
+        if not healthy:
+            return []
+        if key is None:
+            return sorted(healthy, key=lambda b: b.load)
+
+        # rendezvous 哈希：每个副本对该键的得分固定，不可用的副本只影响原本落在它上面的键
+        ranked = sorted(self.backends, key=lambda b: _hash(f"{key}|{b.url}"), reverse=True)
+        order = [b for b in ranked if b.healthy]
+        # 有界负载：加入本请求后不超过平均负载的 load_factor 倍（向上取整）再加 load_slack
+        capacity = math.ceil(self.load_factor * (sum(b.load for b in order) + 1) / len(order)) + self.load_slack
+        chosen = next((b for b in order if b.load + 1 <= capacity), min(order, key=lambda b: b.load))
+        if chosen is ranked[0]:
+            self.affinity_hits += 1
+        else:
+            self.affinity_spills += 1
+        return [chosen] + [b for b in order if b is not chosen]
+
+    def mark_down(self, backend: Backend, error: str) -> None:
+        if backend.healthy:
+            logger.warning(f"后端副本不可用: {backend.url} ({error})")
+        backend.healthy = False
+        backend.failures_total += 1
+        backend.last_error = error
+
+    async def check(self, client: httpx.AsyncClient, backend: Backend) -> None:
+        """检查副本的 /health/ready，并刷新其上报的负载"""
+        backend.last_check = time.time()
+        try:
+            response = await client.get(f"{backend.url}/health/ready", timeout=config.ROUTER_CONFIG["health_interval"])
+        except httpx.HTTPError as e:
+            self.mark_down(backend, f"{type(e).__name__}: {e}")
+            return
+        if response.status_code != 200:
+            self.mark_down(backend, f"/health/ready 返回 {response.status_code}")
+            return
+        try:
+            load = response.json().get("load") or {}
+        except ValueError:
+            load = {}
+        backend.reported_queue_depth = int(load.get("queue_depth", 0))
+        if not backend.healthy:
+            logger.info(f"后端副本可用: {backend.url}")
+        backend.healthy = True
+        backend.last_error = None
+
+    async def check_all(self, client: httpx.AsyncClient) -> None:
+        await asyncio.gather(*(self.check(client, backend) for backend in self.backends))
+
+    def stats(self) -> Dict:
+        return {
+            "backends": [b.stats() for b in self.backends],
+            "healthy": sum(1 for b in self.backends if b.healthy),
+            "affinity_hits": self.affinity_hits,
+            "affinity_spills": self.affinity_spills,
+        }
+
+
+router: Optional[Router] = None
+client: Optional[httpx.AsyncClient] = None
+
+
+async def health_loop():
+    while True:
+        await asyncio.sleep(config.ROUTER_CONFIG["health_interval"])
+        try:
+            await router.check_all(client)
+        except Exception as e:
+            logger.error(f"健康检查失败: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global router, client
+    router = Router(
+        config.ROUTER_CONFIG["backends"],
+        load_factor=config.ROUTER_CONFIG["load_factor"],
+        load_slack=config.ROUTER_CONFIG["load_slack"],
+    )
+    max_connections = config.ROUTER_CONFIG["max_connections"]
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(config.ROUTER_CONFIG["timeout"], connect=5.0),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+    await router.check_all(client)
+    logger.info(f"请求路由已启动，可用副本 {router.stats()['healthy']}/{len(router.backends)}")
+    health_task = asyncio.create_task(health_loop())
+    yield
+    health_task.cancel()
+    await client.aclose()
+
+
+app = FastAPI(
+    title="Qwen LLM Router",
+    description="多副本请求路由（前缀 / 会话亲和 + 负载感知 + 故障切换）",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+
+
+@app.get("/router/health")
+async def router_health():
+    """路由自身的健康检查：至少一个副本可用时返回 200"""
+    stats = router.stats()
+    if not stats["healthy"]:
+        raise HTTPException(status_code=503, detail="没有可用的后端副本")
+    return {"status": "healthy", **stats}
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "DELETE"])
+async def proxy(path: str, request: Request):
+    body = await request.body()
+    key = None
+    if request.method == "POST" and path in AFFINITY_PATHS:
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict):
+            key = affinity_key(payload, config.ROUTER_CONFIG["prefix_chars"])
+    elif path.startswith(PINNED_PATH_PREFIXES):
+        key = PINNED_KEY
+
+    candidates = router.candidates(key)[:max(1, config.ROUTER_CONFIG["max_attempts"])]
+    if not candidates:
+        raise HTTPException(status_code=503, detail="没有可用的后端副本")
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
+    for attempt, backend in enumerate(candidates):
+        upstream = client.build_request(
+            request.method, f"{backend.url}/{path}",
+            params=request.query_params, headers=headers, content=body,
+        )
+        backend.in_flight += 1
+        try:
+            response = await client.send(upstream, stream=True)
+        except FAILOVER_ERRORS as e:
+            backend.in_flight -= 1
+            router.mark_down(backend, f"{type(e).__name__}: {e}")
+            continue
+        except httpx.HTTPError as e:
+            # 请求已发出，副本可能已在处理：不重试，避免重复生成
+            backend.in_flight -= 1
+            backend.failures_total += 1
+            backend.last_error = f"{type(e).__name__}: {e}"
+            logger.warning(f"{backend.url} 请求失败: {backend.last_error}")
+            status_code = 504 if isinstance(e, httpx.TimeoutException) else 502
+            raise HTTPException(status_code=status_code, detail=f"后端副本请求失败: {type(e).__name__}")
+        if response.status_code in RETRY_STATUS_CODES and attempt < len(candidates) - 1:
+            # 副本过载或网关错误：响应尚未开始，换下一个副本（不标记为不可用，由健康检查判断）
+            await response.aclose()
+            backend.in_flight -= 1
+            logger.info(f"{backend.url} 返回 {response.status_code}，切换副本重试")
+            continue
+        backend.requests_total += 1
+        return RelayResponse(response, backend)
+    raise HTTPException(status_code=502, detail="所有后端副本均不可用")
+
+
+class RelayResponse(StreamingResponse):
+    """逐块转发副本的响应；响应结束或客户端断开时关闭上游连接（副本随之中止生成）并释放副本负载。
+    在 __call__ 中释放：客户端在开始迭代前断开时，响应体生成器的 finally 不会执行"""
+
+    def __init__(self, upstream: httpx.Response, backend: Backend):
+        super().__init__(
+            upstream.aiter_raw(),
+            status_code=upstream.status_code,
+            headers={k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS},
+        )
+        self.upstream = upstream
+        self.backend = backend
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.backend.in_flight -= 1
+            await self.upstream.aclose()
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        app,
+        host=config.SERVICE_HOST,
+        port=config.ROUTER_CONFIG["port"],
+        log_level="info"
+    )
@@ -0,0 +1,139 @@
+"""
+采样工具 - 批量 logits 按请求各自的采样参数做 temperature / top-k / top-p 采样
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import torch
+
+
+@dataclass
+class SamplingParams:
+    """单个请求的采样参数"""
+    max_tokens: int = 512
+    temperature: float = 0.7
+    top_p: float = 1.0
+    top_k: int = 0  # <=0 表示不限制
+    stop: List[str] = field(default_factory=list)
+    seed: Optional[int] = None
+    n: int = 1  # 返回的候选数
+    best_of: Optional[int] = None  # 实际生成的候选数（>= n），按累计 logprob 取前 n 个；None 表示等于 n
+    deadline: Optional[float] = None  # 截止时间（time.time() 时间戳），到期时以 "length" 结束，返回已生成的部分
+
+    @property
+    def greedy(self) -> bool:
+        return self.temperature <= 1e-5
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now >= self.deadline
+
+    @property
+    def num_sequences(self) -> int:
+        """同一 prompt 分叉出的序列数"""
+        return max(self.best_of or self.n, self.n)
+
+    def validate(self) -> None:
+        if self.n < 1:
+            raise ValueError("n 必须 >= 1")
+        if self.best_of is not None and self.best_of < self.n:
+            raise ValueError(f"best_of ({self.best_of}) 不能小于 n ({self.n})")
+
+
+def logits_to_probs(logits: torch.Tensor, params: List[SamplingParams]) -> torch.Tensor:
+    """
+    将 [B, V] 的 logits 按每行的采样参数转换为概率分布（词表顺序）
+    greedy 行返回 argmax 处为 1 的 one-hot 分布
+    """
+    logits = logits.float()
+    batch_size, vocab_size = logits.shape
+
+    greedy = torch.tensor([p.greedy for p in params])
+    temperatures = torch.tensor([max(p.temperature, 1e-5) for p in params])
+    top_k = torch.tensor([p.top_k if p.top_k > 0 else vocab_size for p in params]).clamp(max=vocab_size)
+    top_p = torch.tensor([p.top_p for p in params])
+
+    sorted_logits, sorted_idx = (logits / temperatures[:, None]).sort(dim=-1, descending=True)
+    ranks = torch.arange(vocab_size)[None, :]
+    sorted_logits = sorted_logits.masked_fill(ranks >= top_k[:, None], float("-inf"))
+    sorted_probs = torch.softmax(sorted_logits, dim=-1)
+
+    # top-p：保留累计概率刚好超过 top_p 的最小集合（至少保留一个）
+    cumulative = sorted_probs.cumsum(dim=-1)
+    remove = (cumulative - sorted_probs) > top_p[:, None]
+    remove[:, 0] = False
+    sorted_probs = sorted_probs.masked_fill(remove, 0.0)
+    sorted_probs = sorted_probs / sorted_probs.sum(dim=-1, keepdim=True)
+
+    probs = torch.zeros_like(sorted_probs).scatter_(-1, sorted_idx, sorted_probs)
+    if greedy.any():
+        one_hot = torch.zeros_like(probs).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+        probs = torch.where(greedy[:, None], one_hot, probs)
+    return probs
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    params: List[SamplingParams],
+    generators: Optional[List[Optional[torch.Generator]]] = None,
+) -> torch.Tensor:
+    """
+    为 batch 中每一行采样下一个 token，返回 [B] 的 token id
+    generators 中非空的行（指定了 seed 的请求）使用各自的随机数生成器
+    """
+    if all(p.greedy for p in params):
+        return logits.argmax(dim=-1)
+    probs = logits_to_probs(logits, params)
+    tokens = torch.multinomial(probs, num_samples=1).squeeze(-1)
+    for i, generator in enumerate(generators or []):
+        if generator is not None and not params[i].greedy:
+            tokens[i] = torch.multinomial(probs[i], num_samples=1, generator=generator)[0]
+    return tokens
+
+
+def sample_from_probs(
+    probs: torch.Tensor,
+    generators: Optional[List[Optional[torch.Generator]]] = None,
+) -> torch.Tensor:
+    """从 [B, V] 的概率分布中为每行采样一个 token，指定了 seed 的行使用各自的生成器"""
+    tokens = torch.multinomial(probs, num_samples=1).squeeze(-1)
+    for i, generator in enumerate(generators or []):
+        if generator is not None:
+            tokens[i] = torch.multinomial(probs[i], num_samples=1, generator=generator)[0]
+    return tokens
+
+
+def verify_draft_tokens(
+    target_probs: torch.Tensor,
+    draft_probs: torch.Tensor,
+    draft_tokens: torch.Tensor,
+    generators: Optional[List[Optional[torch.Generator]]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    投机采样的拒绝采样验证，输出分布与直接从目标模型采样完全一致
+    target_probs: [B, k+1, V] 目标模型在每个位置的分布（最后一个位置用于全部接受时的额外 token）
+    draft_probs:  [B, k, V]   草稿模型提议时使用的分布
+    draft_tokens: [B, k]      草稿 token
+    返回 (每行接受的草稿 token 数 [B], 每行接下来的 token [B])
+    第 j 个草稿 token 以 min(1, p/q) 的概率接受；第一次拒绝时从 max(0, p - q) 归一化后的分布中重新采样
+    """
+    batch_size, k = draft_tokens.shape
+    p = target_probs[:, :k].gather(-1, draft_tokens[..., None]).squeeze(-1)
+    q = draft_probs.gather(-1, draft_tokens[..., None]).squeeze(-1)
+    uniform = torch.rand(batch_size, k)
+    for i, generator in enumerate(generators or []):
+        if generator is not None:
+            uniform[i] = torch.rand(k, generator=generator)
+    accepted = (uniform * q < p).long().cumprod(dim=-1)
+    num_accepted = accepted.sum(dim=-1)
+
+    rows = torch.arange(batch_size)
+    next_probs = target_probs[rows, num_accepted]
+    rejected = num_accepted < k
+    if rejected.any():
+        index = num_accepted.clamp(max=k - 1)
+        residual = (next_probs - draft_probs[rows, index]).clamp(min=0)
+        total = residual.sum(dim=-1, keepdim=True)
+        # p 与 q 完全相同时残差为 0（此时不会发生拒绝），退回目标分布避免除零
+        residual = torch.where(total > 0, residual / total.clamp(min=1e-12), next_probs)
+        next_probs = torch.where(rejected[:, None], residual, next_probs)
+    return num_accepted, sample_from_probs(next_probs, generators)
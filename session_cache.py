@@ -0,0 +1,220 @@
+"""
+会话 KV 缓存 - 多轮对话按 session_id 保留上一轮结束时的 KV（含模型的回复），下一轮只需 prefill 新增的消息
+- 命中前逐 token 校验缓存的历史与新 prompt，只复用两者的公共前缀；客户端改写了历史时自动退化为部分复用
+- 内存中的会话总字节数超过上限，或空闲超过 idle_seconds 时，按 LRU 转存到磁盘，
+  下一轮以 mmap 方式读回（页面按需读入，不占用进程内存）；未配置转存目录时直接丢弃
+- 磁盘占用超过上限或超过 ttl_seconds 未访问的会话直接删除
+- 只在引擎线程中修改，不加锁；stats() 只读取引擎线程维护的计数、不遍历会话表，可在事件循环中调用
+"""
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from prefix_cache import KVCache
+
+logger = logging.getLogger(__name__)
+
+# 空闲 / 过期检查的最小间隔（秒）
+EXPIRE_INTERVAL = 1.0
+
+
+def _kv_nbytes(kv: KVCache) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+
+class _Session:
+    __slots__ = ("token_ids", "prompt_length", "kv", "path", "nbytes", "last_access")
+
+    def __init__(self, token_ids: List[int], prompt_length: int, kv: KVCache):
+        self.token_ids = token_ids
+        self.prompt_length = prompt_length
+        self.kv: Optional[KVCache] = kv  # 已转存到磁盘时为 None
+        self.path: Optional[str] = None
+        self.nbytes = _kv_nbytes(kv)
+        self.last_access = time.monotonic()
+
+
+def _common_prefix(a: List[int], b: List[int], limit: int) -> int:
+    n = 0
+    limit = min(limit, len(a), len(b))
+    while n < limit and a[n] == b[n]:
+        n += 1
+    return n
+
+
+class SessionCache:
+    """按 session_id 保存对话 KV，内存超限或空闲时转存到 mmap 磁盘文件"""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        spill_dir: str = "",
+        max_disk_bytes: int = 0,
+        idle_seconds: float = 60,
+        ttl_seconds: float = 3600,
+    ):
+        self.max_bytes = max_bytes
+        # 每个缓存实例（引擎 / worker 进程）使用独立子目录，互不覆盖
+        self.spill_dir = os.path.join(spill_dir, f"sessions-{uuid.uuid4().hex[:12]}") if spill_dir else ""
+        self.max_disk_bytes = max_disk_bytes
+        self.idle_seconds = idle_seconds
+        self.ttl_seconds = ttl_seconds
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()  # 按最近访问排序
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.sessions_in_memory = 0
+        self.sessions_on_disk = 0
+        self._last_expire = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0  # 缓存的历史与新 prompt 不一致（客户端改写了历史）
+        self.hit_tokens = 0
+        self.spills = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def match(self, session_id: str, token_ids: List[int], max_length: int) -> Tuple[int, Optional[KVCache]]:
+        """返回 (可复用的前缀长度, 对应的 KV)，未命中时返回 (0, None)"""
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is None:
+            self.misses += 1
+            return 0, None
+        length = _common_prefix(session.token_ids, token_ids, max_length)
+        if length < session.prompt_length:
+            self.mismatches += 1
+        if length == 0:
+            self.misses += 1
+            return 0, None
+
+        kv = session.kv
+        if kv is None:
+            try:
+                kv = self._reload(session)
+            except Exception as e:
+                logger.warning(f"会话 {session_id} 的 KV 读取失败: {str(e)}")
+                self.drop(session_id)
+                self.misses += 1
+                return 0, None
+        session.last_access = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        self.hits += 1
+        self.hit_tokens += length
+        return length, tuple((k[:, :, :length], v[:, :, :length]) for k, v in kv)
+
+    def store(self, session_id: str, token_ids: List[int], prompt_length: int, kv: KVCache) -> None:
+        """保存会话本轮结束时的 KV（时间维度长度与 token_ids 一致），替换该会话之前的记录"""
+        self.drop(session_id)
+        session = _Session(list(token_ids), prompt_length, kv)
+        self._sessions[session_id] = session
+        self.memory_bytes += session.nbytes
+        self.sessions_in_memory += 1
+        while self.memory_bytes > self.max_bytes:
+            victim_id = next((sid for sid, s in self._sessions.items() if s.kv is not None), None)
+            if victim_id is None:
+                break
+            self._spill(victim_id)
+        self._enforce_disk_limit()
+
+    def drop(self, session_id: str) -> None:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return
+        if session.kv is not None:
+            self.memory_bytes -= session.nbytes
+            self.sessions_in_memory -= 1
+        if session.path is not None:
+            self.disk_bytes -= session.nbytes
+            self.sessions_on_disk -= 1
+            try:
+                os.remove(session.path)
+            except OSError:
+                pass
+
+    def _spill(self, session_id: str) -> None:
+        """把会话的 KV 转存到磁盘；未配置转存目录或写入失败时直接丢弃"""
+        session = self._sessions[session_id]
+        if not self.spill_dir:
+            self.drop(session_id)
+            self.evictions += 1
+            return
+        path = os.path.join(self.spill_dir, hashlib.sha1(session_id.encode("utf-8")).hexdigest() + ".pt")
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            torch.save({"keys": [k for k, _ in session.kv], "values": [v for _, v in session.kv]}, path)
+        except Exception as e:
+            logger.warning(f"会话 {session_id} 的 KV 转存失败: {str(e)}")
+            self.drop(session_id)
+            self.evictions += 1
+            return
+        session.kv = None
+        session.path = path
+        self.memory_bytes -= session.nbytes
+        self.disk_bytes += session.nbytes
+        self.sessions_in_memory -= 1
+        self.sessions_on_disk += 1
+        self.spills += 1
+
+    def _reload(self, session: _Session) -> KVCache:
+        """以 mmap 方式读回磁盘上的 KV，文件保留到会话被替换或删除"""
+        data = torch.load(session.path, map_location="cpu", mmap=True, weights_only=True)
+        self.reloads += 1
+        return tuple(zip(data["keys"], data["values"]))
+
+    def _enforce_disk_limit(self) -> None:
+        while self.max_disk_bytes and self.disk_bytes > self.max_disk_bytes:
+            victim_id = next((sid for sid, s in self._sessions.items() if s.path is not None), None)
+            if victim_id is None:
+                break
+            self.drop(victim_id)
+            self.evictions += 1
+
+    def _expire(self) -> None:
+        """删除过期的会话，空闲的会话转存到磁盘"""
+        now = time.monotonic()
+        if now - self._last_expire < EXPIRE_INTERVAL:
+            return
+        self._last_expire = now
+        for session_id, session in list(self._sessions.items()):
+            idle = now - session.last_access
+            if idle > self.ttl_seconds:
+                self.drop(session_id)
+                self.evictions += 1
+            elif session.kv is not None and self.spill_dir and idle > self.idle_seconds:
+                self._spill(session_id)
+        self._enforce_disk_limit()
+
+    def clear(self) -> None:
+        self._sessions.clear()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.sessions_in_memory = 0
+        self.sessions_on_disk = 0
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "hit_tokens": self.hit_tokens,
+            "mismatches": self.mismatches,
+            "sessions_in_memory": self.sessions_in_memory,
+            "sessions_on_disk": self.sessions_on_disk,
+            "spills": self.spills,
+            "reloads": self.reloads,
+            "evictions": self.evictions,
+            "memory_mb": round(self.memory_bytes / 1024 / 1024, 2),
+            "max_memory_mb": round(self.max_bytes / 1024 / 1024, 2),
+            "disk_mb": round(self.disk_bytes / 1024 / 1024, 2),
+        }
@@ -0,0 +1,171 @@
+"""
+OpenAI 兼容的 SSE 流式输出格式（CPU / GPU 服务共用）
+- chat_chunk：单条事件，用于缓存回放等低频路径
+- ChatStreamEncoder：逐 token 流式输出，预先编码不变的外层字段，每个 token 只转义增量文本，
+  可按时间 / 字节窗口把多个 token 合并为一个 chunk，待发送的多个 chunk 合并为一次写入
+- DisconnectCheck：按时间间隔检查客户端是否断开，不在每个 token 上轮询连接
+"""
+import json
+import time
+from typing import Dict, List, Optional
+
+DONE_EVENT = "data: [DONE]\n\n"
+
+# json.dumps(ensure_ascii=False) 对字符串使用的转义函数（C 实现），直接调用省去构造 JSONEncoder 的开销
+_escape = json.encoder.encode_basestring
+
+
+def format_event(data: Dict) -> str:
+    """编码为一条 SSE 事件"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def usage_dict(prompt_tokens: int, completion_tokens: int) -> Dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def chat_chunk(
+    chunk_id: str,
+    created: int,
+    model: str,
+    content: Optional[str] = None,
+    finish_reason: Optional[str] = None,
+    usage: Optional[Dict] = None,
+    index: int = 0,
+) -> str:
+    """
+    构造一条 chat.completion.chunk 事件
+    - 内容增量：content 非空，finish_reason 为 None
+    - 结束事件：delta 为空，带 finish_reason；n > 1 时每个候选各有一个结束事件，usage 只在最后一个上
+    """
+    delta = {"role": "assistant", "content": content} if content is not None else {}
+    chunk = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": index,
+            "delta": delta,
+            "finish_reason": finish_reason,
+        }],
+    }
+    if usage is not None:
+        chunk["usage"] = usage
+    return format_event(chunk)
+
+
+def error_event(message: str, code: int = 500) -> str:
+    return format_event({
+        "error": {
+            "message": message,
+            "type": "server_error",
+            "code": code,
+        }
+    })
+
+
+class DisconnectCheck:
+    """
+    流式生成中检查客户端是否断开：距上次检查不足 interval 秒时直接返回 False，
+    避免每个 token 都轮询一次连接（is_disconnected 需要从 ASGI receive 中取消息）
+    """
+
+    def __init__(self, request, interval: float):
+        self.request = request
+        self.interval = interval
+        self._next_check = time.monotonic() + interval
+
+    async def __call__(self) -> bool:
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.interval
+        return await self.request.is_disconnected()
+
+
+class ChatStreamEncoder:
+    """
+    单个流式响应的 chat.completion.chunk 编码器
+    - id / object / created / model 在构造时编码一次；role 只在每个候选的第一个内容 chunk 中发送
+    - coalesce_seconds / coalesce_bytes 大于 0 时，窗口内的增量文本合并为一个 chunk（任一条件满足即发送），
+      每个流的第一个 chunk 立即发送，不影响首 token 延迟
+    - add_* 只把事件放入缓冲，poll() / finish_stream() 返回本次要写出的全部字节（一次写入）
+    """
+
+    def __init__(self, chunk_id: str, created: int, model: str, coalesce_seconds: float = 0.0, coalesce_bytes: int = 0):
+        self._prefix = (
+            f'data: {{"id":{_escape(chunk_id)},"object":"chat.completion.chunk",'
+            f'"created":{int(created)},"model":{_escape(model)},"choices":[{{"index":'
+        )
+        self.coalesce_seconds = coalesce_seconds
+        self.coalesce_bytes = coalesce_bytes
+        self._pending: Dict[int, List[str]] = {}  # 候选 index -> 尚未编码的增量文本
+        self._pending_bytes = 0
+        self._window_start = 0.0
+        self._frames: List[str] = []  # 已编码、待写出的 chunk
+        self._role_sent: set = set()
+        self._started = False  # 是否已写出过内容
+
+    def add_content(self, text: str, index: int = 0) -> None:
+        if not text:
+            return
+        if not self._pending:
+            self._window_start = time.monotonic()
+        self._pending.setdefault(index, []).append(text)
+        self._pending_bytes += len(text.encode("utf-8"))
+
+    def add_finish(self, finish_reason: Optional[str], usage: Optional[Dict] = None, index: int = 0) -> None:
+        """候选结束：先写出该候选剩余的内容，再写结束事件（usage 只在最后一个候选上）"""
+        texts = self._pending.pop(index, None)
+        if texts:
+            text = "".join(texts)
+            # 与 add_content 一致按 UTF-8 字节数计，否则其他候选的合并窗口会按残留字节数提前发送
+            self._pending_bytes -= len(text.encode("utf-8"))
+            self._frames.append(self._content_frame(index, text))
+        reason = _escape(finish_reason) if finish_reason is not None else "null"
+        tail = f',"usage":{json.dumps(usage, separators=(",", ":"))}}}\n\n' if usage is not None else "}\n\n"
+        self._frames.append(f'{self._prefix}{index},"delta":{{}},"finish_reason":{reason}}}]{tail}')
+
+    def _content_frame(self, index: int, text: str) -> str:
+        role = ""
+        if index not in self._role_sent:
+            self._role_sent.add(index)
+            role = '"role":"assistant",'
+        return f'{self._prefix}{index},"delta":{{{role}"content":{_escape(text)}}},"finish_reason":null}}]}}\n\n'
+
+    def _window_due(self) -> bool:
+        if not self._started:
+            return True
+        if self.coalesce_bytes > 0 and self._pending_bytes >= self.coalesce_bytes:
+            return True
+        if self.coalesce_seconds > 0:
+            return time.monotonic() - self._window_start >= self.coalesce_seconds
+        return self.coalesce_bytes <= 0
+
+    def _drain_pending(self) -> None:
+        for index in sorted(self._pending):
+            self._frames.append(self._content_frame(index, "".join(self._pending[index])))
+        self._pending.clear()
+        self._pending_bytes = 0
+
+    def poll(self) -> bytes:
+        """返回现在应写出的数据（合并窗口未到时可能为空）"""
+        if self._pending and self._window_due():
+            self._drain_pending()
+        if not self._frames:
+            return b""
+        self._started = True
+        data = "".join(self._frames).encode("utf-8")
+        self._frames.clear()
+        return data
+
+    def finish_stream(self) -> bytes:
+        """写出全部剩余内容与 [DONE]"""
+        self._drain_pending()
+        self._frames.append(DONE_EVENT)
+        return self.poll()
@@ -0,0 +1,206 @@
+"""
+静态 KV 缓存 decode（CPU 连续批处理引擎可选模式）
+- 动态 KV 缓存每个 decode 步都要 torch.cat 出一份更长的 KV（每层复制 O(T) 数据），静态模式预分配
+  [batch 分桶, heads, 长度分桶, head_dim] 的缓冲区，新 token 的 KV 原地写入第 T 列
+- batch 内序列左 padding 对齐，所有行在同一列写入，可直接使用 transformers 的 StaticCache（共享 cache_position）
+- 形状分桶：超过当前长度分桶或 batch 组成变化（加入 / 移除序列）时按新的分桶重建缓冲区
+  - eager：batch 不补齐，长度按 min_len 的整数倍分桶，attention 多算的列不超过 min_len
+  - 编译：batch 按 2 的幂补齐到 max_batch_size（补齐的行只关注自己的当前列，结果丢弃），
+    长度从 min_len 起按 2 倍增长到 max_model_len，图的数量为两者分桶数之积
+- 可选 torch.compile 编译 decode 前向（dynamic=False，每个分桶一个图），启动时按分桶预热，请求中不再编译
+- 引擎的其他逻辑仍使用 tuple 格式的 KV：每步之后 past 为缓冲区前 B 行、前 T+1 列的视图（不复制）；
+  引擎替换 past（合并、移除序列等）后视图失效，下一步从新的 past 重建
+"""
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+try:
+    from transformers import StaticCache
+except ImportError:  # 旧版本 transformers 没有 StaticCache
+    StaticCache = None
+
+logger = logging.getLogger(__name__)
+
+# 每层一个 (key, value)，形状均为 [batch, heads, seq_len, head_dim]
+KVCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def size_buckets(smallest: int, largest: int, geometric: bool = True) -> List[int]:
+    """从 smallest 起按 2 倍（geometric）或按 smallest 的整数倍增长的分桶，最后一个为 largest"""
+    buckets = []
+    step = max(1, min(smallest, largest))
+    size = step
+    while size < largest:
+        buckets.append(size)
+        size = size * 2 if geometric else size + step
+    buckets.append(largest)
+    return buckets
+
+
+def static_cache_supported(model) -> bool:
+    """transformers 的 StaticCache 是否为按层对象（layers）的实现，旧版本接口不同，不支持"""
+    if StaticCache is None:
+        return False
+    try:
+        cache = StaticCache(config=model.config, max_cache_len=1)
+    except Exception:
+        return False
+    return bool(getattr(cache, "layers", None)) and hasattr(cache.layers[0], "lazy_initialization")
+
+
+class StaticKVDecoder:
+    """按 (batch 分桶, 长度分桶) 复用形状的 decode 步"""
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int,
+        max_model_len: int,
+        min_len: int = 256,
+        compile: bool = False,
+        warmup_len: int = 1024,
+    ):
+        self.model = model
+        self.batch_buckets = size_buckets(1, max_batch_size, geometric=compile)
+        self.length_buckets = size_buckets(min_len, max_model_len, geometric=compile)
+        self.max_len = self.length_buckets[-1]
+        self.compile = compile
+        self.warmup_len = warmup_len
+        self._forward = torch.compile(model.forward, dynamic=False) if compile else model.forward
+
+        self._cache = None
+        self._view: Optional[KVCache] = None  # 上一步返回的 past 视图
+        self._batch_bucket = 0
+        self._length_bucket = 0
+        self._shapes: set = set()  # 已运行过（已编译）的 (batch 分桶, 长度分桶)
+
+        self.steps = 0
+        self.rebuilds = 0
+        self.warmup_seconds = 0.0
+
+    @staticmethod
+    def _bucket(buckets: List[int], size: int) -> int:
+        return next(b for b in buckets if b >= size)
+
+    def fits(self, batch_size: int, length: int) -> bool:
+        """过去长度为 length 的 batch 能否再 decode 一步（超出最大分桶时由引擎走动态路径）"""
+        return batch_size <= self.batch_buckets[-1] and length + 1 <= self.max_len
+
+    def reset(self) -> None:
+        """batch 清空时释放缓冲区"""
+        self._cache = None
+        self._view = None
+
+    def _rebuild(self, past: KVCache, batch_size: int, length: int) -> None:
+        """分配新的缓冲区并把 past 复制到前 batch_size 行、前 length 列，其余位置为 0"""
+        batch_bucket = self._bucket(self.batch_buckets, batch_size)
+        length_bucket = self._bucket(self.length_buckets, length + 1)
+        cache = StaticCache(config=self.model.config, max_cache_len=length_bucket)
+        for layer, (k, v) in zip(cache.layers, past):
+            # lazy_initialization 只读取 heads / head_dim / dtype / device，传入 0 长度的张量即可
+            layer.lazy_initialization(
+                k.new_empty((batch_bucket, k.shape[1], 0, k.shape[3])),
+                v.new_empty((batch_bucket, v.shape[1], 0, v.shape[3])),
+            )
+            layer.keys[:batch_size, :, :length] = k
+            layer.values[:batch_size, :, :length] = v
+            layer.cumulative_length.fill_(length)
+        self._cache = cache
+        self._batch_bucket = batch_bucket
+        self._length_bucket = length_bucket
+        self.rebuilds += 1
+
+    def step(
+        self, past: KVCache, attention_mask: torch.Tensor, input_ids: torch.Tensor
+    ) -> Tuple[torch.Tensor, KVCache]:
+        """
+        decode 一步：past 的 T 列之后写入 input_ids 的 KV
+        attention_mask 为 [B, T]（不含本步），返回 [B, V] 的 logits 与新的 past 视图（T+1 列）
+        """
+        batch_size, length = attention_mask.shape
+        if past is not self._view or length + 1 > self._length_bucket:
+            self._rebuild(past, batch_size, length)
+        shape = (self._batch_bucket, self._length_bucket)
+        if shape not in self._shapes:
+            self._shapes.add(shape)
+            if self.compile and self.warmup_seconds:
+                logger.info(f"decode 分桶 batch={shape[0]} len={shape[1]} 未预热，首次使用需编译")
+
+        # 补齐的行只关注本步写入的列，避免整行被屏蔽
+        mask = torch.zeros(shape, dtype=torch.long)
+        mask[:batch_size, :length] = attention_mask
+        mask[:, length] = 1
+        tokens = torch.full((shape[0], 1), 0, dtype=torch.long)
+        tokens[:batch_size, 0] = input_ids
+        position_ids = torch.zeros((shape[0], 1), dtype=torch.long)
+        position_ids[:batch_size] = attention_mask.sum(-1, keepdim=True)
+
+        out = self._forward(
+            input_ids=tokens,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self.steps += 1
+        self._view = tuple(
+            (layer.keys[:batch_size, :, :length + 1], layer.values[:batch_size, :, :length + 1])
+            for layer in self._cache.layers
+        )
+        return out.logits[:batch_size, -1, :], self._view
+
+    def warm_up(self, template: KVCache) -> None:
+        """
+        编译模式下预先运行能容纳 warmup_len 个 token 的各个长度分桶（与全部 batch 分桶的组合）；
+        template 为形状正确的任意长度 KV
+        dynamo 的配置按线程生效，需在之后调用 step 的线程（引擎线程）中调用
+        """
+        if not self.compile:
+            return
+        # 每个分桶一个图，重新编译次数上限至少要容纳全部分桶，否则超出后静默退回 eager
+        dynamo_config = torch._dynamo.config
+        limit_name = "recompile_limit" if hasattr(dynamo_config, "recompile_limit") else "cache_size_limit"
+        num_shapes = len(self.batch_buckets) * len(self.length_buckets)
+        setattr(dynamo_config, limit_name, max(getattr(dynamo_config, limit_name), num_shapes))
+
+        last_bucket = self._bucket(self.length_buckets, min(self.warmup_len, self.max_len))
+        start = time.perf_counter()
+        try:
+            for length_bucket in self.length_buckets[:self.length_buckets.index(last_bucket) + 1]:
+                for batch_bucket in self.batch_buckets:
+                    length = length_bucket - 1
+                    past = tuple(
+                        (
+                            k.new_zeros((batch_bucket, k.shape[1], length, k.shape[3])),
+                            v.new_zeros((batch_bucket, v.shape[1], length, v.shape[3])),
+                        )
+                        for k, v in template
+                    )
+                    self.step(
+                        past,
+                        torch.ones((batch_bucket, length), dtype=torch.long),
+                        torch.zeros(batch_bucket, dtype=torch.long),
+                    )
+        except Exception as e:
+            # 如缺少 C 编译器、量化算子不支持编译：退回 eager，仍使用静态 KV 缓存
+            logger.warning(f"decode 编译失败，改用 eager 执行: {type(e).__name__}: {e}")
+            self.compile = False
+            self._forward = self.model.forward
+            self._shapes.clear()
+        self.reset()
+        self.warmup_seconds = time.perf_counter() - start
+        logger.info(f"decode 预热完成: {len(self._shapes)} 个分桶，耗时 {self.warmup_seconds:.1f}s")
+
+    def stats(self) -> Dict:
+        return {
+            "compile": self.compile,
+            "steps": self.steps,
+            "rebuilds": self.rebuilds,
+            "batch_buckets": self.batch_buckets,
+            "length_buckets": self.length_buckets,
+            "shapes_used": len(self._shapes),
+            "warmup_seconds": round(self.warmup_seconds, 2),
+        }
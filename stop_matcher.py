@@ -0,0 +1,67 @@
+"""
+增量停止词匹配 - 基于 Aho-Corasick 自动机的多模式流式匹配
+- 每次只喂入新解码出的字符，停止词跨 token / 跨 chunk 时也能识别
+- pending 给出末尾可能是某个停止词开头的字符数，流式输出时这部分需要暂缓发送
+"""
+from collections import deque
+from typing import Dict, List
+
+
+class StopMatcher:
+    """多停止词增量匹配器（每个请求一个实例）"""
+
+    def __init__(self, patterns: List[str]):
+        patterns = [p for p in patterns if p]
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._depth: List[int] = [0]
+        self._match_len: List[int] = [0]  # 在该状态结束的最长停止词长度，0 表示无
+
+        for pattern in patterns:
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._match_len.append(0)
+                state = nxt
+            self._match_len[state] = max(self._match_len[state], len(pattern))
+
+        # BFS 构建失败指针，并沿失败链继承匹配长度
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._match_len[nxt] = max(self._match_len[nxt], self._match_len[self._fail[nxt]])
+                queue.append(nxt)
+
+        self._state = 0
+        self._consumed = 0
+
+    @property
+    def pending(self) -> int:
+        """已喂入文本末尾可能构成停止词前缀的字符数"""
+        return self._depth[self._state]
+
+    def feed(self, text: str) -> int:
+        """
+        喂入新增文本；命中停止词时返回该停止词在全部已喂入文本中的起始位置，否则返回 -1
+        """
+        for ch in text:
+            state = self._state
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            self._state = self._goto[state].get(ch, 0)
+            self._consumed += 1
+            length = self._match_len[self._state]
+            if length:
+                return self._consumed - length
+        return -1
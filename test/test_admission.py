@@ -0,0 +1,207 @@
+"""
+准入控制测试 - 租户加权公平排队（SFQ）的出队顺序、优先级与 batch 并发上限、截止时间的提前拒绝与排队到期、队列满时拒绝
+不需要模型权重（只调用 AdmissionController，请求由协程模拟）
+
+用法:
+    python test/test_admission.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import (  # noqa: E402
+    PRIORITY_BATCH,
+    AdmissionController,
+    DeadlineError,
+    OverloadedError,
+    Tenant,
+    request_deadline,
+)
+
+
+async def run_queued(controller: AdmissionController, requests):
+    """
+    先占住全部名额，再按顺序提交 requests [(名称, 租户, cost)]，全部入队后释放名额，返回获得名额的顺序
+    每个请求获得名额后立即释放，使 max_concurrency=1 时的顺序即出队顺序
+    """
+    order = []
+
+    async def one(name, tenant, cost):
+        grant = await controller.acquire(tenant, cost)
+        order.append(name)
+        await asyncio.sleep(0)
+        controller.release(grant)
+
+    holders = [await controller.acquire(Tenant("holder")) for _ in range(controller.max_concurrency)]
+    tasks = []
+    for name, tenant, cost in requests:
+        tasks.append(asyncio.ensure_future(one(name, tenant, cost)))
+        await asyncio.sleep(0)  # 保证按提交顺序入队
+    for grant in holders:
+        controller.release(grant)
+    await asyncio.gather(*tasks)
+    return order
+
+
+async def check_fair_queuing() -> bool:
+    a, b = Tenant("a"), Tenant("b")
+    passed = True
+    # A 先提交 3 个请求，B 随后提交 1 个：B 不必等 A 全部完成
+    order = await run_queued(AdmissionController(1, 100), [("A1", a, 100), ("A2", a, 100), ("A3", a, 100), ("B1", b, 100)])
+    if order != ["A1", "B1", "A2", "A3"]:
+        print(f"  同权重: 期望 A1 B1 A2 A3，实际 {order}")
+        passed = False
+
+    # 权重 2:1，交替提交：A 获得约两倍的名额
+    heavy = Tenant("a", weight=2.0)
+    requests = []
+    for i in range(1, 5):
+        requests += [(f"A{i}", heavy, 100), (f"B{i}", b, 100)]
+    order = await run_queued(AdmissionController(1, 100), requests)
+    expected = ["A1", "B1", "A2", "A3", "B2", "A4", "B3", "B4"]
+    if order != expected:
+        print(f"  加权: 期望 {expected}，实际 {order}")
+        passed = False
+    return passed
+
+
+async def check_priority() -> bool:
+    batch = Tenant("offline", priority=PRIORITY_BATCH)
+    interactive = Tenant("chat")
+    passed = True
+    order = await run_queued(AdmissionController(1, 100), [("batch", batch, 1), ("chat", interactive, 1000)])
+    if order != ["chat", "batch"]:
+        print(f"  期望交互式请求先获得名额，实际 {order}")
+        passed = False
+
+    # batch_max_share=0.5：batch 最多占 1 个名额，剩余名额留给交互式请求
+    controller = AdmissionController(2, 100, batch_max_share=0.5)
+    first = await controller.acquire(batch)
+    second = asyncio.ensure_future(controller.acquire(batch))
+    await asyncio.sleep(0)
+    chat = await asyncio.wait_for(controller.acquire(interactive), 0.5)
+    if second.done() or controller.queue_depth != 1:
+        print("  batch 请求超出 batch_max_share")
+        passed = False
+    controller.release(first)
+    controller.release(await asyncio.wait_for(second, 0.5))
+    controller.release(chat)
+    return passed
+
+
+async def check_deadline() -> bool:
+    passed = True
+    controller = AdmissionController(1, 100)
+    controller.decode_seconds_per_token = 0.01
+    # 预计耗时 100 × 0.01 = 1s，超过剩余 0.5s：直接拒绝
+    try:
+        await controller.acquire(deadline=time.time() + 0.5, max_tokens=100)
+        print("  预计超时的请求未被拒绝")
+        passed = False
+    except DeadlineError:
+        pass
+    grant = await controller.acquire(deadline=time.time() + 0.5, max_tokens=10)
+    # 排在预计 0.1s 的请求之后，预计总耗时 0.1 + 0.45 仍超过 0.5s
+    try:
+        await controller.acquire(deadline=time.time() + 0.5, max_tokens=45)
+        print("  未计入排队等待的估计")
+        passed = False
+    except DeadlineError:
+        pass
+    if controller.deadline_rejected_total != 2:
+        print(f"  deadline_rejected_total 期望 2，实际 {controller.deadline_rejected_total}")
+        passed = False
+
+    # 尚无实测数据时新请求不做预估（运行中请求的剩余约 0.1s 仍计入等待），排队期间到期后移出队列
+    controller.decode_seconds_per_token = 0.0
+    try:
+        await controller.acquire(deadline=time.time() + 0.3, max_tokens=1000)
+        print("  排队到期的请求未被移出")
+        passed = False
+    except DeadlineError:
+        pass
+    if controller.queue_depth != 0 or controller.deadline_expired_total != 1:
+        print(f"  queue_depth={controller.queue_depth}，deadline_expired_total={controller.deadline_expired_total}")
+        passed = False
+    controller.release(grant)
+    if controller.stats()["active"] != 0:
+        print("  名额未归还")
+        passed = False
+    return passed
+
+
+async def check_queue_full() -> bool:
+    controller = AdmissionController(1, 1)
+    grant = await controller.acquire()
+    queued = asyncio.ensure_future(controller.acquire())
+    await asyncio.sleep(0)
+    passed = True
+    try:
+        await controller.acquire()
+        print("  队列满时未拒绝")
+        passed = False
+    except DeadlineError:
+        print("  队列满时应抛出 OverloadedError 而非 DeadlineError")
+        passed = False
+    except OverloadedError as e:
+        if e.retry_after < 1:
+            print(f"  retry_after={e.retry_after}")
+            passed = False
+    unbounded = asyncio.ensure_future(controller.acquire(bounded=False))  # 离线批处理不受排队上限限制
+    await asyncio.sleep(0)
+    if unbounded.done() or controller.rejected_total != 1:
+        print("  bounded=False 的请求被拒绝")
+        passed = False
+    controller.release(grant)
+    controller.release(await queued)
+    controller.release(await unbounded)
+    return passed
+
+
+def check_request_deadline() -> bool:
+    now = time.time()
+    passed = True
+    cases = [
+        ((None, None, 0.0), None),
+        ((None, None, 30.0), 30.0),
+        ((10.0, None, 30.0), 10.0),
+        ((10.0, "5", 30.0), 5.0),
+        ((3.0, "5", 0.0), 3.0),
+    ]
+    for args, expected in cases:
+        deadline = request_deadline(*args)
+        if (deadline is None) != (expected is None) or (
+            deadline is not None and abs(deadline - now - expected) > 1.0
+        ):
+            print(f"  request_deadline{args}: 期望 {expected}s，实际 {deadline and deadline - now}")
+            passed = False
+    for header in ("0", "-1", "abc", "nan"):
+        try:
+            request_deadline(None, header)
+            print(f"  头部 {header!r} 未抛出 ValueError")
+            passed = False
+        except ValueError:
+            pass
+    return passed
+
+
+def main() -> bool:
+    results = {
+        "租户加权公平排队": asyncio.run(check_fair_queuing()),
+        "优先级与 batch 并发上限": asyncio.run(check_priority()),
+        "截止时间拒绝与排队到期": asyncio.run(check_deadline()),
+        "队列满时拒绝": asyncio.run(check_queue_full()),
+        "请求截止时间解析": check_request_deadline(),
+    }
+    for name, ok in results.items():
+        print(f"{name}: {'通过' if ok else '失败'}")
+    return all(results.values())
+
+
+if __name__ == "__main__":
+    ok = main()
+    print("通过" if ok else "失败")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,120 @@
+"""
+增量解码测试 - 多字节字符被切分到多个 token 时，流式输出不出现半个字符，拼接结果与整体解码一致
+不需要模型权重（使用按字节 / 按固定字节块切分的分词器）
+
+用法:
+    python test/test_detokenizer.py
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detokenizer import IncrementalDetokenizer  # noqa: E402
+
+SPECIAL_TOKEN_ID = 100000  # 跳过特殊 token 时解码为空
+TEXTS = ["你好，世界", "naïve café 😀 ok", "混合 mixed テキスト 🎉🎉", "a", "  前导空格"]
+
+
+class ChunkTokenizer:
+    """把 UTF-8 字节按 chunk_size 切成 token（token id 按片段首次出现的顺序编号），多字节字符会跨 token"""
+
+    def __init__(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.pieces = {}
+
+    def encode(self, text: str):
+        data = text.encode("utf-8")
+        ids = []
+        for pos in range(0, len(data), self.chunk_size):
+            piece = data[pos:pos + self.chunk_size]
+            ids.append(self.pieces.setdefault(piece, len(self.pieces)))
+        return ids
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        by_id = {token_id: piece for piece, token_id in self.pieces.items()}
+        data = b"".join(by_id[t] for t in token_ids if t != SPECIAL_TOKEN_ID or not skip_special_tokens)
+        return data.decode("utf-8", errors="replace")
+
+
+def stream(tokenizer, token_ids, step_sizes):
+    """按 step_sizes 分批喂入 token，返回每步的增量文本与 flush 的结果"""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = []
+    pos = 0
+    for size in step_sizes:
+        deltas.append(detokenizer.step(token_ids[pos:pos + size]))
+        pos += size
+    return deltas, detokenizer.flush()
+
+
+def check_split_characters() -> bool:
+    rng = random.Random(0)
+    passed = True
+    for chunk_size in (1, 2, 3, 5):
+        tokenizer = ChunkTokenizer(chunk_size)
+        for text in TEXTS:
+            token_ids = tokenizer.encode(text)
+            # 每次一个 token，以及随机多个 token 一起喂入（投机解码一步接受多个 token）
+            plans = [[1] * len(token_ids)]
+            sizes = []
+            while sum(sizes) < len(token_ids):
+                sizes.append(rng.randint(1, 3))
+            plans.append(sizes)
+            for step_sizes in plans:
+                deltas, tail = stream(tokenizer, token_ids, step_sizes)
+                if "".join(deltas) + tail != text:
+                    print(f"  chunk={chunk_size} {text!r}: 拼接结果 {''.join(deltas) + tail!r}")
+                    passed = False
+                if any("�" in delta for delta in deltas) or "�" in tail:
+                    print(f"  chunk={chunk_size} {text!r}: 输出了不完整的字符 {deltas}")
+                    passed = False
+    return passed
+
+
+def check_emit_on_completion() -> bool:
+    """字符的最后一个字节到达时立即输出，不等到结束"""
+    tokenizer = ChunkTokenizer(1)
+    token_ids = tokenizer.encode("你好")  # 每个汉字 3 个字节
+    deltas, tail = stream(tokenizer, token_ids, [1] * len(token_ids))
+    expected = ["", "", "你", "", "", "好"]
+    if deltas != expected or tail != "":
+        print(f"  期望 {expected}，实际 {deltas} + {tail!r}")
+        return False
+    return True
+
+
+def check_incomplete_tail_and_special_tokens() -> bool:
+    tokenizer = ChunkTokenizer(1)
+    token_ids = tokenizer.encode("好")
+    # 只有前两个字节时结束：flush 返回替换字符，而不是丢弃
+    deltas, tail = stream(tokenizer, token_ids[:2], [1, 1])
+    passed = True
+    if deltas != ["", ""] or tail != "�":
+        print(f"  不完整的结尾: {deltas} + {tail!r}")
+        passed = False
+    # 特殊 token 解码为空，不影响前后文本
+    ids = tokenizer.encode("ab") + [SPECIAL_TOKEN_ID] + tokenizer.encode("c")
+    deltas, tail = stream(tokenizer, ids, [1] * len(ids))
+    if "".join(deltas) + tail != "abc" or deltas[2] != "":
+        print(f"  特殊 token: {deltas} + {tail!r}")
+        passed = False
+    return passed
+
+
+def main() -> bool:
+    results = {
+        "多字节字符跨 token": check_split_characters(),
+        "字符补全时立即输出": check_emit_on_completion(),
+        "不完整结尾与特殊 token": check_incomplete_tail_and_special_tokens(),
+    }
+    for name, ok in results.items():
+        print(f"{name}: {'通过' if ok else '失败'}")
+    return all(results.values())
+
+
+if __name__ == "__main__":
+    ok = main()
+    print("通过" if ok else "失败")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,96 @@
+"""
+回归测试 - prefill 失败时请求应返回错误，而不是一直等待
+用随机初始化的小模型（无需下载权重），包装 forward 使 prefill（输入长度 > 1）抛出异常，
+检查普通请求与 n > 1 的请求都收到该错误，之后引擎仍可正常处理新请求
+
+用法:
+    python test/test_prefill_failure.py
+"""
+import asyncio
+import os
+import sys
+
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_engine import ContinuousBatchingEngine  # noqa: E402
+from sampling import SamplingParams  # noqa: E402
+
+# 请求应在该时间内结束（失败时会一直等待）
+TIMEOUT_SECONDS = 10
+
+
+class CharTokenizer:
+    """只用于解码输出的最小分词器"""
+    eos_token_id = 1
+    pad_token_id = 0
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(chr(ord("a") + t % 26) for t in token_ids if t != self.eos_token_id)
+
+
+class FailingPrefillModel(torch.nn.Module):
+    """fail_prefill 为 True 时，输入长度大于 1 的前向（prefill）抛出异常"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.config = model.config
+        self.fail_prefill = True
+
+    def forward(self, input_ids=None, **kwargs):
+        if self.fail_prefill and input_ids.shape[1] > 1:
+            raise RuntimeError("注入的 prefill 失败")
+        return self.model(input_ids=input_ids, **kwargs)
+
+
+def make_model() -> FailingPrefillModel:
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=64, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512, eos_token_id=1,
+    )
+    return FailingPrefillModel(Qwen2ForCausalLM(config).eval())
+
+
+async def run_request(engine, params: SamplingParams) -> str:
+    """返回 "ok" 或异常信息，超时视为失败"""
+    async def collect():
+        async for _ in engine.generate([5, 6, 7, 8], params):
+            pass
+    try:
+        await asyncio.wait_for(collect(), TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        return "timeout"
+    except RuntimeError as e:
+        return str(e)
+    return "ok"
+
+
+async def main() -> bool:
+    model = make_model()
+    engine = ContinuousBatchingEngine(model, CharTokenizer(), max_batch_size=4, max_model_len=256)
+    engine.start()
+    try:
+        results = await asyncio.gather(
+            run_request(engine, SamplingParams(max_tokens=8, temperature=0)),
+            run_request(engine, SamplingParams(max_tokens=8, temperature=0.8, n=2)),
+        )
+        print(f"prefill 失败时: {results}")
+        passed = all(result == "注入的 prefill 失败" for result in results)
+
+        model.fail_prefill = False
+        result = await run_request(engine, SamplingParams(max_tokens=8, temperature=0))
+        print(f"恢复后: {result}")
+        passed = passed and result == "ok"
+    finally:
+        engine.stop()
+    return passed
+
+
+if __name__ == "__main__":
+    ok = asyncio.run(main())
+    print("通过" if ok else "失败")
+    sys.exit(0 if ok else 1)
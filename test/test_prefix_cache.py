@@ -0,0 +1,135 @@
+"""
+前缀 KV 缓存测试 - 基数树的命中 / 分裂、LRU 淘汰与内存计数、命中返回的 KV 与缓存内部互不影响
+不需要模型权重（KV 张量的值直接编码 token id，便于核对拼接结果）
+
+用法:
+    python test/test_prefix_cache.py
+"""
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefix_cache import PrefixCache  # noqa: E402
+
+NUM_LAYERS = 2
+BYTES_PER_TOKEN = NUM_LAYERS * 2 * 2 * 4  # 每层 key + value，head_dim=2，float32
+
+
+def make_kv(token_ids):
+    """每个位置的 key 为 token id，value 为其相反数，形状 [1, 1, seq_len, 2]"""
+    ids = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1).expand(1, 1, -1, 2).contiguous()
+    return tuple((ids.clone() + layer, -ids.clone() - layer) for layer in range(NUM_LAYERS))
+
+
+def kv_matches(kv, token_ids) -> bool:
+    expected = make_kv(token_ids)
+    return all(torch.equal(k, ek) and torch.equal(v, ev) for (k, v), (ek, ev) in zip(kv, expected))
+
+
+def tree_bytes(cache: PrefixCache) -> int:
+    total = 0
+    stack = list(cache._root.children.values())
+    while stack:
+        node = stack.pop()
+        total += node.nbytes
+        stack.extend(node.children.values())
+    return total
+
+
+def check_match_and_split() -> bool:
+    cache = PrefixCache(max_bytes=1 << 20, min_match_tokens=2)
+    a = [1, 2, 3, 4, 5, 6]
+    b = [1, 2, 3, 7, 8]
+    cache.insert(a, make_kv(a))
+    cache.insert(b, make_kv(b))  # 在位置 3 分裂 a 的边
+    passed = True
+    cases = [
+        (a + [9], None, 6),
+        (b, None, 5),
+        ([1, 2, 3, 4, 0], None, 4),
+        (a, 4, 4),  # max_length 限制命中长度
+        ([1, 9], None, 0),  # 不足 min_match_tokens
+        ([5, 6], None, 0),
+    ]
+    for token_ids, max_length, expected in cases:
+        length, kv = cache.match(token_ids, max_length)
+        if length != expected or (length and not kv_matches(kv, token_ids[:length])) or (not length and kv is not None):
+            print(f"  match({token_ids}, {max_length}): 期望长度 {expected}，实际 {length}")
+            passed = False
+    if cache.total_bytes != tree_bytes(cache) or cache.total_bytes != BYTES_PER_TOKEN * 8:
+        print(f"  total_bytes {cache.total_bytes}，树中实际 {tree_bytes(cache)}，期望 {BYTES_PER_TOKEN * 8}")
+        passed = False
+    return passed
+
+
+def check_lru_eviction() -> bool:
+    # 容量 11 个 token：公共前缀 2 + 三个分支各 3，插入第四个分支后只需淘汰一个
+    cache = PrefixCache(max_bytes=BYTES_PER_TOKEN * 11, min_match_tokens=1)
+    seqs = {name: [0, 0] + [base] * 3 for name, base in (("a", 10), ("b", 20), ("c", 30))}
+    for name in ("a", "b", "c"):
+        cache.insert(seqs[name], make_kv(seqs[name]))
+        time.sleep(0.002)
+    cache.match(seqs["a"])  # a 最近访问过，最久未用的是 b
+    time.sleep(0.002)
+    d = [0, 0, 40, 40, 40]
+    cache.insert(d, make_kv(d))
+
+    passed = True
+    expected = {"a": 5, "b": 2, "c": 5}
+    for name, length in expected.items():
+        got, kv = cache.match(seqs[name])
+        if got != length or not kv_matches(kv, seqs[name][:got]):
+            print(f"  分支 {name}: 期望命中 {length}，实际 {got}")
+            passed = False
+    if cache.evictions != 1 or cache.total_bytes > cache.max_bytes or cache.total_bytes != tree_bytes(cache):
+        print(f"  evictions={cache.evictions}，total_bytes={cache.total_bytes}，树中实际 {tree_bytes(cache)}")
+        passed = False
+    return passed
+
+
+def check_matched_kv_is_independent() -> bool:
+    """缓存不做引用计数：命中返回的是拼接出的副本，插入时也复制源 KV，淘汰 / 清空不影响正在使用的 KV"""
+    cache = PrefixCache(max_bytes=BYTES_PER_TOKEN * 6, min_match_tokens=1)
+    a = [1, 2, 3, 4]
+    source = make_kv(a)
+    cache.insert(a, source)
+    for k, v in source:  # 引擎复用 batch 张量时会原地改写
+        k.zero_()
+        v.zero_()
+    length, kv = cache.match(a)
+    passed = True
+    if length != 4 or not kv_matches(kv, a):
+        print("  改写源 KV 后缓存内容被破坏")
+        passed = False
+
+    b = [5, 6, 7, 8]
+    cache.insert(b, make_kv(b))  # 超出容量，淘汰 a
+    if cache.match(a)[0] != 0:
+        print("  a 未被淘汰")
+        passed = False
+    cache.clear()
+    if not kv_matches(kv, a) or cache.total_bytes != 0:
+        print("  淘汰 / 清空后已返回的 KV 被修改")
+        passed = False
+    return passed
+
+
+def main() -> bool:
+    results = {
+        "命中与分裂": check_match_and_split(),
+        "LRU 淘汰与内存计数": check_lru_eviction(),
+        "命中的 KV 与缓存互不影响": check_matched_kv_is_independent(),
+    }
+    for name, ok in results.items():
+        print(f"{name}: {'通过' if ok else '失败'}")
+    return all(results.values())
+
+
+if __name__ == "__main__":
+    ok = main()
+    print("通过" if ok else "失败")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,159 @@
+"""
+限流测试 - 令牌桶的预扣与退还、超出容量的请求、限流响应头、按 API key 识别租户（user 字段不能冒充）、租户配置解析
+不需要模型权重
+
+用法:
+    python test/test_rate_limit.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import PRIORITY_BATCH  # noqa: E402
+from rate_limit import (  # noqa: E402
+    ANONYMOUS,
+    RateLimiter,
+    RateLimitError,
+    TenantConfig,
+    key_tenant_name,
+    parse_tenant_specs,
+)
+
+SECRET = "sk-test-secret"
+
+
+def expect_limited(limiter: RateLimiter, name: str, tokens: int):
+    """check 应被拒绝，返回 RateLimitError；未拒绝时返回 None"""
+    try:
+        limiter.check(name, tokens)
+    except RateLimitError as e:
+        return e
+    print(f"  {name} 预扣 {tokens} 未被拒绝")
+    return None
+
+
+def check_refund() -> bool:
+    # 每分钟 60 个 token，每秒补充 1 个，测试期间的补充可以忽略
+    limiter = RateLimiter({}, TenantConfig(tokens_per_minute=60))
+    passed = True
+    limiter.check("t", 50)
+    error = expect_limited(limiter, "t", 20)
+    if error is None or not 9 <= error.retry_after <= 11:
+        print(f"  剩余约 10 个 token 时预扣 20，Retry-After 应约为 10s，实际 {error and error.retry_after}")
+        passed = False
+    # 生成结束后退还未用完的 40 个，额度恢复
+    limiter.refund("t", 40)
+    try:
+        limiter.check("t", 20)
+    except RateLimitError:
+        print("  退还后仍被拒绝")
+        passed = False
+    # 退还不超过桶容量，非正数不退还
+    limiter.refund("t", 1000)
+    limiter.refund("t", -1000)
+    bucket = limiter._get_buckets("t")[1]
+    if bucket.tokens != bucket.capacity:
+        print(f"  退还后令牌数 {bucket.tokens}，应为容量 {bucket.capacity}")
+        passed = False
+    # 超过每分钟额度的请求永远无法满足：固定 Retry-After 60，而不是无穷大
+    error = expect_limited(limiter, "t", 61)
+    if error is None or error.retry_after != 60 or "61" not in str(error):
+        print(f"  超出容量: {error and (error.retry_after, str(error))}")
+        passed = False
+    return passed
+
+
+def check_headers() -> bool:
+    limiter = RateLimiter({}, TenantConfig(requests_per_minute=2, tokens_per_minute=1000))
+    passed = True
+    headers = limiter.check("t", 100)
+    expected = {
+        "x-ratelimit-limit-requests": "2", "x-ratelimit-remaining-requests": "1",
+        "x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "900",
+    }
+    if any(headers.get(k) != v for k, v in expected.items()) or "x-ratelimit-reset-tokens" not in headers:
+        print(f"  响应头: {headers}")
+        passed = False
+    limiter.check("t", 100)
+    error = expect_limited(limiter, "t", 100)
+    if error is None or error.headers.get("Retry-After") != str(error.retry_after) or "请求数" not in str(error):
+        print(f"  请求数超限: {error and (str(error), error.headers)}")
+        passed = False
+    # 不限制的租户没有限流响应头
+    if RateLimiter({}, TenantConfig()).check("t", 100) != {}:
+        print("  不限制的租户返回了限流响应头")
+        passed = False
+    return passed
+
+
+def check_tenant_identity() -> bool:
+    default = TenantConfig(tokens_per_minute=50)
+    tenants = parse_tenant_specs(f"vip=key:{SECRET},weight:4,priority:batch;free=rpm:1", default)
+    limiter = RateLimiter(tenants, default)
+    other_key = "sk-other-key"
+    cases = [
+        ((None, f"Bearer {SECRET}"), ("vip", 4.0, PRIORITY_BATCH)),
+        (("free", f"Bearer {SECRET}"), ("vip", 4.0, PRIORITY_BATCH)),  # 有 key 时 user 字段不参与
+        (("vip", None), ("user:vip", 1.0, default.priority)),  # 不能用 user 字段认领配置了 key 的租户
+        (("vip", f"Bearer {other_key}"), (key_tenant_name(other_key), 1.0, default.priority)),
+        (("free", None), ("free", 1.0, default.priority)),
+        ((None, None), (ANONYMOUS, 1.0, default.priority)),
+        ((None, "Basic abc"), (ANONYMOUS, 1.0, default.priority)),
+    ]
+    passed = True
+    for args, expected in cases:
+        tenant = limiter.resolve(*args)
+        if (tenant.name, tenant.weight, tenant.priority) != expected:
+            print(f"  resolve{args}: 期望 {expected}，实际 {tenant}")
+            passed = False
+
+    # 错误信息中只出现 key 的哈希，不出现 key 本身
+    name = limiter.tenant_name(None, f"Bearer {other_key}")
+    limiter.check(name, 50)
+    error = expect_limited(limiter, name, 10)
+    if error is None or other_key in str(error) or name not in str(error):
+        print(f"  错误信息: {error}")
+        passed = False
+
+    try:
+        RateLimiter(parse_tenant_specs(f"a=key:{SECRET};b=key:{SECRET}", default), default)
+        print("  重复的 key 未报错")
+        passed = False
+    except ValueError:
+        pass
+    return passed
+
+
+def check_parse_errors() -> bool:
+    passed = True
+    for specs in ("bad", "=weight:1", "x=foo:1", "x=priority:urgent", "x=weight:0", "x=rpm:abc"):
+        try:
+            parse_tenant_specs(specs, TenantConfig())
+            print(f"  {specs!r} 未报错")
+            passed = False
+        except ValueError:
+            pass
+    tenants = parse_tenant_specs(" a=rpm:5 ; ;b=", TenantConfig(tokens_per_minute=7))
+    if tenants != {"a": TenantConfig(requests_per_minute=5, tokens_per_minute=7), "b": TenantConfig(tokens_per_minute=7)}:
+        print(f"  解析结果: {tenants}")
+        passed = False
+    return passed
+
+
+def main() -> bool:
+    results = {
+        "令牌退还": check_refund(),
+        "限流响应头": check_headers(),
+        "按 API key 识别租户": check_tenant_identity(),
+        "租户配置解析": check_parse_errors(),
+    }
+    for name, ok in results.items():
+        print(f"{name}: {'通过' if ok else '失败'}")
+    return all(results.values())
+
+
+if __name__ == "__main__":
+    ok = main()
+    print("通过" if ok else "失败")
+    sys.exit(0 if ok else 1)
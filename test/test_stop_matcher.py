@@ -0,0 +1,150 @@
+"""
+停止词匹配测试 - 停止词被切分到多个 token / chunk 时也能命中，位置与逐字符朴素匹配一致；
+引擎在结束（max_tokens / EOS）时吐出增量解码暂缓的尾部文本，尾部中的停止词同样要截断
+不需要模型权重（引擎部分使用随机初始化的小模型，只调用文本更新逻辑，不做前向）
+
+用法:
+    python test/test_stop_matcher.py
+"""
+import os
+import random
+import sys
+
+from transformers import Qwen2Config, Qwen2ForCausalLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_engine import ContinuousBatchingEngine, Sequence  # noqa: E402
+from sampling import SamplingParams  # noqa: E402
+from stop_matcher import StopMatcher  # noqa: E402
+
+EOS_TOKEN_ID = 0
+# 多字节 token：停止词后紧跟一个不完整的多字节字符，整个 token 的文本在增量解码中被暂缓
+END_PARTIAL_TOKEN_ID = 256
+PIECES = {END_PARTIAL_TOKEN_ID: b"END\xe5"}
+
+
+class BytePieceTokenizer:
+    """token id < 256 为单个字节，其余按 PIECES；不完整的多字节字符解码为 U+FFFD"""
+    eos_token_id = EOS_TOKEN_ID
+    pad_token_id = EOS_TOKEN_ID
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        data = b"".join(PIECES[t] if t in PIECES else bytes([t]) for t in token_ids if t != EOS_TOKEN_ID)
+        return data.decode("utf-8", errors="replace")
+
+
+def naive_first_match(text: str, patterns) -> int:
+    """逐字符检查：最早结束的停止词（同一位置结束时取最长者）的起始位置"""
+    for end in range(1, len(text) + 1):
+        lengths = [len(p) for p in patterns if p and text[:end].endswith(p)]
+        if lengths:
+            return end - max(lengths)
+    return -1
+
+
+def feed_chunks(matcher: StopMatcher, chunks) -> int:
+    for chunk in chunks:
+        start = matcher.feed(chunk)
+        if start >= 0:
+            return start
+    return -1
+
+
+def check_split_across_chunks() -> bool:
+    cases = [
+        (["Hel", "lo W", "orld"], ["lo Wo"], 3),
+        (["用户", "：", "你好"], ["用户：你"], 0),
+        (["ab", "c"], ["abcd", "bc"], 1),  # 失败链上的短停止词
+        (["xxab", "ab", "c"], ["abc"], 4),  # 部分匹配失败后重新开始
+        (["no stop ", "here"], ["STOP"], -1),
+    ]
+    passed = True
+    for chunks, patterns, expected in cases:
+        got = feed_chunks(StopMatcher(patterns), chunks)
+        if got != expected:
+            print(f"  {chunks} / {patterns}: 期望 {expected}，实际 {got}")
+            passed = False
+
+    # pending：末尾可能是停止词开头的字符数
+    matcher = StopMatcher(["abc"])
+    matcher.feed("xxab")
+    if matcher.pending != 2:
+        print(f"  pending 期望 2，实际 {matcher.pending}")
+        passed = False
+    return passed
+
+
+def check_random_against_naive() -> bool:
+    rng = random.Random(0)
+    alphabet = "ab中\n"
+    for _ in range(2000):
+        patterns = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 3))]
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        chunks = []
+        pos = 0
+        while pos < len(text):
+            size = rng.randint(1, 5)
+            chunks.append(text[pos:pos + size])
+            pos += size
+        expected = naive_first_match(text, patterns)
+        got = feed_chunks(StopMatcher(patterns), chunks)
+        if got != expected:
+            print(f"  {text!r} / {patterns} / {chunks}: 期望 {expected}，实际 {got}")
+            return False
+    return True
+
+
+def make_engine() -> ContinuousBatchingEngine:
+    config = Qwen2Config(
+        vocab_size=256, hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+        num_attention_heads=2, num_key_value_heads=1, max_position_embeddings=256, eos_token_id=EOS_TOKEN_ID,
+    )
+    return ContinuousBatchingEngine(Qwen2ForCausalLM(config).eval(), BytePieceTokenizer(), max_batch_size=1, max_model_len=256)
+
+
+def run_tokens(engine: ContinuousBatchingEngine, token_ids, params: SamplingParams) -> Sequence:
+    seq = Sequence("test", [1], params, loop=None)
+    for token in token_ids:
+        seq.output_token_ids.append(token)
+        engine._update_text(seq, token)
+        if seq.finished:
+            break
+    return seq
+
+
+def check_stop_in_flushed_tail() -> bool:
+    engine = make_engine()
+    # 最后一个 token 的文本以不完整的字符结尾，"END" 被增量解码暂缓，直到结束时才由 flush 吐出
+    tokens = list(b"ab") + [END_PARTIAL_TOKEN_ID]
+    cases = [
+        (tokens, SamplingParams(max_tokens=len(tokens), stop=["END"]), "ab", "stop"),
+        (tokens + [EOS_TOKEN_ID], SamplingParams(max_tokens=100, stop=["END"]), "ab", "stop"),
+        (tokens + [EOS_TOKEN_ID], SamplingParams(max_tokens=100, stop=["bE"]), "a", "stop"),
+        (tokens, SamplingParams(max_tokens=len(tokens), stop=["XYZ"]), "abEND\ufffd", "length"),
+        (list("你好END".encode()), SamplingParams(max_tokens=100, stop=["好E"]), "你", "stop"),
+    ]
+    passed = True
+    for token_ids, params, text, finish_reason in cases:
+        seq = run_tokens(engine, token_ids, params)
+        if (seq.text, seq.finish_reason) != (text, finish_reason):
+            print(f"  stop={params.stop}: 期望 {(text, finish_reason)}，实际 {(seq.text, seq.finish_reason)}")
+            passed = False
+    return passed
+
+
+def main() -> bool:
+    results = {
+        "停止词跨 chunk": check_split_across_chunks(),
+        "与朴素匹配一致": check_random_against_naive(),
+        "结束时尾部文本的停止词": check_stop_in_flushed_tail(),
+    }
+    for name, ok in results.items():
+        print(f"{name}: {'通过' if ok else '失败'}")
+    return all(results.values())
+
+
+if __name__ == "__main__":
+    ok = main()
+    print("通过" if ok else "失败")
+    sys.exit(0 if ok else 1)
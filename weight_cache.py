@@ -0,0 +1,132 @@
+"""
+转换后权重缓存（CPU）- 冷启动时跳过 from_pretrained 的 dtype 转换与量化
+- 按目标精度保存转换（int4 为量化）后的全部参数与 buffer（torch.save 格式）
+- 命中时在 meta 设备上构建模型骨架，权重以 mmap 方式零拷贝读入：加载几乎不读盘，页面在首次访问（预热）时才读入，
+  多个 worker 进程加载同一缓存可共享操作系统页缓存
+- int8 动态量化的打包权重无法 mmap，缓存量化前的 bf16 权重，加载后再量化
+- 缓存键包含源权重文件的大小与修改时间、精度参数和 PyTorch 版本，任一变化时自动重新生成
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import torch
+import torch.nn as nn
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+import quantization
+from model_registry import WEIGHT_FILE_SUFFIXES
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+WEIGHTS_FILE = "weights.pt"
+META_FILE = "meta.json"  # 最后写入，存在即表示缓存完整
+
+
+def cached_precision(precision: str) -> str:
+    """缓存中权重的精度：int8 缓存量化前的权重"""
+    return "bf16" if precision == "int8" else precision
+
+
+def cache_key(model_path: str, precision: str, int4_group_size: int) -> str:
+    parts = [
+        CACHE_FORMAT_VERSION,
+        os.path.realpath(model_path),
+        precision,
+        int4_group_size if precision == "int4" else 0,
+        torch.__version__,
+    ]
+    if os.path.isdir(model_path):
+        for name in sorted(os.listdir(model_path)):
+            if name.endswith(WEIGHT_FILE_SUFFIXES) or name == "config.json":
+                stat = os.stat(os.path.join(model_path, name))
+                parts.append([name, stat.st_size, int(stat.st_mtime)])
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class WeightCache:
+    """cache_dir 下每个 (模型, 精度) 一个子目录"""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def entry_dir(self, model_path: str, precision: str, int4_group_size: int) -> str:
+        name = os.path.basename(os.path.normpath(model_path)) or "model"
+        return os.path.join(self.cache_dir, f"{name}-{precision}-{cache_key(model_path, precision, int4_group_size)}")
+
+    def load(self, model_path: str, precision: str, int4_group_size: int) -> Optional[nn.Module]:
+        """命中时返回 mmap 加载的模型（精度为 cached_precision(precision)），未命中或缓存损坏时返回 None"""
+        precision = cached_precision(precision)
+        entry = self.entry_dir(model_path, precision, int4_group_size)
+        if not os.path.exists(os.path.join(entry, META_FILE)):
+            return None
+        try:
+            model = _build_skeleton(model_path, precision, int4_group_size)
+            tensors = torch.load(os.path.join(entry, WEIGHTS_FILE), map_location="cpu", mmap=True, weights_only=True)
+            _assign_tensors(model, tensors)
+        except Exception as e:
+            logger.warning(f"权重缓存 {entry} 加载失败，改为从原始权重加载: {str(e)}")
+            return None
+        logger.info(f"从权重缓存加载（mmap）: {entry}")
+        return model.eval()
+
+    def save(self, model: nn.Module, model_path: str, precision: str, int4_group_size: int) -> None:
+        """保存转换后的权重；先写临时文件再改名，多个进程同时写入也不会留下不完整的缓存"""
+        entry = self.entry_dir(model_path, cached_precision(precision), int4_group_size)
+        os.makedirs(entry, exist_ok=True)
+        tensors = {name: tensor.detach() for name, tensor in model.named_parameters(remove_duplicate=False)}
+        tensors.update(model.named_buffers(remove_duplicate=False))
+        suffix = f".tmp{os.getpid()}"
+        torch.save(tensors, os.path.join(entry, WEIGHTS_FILE + suffix))
+        os.replace(os.path.join(entry, WEIGHTS_FILE + suffix), os.path.join(entry, WEIGHTS_FILE))
+        meta = {
+            "model_path": model_path,
+            "precision": cached_precision(precision),
+            "int4_group_size": int4_group_size,
+            "memory_bytes": quantization.model_memory_bytes(model),
+            "created": int(time.time()),
+        }
+        with open(os.path.join(entry, META_FILE + suffix), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(os.path.join(entry, META_FILE + suffix), os.path.join(entry, META_FILE))
+        logger.info(f"已写入权重缓存: {entry}")
+
+
+def _build_skeleton(model_path: str, precision: str, int4_group_size: int) -> nn.Module:
+    """在 meta 设备上构建与转换后结构一致的模型（不分配内存）"""
+    model_config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(model_config, trust_remote_code=True)
+    model.to(quantization.LOAD_DTYPES[precision])
+    if precision == "int4":
+        quantization.apply_precision(model, precision, int4_group_size)
+    try:
+        # 引擎从 generation_config 读取额外的结束 token
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        pass
+    return model
+
+
+def _assign_tensors(model: nn.Module, tensors: Dict[str, torch.Tensor]) -> None:
+    """把 mmap 的张量直接挂到模型上（不复制），含非持久化 buffer"""
+    for name, tensor in tensors.items():
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        elif attr in module._buffers:
+            module._buffers[attr] = tensor
+        else:
+            raise KeyError(f"缓存中的张量与模型结构不匹配: {name}")
+    missing = [
+        name
+        for name, tensor in list(model.named_parameters(remove_duplicate=False)) + list(model.named_buffers())
+        if tensor.is_meta
+    ]
+    if missing:
+        raise KeyError(f"缓存缺少张量: {', '.join(missing[:5])}")
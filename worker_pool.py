@@ -0,0 +1,363 @@
+"""
+多进程推理 worker 池（CPU）
+- 启动 K 个 worker 进程，每个绑定一组 CPU 核（或一个 NUMA 节点），使用各自的 torch 线程数
+- 每个 worker 运行一个连续批处理引擎；前端进程把请求派发给负载最低的 worker，
+  带 session_id 的请求固定派发到同一个 worker（会话 KV 缓存在 worker 进程内）
+- 权重只读共享，不会占用 K 倍内存：
+    fork 模式：前端进程加载一次模型后 fork，worker 与前端共享同一份物理内存页（写时复制）
+    mmap 模式：worker 各自以 mmap 方式加载 safetensors，共享操作系统页缓存
+- 对外接口与 ContinuousBatchingEngine 一致（start / stop / generate / abort / stats）
+"""
+import asyncio
+import gc
+import glob
+import logging
+import multiprocessing as mp
+import os
+import threading
+import uuid
+import zlib
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+import torch
+
+from batch_engine import RequestOutput
+from sampling import SamplingParams
+
+logger = logging.getLogger(__name__)
+
+# worker 向前端上报引擎状态的间隔（秒）
+STATS_INTERVAL = 1.0
+
+
+def parse_cpu_list(text: str) -> Set[int]:
+    """解析 "0-3,8,10-11" 格式的核列表"""
+    cpus = set()
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def numa_cpu_sets() -> List[Set[int]]:
+    """读取每个 NUMA 节点的 CPU 列表（仅 Linux），与当前进程允许的核取交集"""
+    allowed = os.sched_getaffinity(0)
+    cpu_sets = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as f:
+            cpus = parse_cpu_list(f.read()) & allowed
+        if cpus:
+            cpu_sets.append(cpus)
+    return cpu_sets
+
+
+def plan_cpu_sets(num_workers: int, cpu_sets: str = "", numa: bool = False) -> List[Optional[Set[int]]]:
+    """
+    确定每个 worker 绑定的核
+    优先使用显式配置（"0-15;16-31"），其次按 NUMA 节点，最后把可用核均分为连续的若干段
+    """
+    if cpu_sets:
+        planned = [parse_cpu_list(part) for part in cpu_sets.split(";") if part.strip()]
+    elif numa:
+        planned = numa_cpu_sets()
+    elif hasattr(os, "sched_getaffinity"):
+        allowed = sorted(os.sched_getaffinity(0))
+        per_worker = max(1, len(allowed) // num_workers)
+        planned = [
+            set(allowed[i * per_worker:(i + 1) * per_worker]) or set(allowed)
+            for i in range(num_workers)
+        ]
+    else:
+        return [None] * num_workers
+
+    if len(planned) < num_workers:
+        logger.warning(f"CPU 分组数 {len(planned)} 少于 worker 数 {num_workers}，部分 worker 共享核")
+    return [planned[i % len(planned)] for i in range(num_workers)]
+
+
+# ============================================
+# worker 进程
+# ============================================
+
+def _worker_main(
+    worker_id: int,
+    conn,
+    cpu_set: Optional[Set[int]],
+    num_threads: int,
+    models,
+    model_path: Optional[str],
+    use_draft: bool,
+):
+    import config
+    import model_loader
+
+    if cpu_set:
+        os.sched_setaffinity(0, cpu_set)
+    threads = num_threads or (len(cpu_set) if cpu_set else torch.get_num_threads())
+    torch.set_num_threads(threads)
+
+    if models is None:
+        model_path = model_path or config.MODEL_PATH
+        model, tokenizer = model_loader.load_model(model_path), model_loader.load_tokenizer(model_path)
+        draft_model = model_loader.load_draft_model() if use_draft else None
+    else:
+        model, tokenizer, draft_model = models
+    engine = model_loader.build_engine(model, tokenizer, draft_model)
+    engine.start()
+    logger.info(f"worker {worker_id} 已启动 (pid={os.getpid()}, cpus={sorted(cpu_set) if cpu_set else 'all'}, threads={threads})")
+    try:
+        asyncio.run(_worker_serve(conn, engine))
+    finally:
+        engine.stop()
+
+
+async def _worker_serve(conn, engine) -> None:
+    loop = asyncio.get_running_loop()
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def run_request(
+        request_id: str, prompt_token_ids: List[int], params: SamplingParams, session_id: Optional[str]
+    ):
+        try:
+            async for output in engine.generate(prompt_token_ids, params, request_id, session_id):
+                conn.send(("output", request_id, output))
+        except Exception as e:
+            conn.send(("output", request_id, e))
+        finally:
+            tasks.pop(request_id, None)
+
+    async def report_stats():
+        while True:
+            conn.send(("stats", None, engine.stats()))
+            await asyncio.sleep(STATS_INTERVAL)
+
+    stats_task = asyncio.create_task(report_stats())
+    while True:
+        try:
+            message = await loop.run_in_executor(None, conn.recv)
+        except (EOFError, OSError):
+            break
+        kind = message[0]
+        if kind == "generate":
+            _, request_id, prompt_token_ids, params, session_id = message
+            tasks[request_id] = asyncio.create_task(run_request(request_id, prompt_token_ids, params, session_id))
+        elif kind == "abort":
+            engine.abort(message[1])
+        elif kind == "stop":
+            break
+    stats_task.cancel()
+
+
+# ============================================
+# 前端进程
+# ============================================
+
+class _Worker:
+    def __init__(self, worker_id: int, process, conn, cpu_set: Optional[Set[int]]):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        self.cpu_set = cpu_set
+        self.alive = True
+        self.inflight = 0
+        self.dispatched_total = 0
+        self.engine_stats: Dict = {}
+
+
+class WorkerPool:
+    """多进程 worker 池，前端侧负责派发请求与汇总输出"""
+
+    def __init__(
+        self,
+        num_workers: int,
+        cpu_sets: str = "",
+        numa: bool = False,
+        threads_per_worker: int = 0,
+        model=None,
+        tokenizer=None,
+        draft_model=None,
+        model_path: Optional[str] = None,
+        use_draft: bool = True,
+    ):
+        """
+        model 不为空时使用 fork 共享已加载的权重（含草稿模型），
+        否则 worker 以 spawn 方式各自 mmap 加载 model_path（默认为 config.MODEL_PATH，use_draft 时加载配置的草稿模型）
+        """
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self._cpu_sets = plan_cpu_sets(num_workers, cpu_sets, numa)
+        self._models = (model, tokenizer, draft_model) if model is not None else None
+        self._model_path = model_path
+        self._use_draft = use_draft
+        self._workers: List[_Worker] = []
+        self._requests: Dict[str, tuple] = {}  # request_id -> (事件循环, 输出队列, 所在 worker)
+        self._stopping = False
+
+    def start(self) -> None:
+        if self._models is not None:
+            ctx = mp.get_context("fork")
+            # 冻结现有对象，避免子进程中的 GC 写对象头触发大量写时复制
+            gc.collect()
+            gc.freeze()
+        else:
+            ctx = mp.get_context("spawn")
+
+        for worker_id, cpu_set in enumerate(self._cpu_sets):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(
+                    worker_id, child_conn, cpu_set, self.threads_per_worker,
+                    self._models, self._model_path, self._use_draft,
+                ),
+                name=f"llm-worker-{worker_id}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            worker = _Worker(worker_id, process, parent_conn, cpu_set)
+            self._workers.append(worker)
+            threading.Thread(
+                target=self._read_loop, args=(worker,), name=f"llm-worker-reader-{worker_id}", daemon=True
+            ).start()
+        logger.info(f"已启动 {self.num_workers} 个推理 worker 进程 ({ctx.get_start_method()} 模式)")
+
+    def stop(self) -> None:
+        self._stopping = True
+        for worker in self._workers:
+            if worker.alive:
+                try:
+                    worker.conn.send(("stop",))
+                except OSError:
+                    pass
+        for worker in self._workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def _pick_worker(self, session_id: Optional[str] = None) -> _Worker:
+        alive = [w for w in self._workers if w.alive]
+        if not alive:
+            raise RuntimeError("没有可用的推理 worker")
+        if session_id is not None:
+            # 同一会话总是派发到同一个 worker，才能复用其缓存的 KV（worker 退出时改派其他 worker）
+            worker = self._workers[zlib.crc32(session_id.encode("utf-8")) % len(self._workers)]
+            if worker.alive:
+                return worker
+        return min(alive, key=lambda w: w.inflight)
+
+    async def generate(
+        self,
+        prompt_token_ids: List[int],
+        params: SamplingParams,
+        request_id: Optional[str] = None,
+        session_id: Optional[str] = None,
+    ) -> AsyncIterator[RequestOutput]:
+        request_id = request_id or uuid.uuid4().hex
+        worker = self._pick_worker(session_id)
+        queue: asyncio.Queue = asyncio.Queue()
+        self._requests[request_id] = (asyncio.get_running_loop(), queue, worker)
+        worker.inflight += 1
+        worker.dispatched_total += 1
+        # worker 侧的 generate() 已完成 best_of 挑选，每个返回的候选各有一个结束输出
+        remaining = params.n
+        try:
+            worker.conn.send(("generate", request_id, list(prompt_token_ids), params, session_id))
+            while remaining:
+                output = await queue.get()
+                if isinstance(output, BaseException):
+                    raise output
+                if output.finished:
+                    remaining -= 1
+                yield output
+        finally:
+            self._requests.pop(request_id, None)
+            worker.inflight -= 1
+            if remaining and worker.alive:
+                try:
+                    worker.conn.send(("abort", request_id))
+                except OSError:
+                    # worker 在检查之后退出：不掩盖原来的异常，由 _read_loop 处理退出
+                    pass
+
+    def abort(self, request_id: str) -> None:
+        for worker in self._workers:
+            if worker.alive:
+                try:
+                    worker.conn.send(("abort", request_id))
+                except OSError:
+                    pass
+
+    def _read_loop(self, worker: _Worker) -> None:
+        while True:
+            try:
+                kind, request_id, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "stats":
+                worker.engine_stats = payload
+                continue
+            entry = self._requests.get(request_id)
+            if entry is not None:
+                loop, queue, _ = entry
+                loop.call_soon_threadsafe(queue.put_nowait, payload)
+
+        worker.alive = False
+        if self._stopping:
+            return
+        logger.error(f"worker {worker.worker_id} 已退出 (exitcode={worker.process.exitcode})")
+        error = RuntimeError(f"推理 worker {worker.worker_id} 异常退出")
+        # 只有派发到该 worker 的请求失败，其他 worker 上的请求继续生成
+        for loop, queue, owner in list(self._requests.values()):
+            if owner is worker:
+                loop.call_soon_threadsafe(queue.put_nowait, error)
+
+    def stats(self) -> Dict:
+        workers = [
+            {
+                "worker_id": w.worker_id,
+                "pid": w.process.pid,
+                "alive": w.alive,
+                "cpus": len(w.cpu_set) if w.cpu_set else None,
+                "inflight": w.inflight,
+                "dispatched_total": w.dispatched_total,
+                "engine": w.engine_stats,
+            }
+            for w in self._workers
+        ]
+        stats = {
+            "num_workers": self.num_workers,
+            "running": sum(w.engine_stats.get("running", 0) for w in self._workers),
+            "waiting": sum(w.engine_stats.get("waiting", 0) for w in self._workers),
+            "total_generated_tokens": sum(w.engine_stats.get("total_generated_tokens", 0) for w in self._workers),
+            "cancelled_total": sum(w.engine_stats.get("cancelled_total", 0) for w in self._workers),
+            "workers": workers,
+        }
+        prefix_stats = [w.engine_stats["prefix_cache"] for w in self._workers if "prefix_cache" in w.engine_stats]
+        if prefix_stats:
+            stats["prefix_cache"] = {
+                "hits": sum(p["hits"] for p in prefix_stats),
+                "misses": sum(p["misses"] for p in prefix_stats),
+            }
+        session_stats = [w.engine_stats["session_cache"] for w in self._workers if "session_cache" in w.engine_stats]
+        if session_stats:
+            stats["session_cache"] = {
+                "hits": sum(p["hits"] for p in session_stats),
+                "misses": sum(p["misses"] for p in session_stats),
+            }
+        spec_stats = [w.engine_stats["speculative"] for w in self._workers if "speculative" in w.engine_stats]
+        if spec_stats:
+            proposed = sum(p["proposed"] for p in spec_stats)
+            accepted = sum(p["accepted"] for p in spec_stats)
+            stats["speculative"] = {
+                "proposed": proposed,
+                "accepted": accepted,
+                "acceptance_rate": round(accepted / proposed, 4) if proposed else 0.0,
+            }
+        return stats